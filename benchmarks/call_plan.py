@@ -0,0 +1,70 @@
+"""emitの1ループあたりの引数準備(シグネチャ解析+Depends解決)のオーバーヘッドを計測する
+
+poetry run python benchmarks/call_plan.py
+"""
+from __future__ import annotations
+
+import asyncio
+import inspect
+from time import perf_counter
+
+from exmachina import Depends, Event
+from exmachina.core.depends_contoroller import DependsContoroller
+
+N = 100_000
+
+
+def config(retries: int = 3):
+    return {"retries": retries}
+
+
+async def session(conf: dict = Depends(config)):
+    return conf
+
+
+def token(conf: dict = Depends(config), _s: dict = Depends(session)):
+    return "token"
+
+
+async def emit(event: Event, interval: int = 1, _s: dict = Depends(session), _t: str = Depends(token)):
+    ...
+
+
+def get_args(func):
+    """呼び出し計画導入前の引数解析"""
+    signature = inspect.signature(func)
+    args = [k for k, v in signature.parameters.items() if v.default is inspect.Parameter.empty]
+    kwargs = {k: v.default for k, v in signature.parameters.items() if v.default is not inspect.Parameter.empty}
+    return args, kwargs
+
+
+async def before():
+    start = perf_counter()
+    for _ in range(N):
+        args, kwargs = get_args(emit)
+        if "event" in args:
+            kwargs["event"] = None
+        kwargs.update(await DependsContoroller.get_depends_result(emit))
+    return perf_counter() - start
+
+
+async def after():
+    plan = DependsContoroller.compile(emit)
+    start = perf_counter()
+    for _ in range(N):
+        kwargs = dict(plan.defaults)
+        if plan.use_event:
+            kwargs["event"] = None
+        kwargs.update(await DependsContoroller.execute_plan(plan))
+    return perf_counter() - start
+
+
+async def main():
+    b = await before()
+    a = await after()
+    print(f"before: {b / N * 1e6:.2f} us/iter")
+    print(f"after : {a / N * 1e6:.2f} us/iter ({b / a:.1f}x)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
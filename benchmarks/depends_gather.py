@@ -0,0 +1,60 @@
+"""互いに独立した非同期のDependsを順に解決した場合と並行して解決した場合の時間を比較する
+
+poetry run python benchmarks/depends_gather.py
+"""
+from __future__ import annotations
+
+import asyncio
+from time import perf_counter
+
+from exmachina import Depends
+from exmachina.core.depends_contoroller import DependsContoroller
+
+N = 20
+LATENCY = 0.01
+
+
+async def lookup_a():
+    await asyncio.sleep(LATENCY)
+
+
+async def lookup_b():
+    await asyncio.sleep(LATENCY)
+
+
+async def lookup_c():
+    await asyncio.sleep(LATENCY)
+
+
+async def execute(
+    a=Depends(lookup_a, use_cache=False), b=Depends(lookup_b, use_cache=False), c=Depends(lookup_c, use_cache=False)
+):
+    ...
+
+
+async def before():
+    """signatureの順に一つずつ解決する"""
+    start = perf_counter()
+    for _ in range(N):
+        for func in (lookup_a, lookup_b, lookup_c):
+            await func()
+    return perf_counter() - start
+
+
+async def after():
+    plan = DependsContoroller.compile(execute)
+    start = perf_counter()
+    for _ in range(N):
+        await DependsContoroller.execute_plan(plan)
+    return perf_counter() - start
+
+
+async def main():
+    b = await before()
+    a = await after()
+    print(f"before: {b / N * 1e3:.2f} ms/iter")
+    print(f"after : {a / N * 1e3:.2f} ms/iter ({b / a:.1f}x)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+"""CPUを使うexecuteを実行中のイベントループの遅延を計測する
+
+executorを指定しない場合はループが止まり遅延が大きくなるが、processを指定するとほぼ一定に保たれる
+
+poetry run python benchmarks/executor.py
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+from time import perf_counter
+
+from exmachina import Event, Machina
+
+CALLS = 16
+TICK = 0.01
+
+
+def cpu_bound(x: int) -> str:
+    data = str(x).encode()
+    for _ in range(200_000):
+        data = hashlib.sha256(data).digest()
+    return data.hex()
+
+
+async def async_cpu_bound(x: int) -> str:
+    return cpu_bound(x)
+
+
+async def measure(executor: str | None) -> tuple[float, float]:
+    bot = Machina()
+    if executor is None:
+        bot.execute(name="cpu")(async_cpu_bound)
+    else:
+        bot.execute(name="cpu", executor=executor)(cpu_bound)  # type: ignore
+
+    lags: list[float] = []
+    done = False
+
+    @bot.emit(count=1)
+    async def ticker():
+        while not done:
+            start = perf_counter()
+            await asyncio.sleep(TICK)
+            lags.append(perf_counter() - start - TICK)
+
+    @bot.emit(count=1)
+    async def emit(event: Event):
+        nonlocal done
+        await asyncio.sleep(TICK)
+        await asyncio.gather(*[event.execute("cpu", i) for i in range(CALLS)])
+        done = True
+
+    await bot.run()
+    return max(lags), sum(lags) / len(lags)
+
+
+async def main():
+    for executor in [None, "thread", "process"]:
+        worst, average = await measure(executor)
+        print(f"executor={executor}: max lag={worst * 1e3:.1f} ms, average lag={average * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,51 @@
+"""`python -X importtime`で`import exmachina`と`from exmachina import Machina`のimport時間を計測する
+
+asyncioなどbotの実行に必ず必要な標準ライブラリは先にimportしておき、exmachinaが追加でimportする分だけを数える
+
+poetry run python benchmarks/import_time.py
+"""
+from __future__ import annotations
+
+import os
+import statistics
+import subprocess
+import sys
+
+import exmachina
+
+N = 10
+# botを動かすのに必ずimportされる標準ライブラリ
+BASELINE = "import asyncio, contextvars, dataclasses, inspect, logging"
+MARK = "--exmachina-import--"
+SOURCE = os.path.dirname(os.path.dirname(os.path.abspath(exmachina.__file__)))
+
+
+def measure(statement: str) -> tuple[float, list[tuple[int, str]]]:
+    """statementのimport時間[sec]と、その間にimportされたモジュールの(累積時間[µs], 名前)を返す"""
+    code = f"import sys; sys.path.insert(0, {SOURCE!r}); {BASELINE}; sys.stderr.write({MARK!r} + '\\n'); {statement}"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True
+    )
+    lines = result.stderr.split(MARK + "\n", 1)[1].splitlines()
+    modules = []
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        # 他のモジュールから呼ばれていない(インデントのない)ものだけを足す
+        if not name[1:].startswith(" "):
+            modules.append((int(cumulative), name.strip()))
+    return sum(us for us, _ in modules) / 1e6, modules
+
+
+def main():
+    for statement in ["import exmachina", "from exmachina import Machina"]:
+        results = [measure(statement) for _ in range(N)]
+        median = statistics.median(seconds for seconds, _ in results)
+        print(f"{statement:32s}: {median * 1e3:6.2f}ms")
+        for us, name in sorted(results[-1][1], reverse=True)[:5]:
+            print(f"    {name:40s}: {us / 1e3:6.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""debugログを表示しない時のexecute開始ログのオーバーヘッドを計測する
+
+poetry run python benchmarks/logging_gate.py
+"""
+from __future__ import annotations
+
+import logging
+from time import perf_counter
+
+from exmachina.core.task import TaskRegistry
+
+N = 1_000_000
+
+logger = logging.getLogger("exmachina.benchmark")
+logger.setLevel(logging.WARNING)
+registry = TaskRegistry()
+name = "execute"
+
+
+def before():
+    start = perf_counter()
+    for _ in range(N):
+        _t = registry.count("execute", name)
+        _e = registry.executings(name)
+        logger.debug(f'Start execute task: "{name}" [tasks={_t}, executings={_e}]')
+    return perf_counter() - start
+
+
+def after():
+    start = perf_counter()
+    for _ in range(N):
+        if logger.isEnabledFor(logging.DEBUG):
+            _t = registry.count("execute", name)
+            _e = registry.executings(name)
+            logger.debug('Start execute task: "%s" [tasks=%d, executings=%d]', name, _t, _e)
+    return perf_counter() - start
+
+
+def main():
+    b = before()
+    a = after()
+    print(f"before: {b / N * 1e9:.0f} ns/call")
+    print(f"after : {a / N * 1e9:.0f} ns/call ({b / a:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
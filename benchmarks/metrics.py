@@ -0,0 +1,50 @@
+"""executeの一回の呼び出しで記録するメトリクスのオーバーヘッドを計測する
+
+poetry run python benchmarks/metrics.py
+"""
+from __future__ import annotations
+
+from time import perf_counter
+
+from exmachina.core.instruments import Instruments
+from exmachina.lib.metrics import MetricsRegistry
+
+N = 1_000_000
+
+instruments = Instruments(MetricsRegistry())
+execute = instruments.execute("execute")
+group = instruments.group("group")
+
+
+def baseline():
+    start = perf_counter()
+    for _ in range(N):
+        _s = perf_counter()
+        _e = perf_counter()
+    return perf_counter() - start
+
+
+def record():
+    start = perf_counter()
+    for _ in range(N):
+        # queue wait, group wait, in_flight, duration, status
+        _s = perf_counter()
+        execute.queue_wait.observe(0.0001)
+        group.wait.observe(0.0001)
+        group.in_flight.inc()
+        _e = perf_counter()
+        group.in_flight.dec()
+        execute.duration.observe(_e - _s)
+        execute.ok.inc()
+    return perf_counter() - start
+
+
+def main():
+    b = baseline()
+    r = record()
+    print(f"baseline: {b / N * 1e9:.0f} ns/call")
+    print(f"metrics : {r / N * 1e9:.0f} ns/call (+{(r - b) / N * 1e9:.0f} ns/call)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""複数のconcurrent_groupを共有するexecuteのスループットを、グループを順番に取得する方式と比較する
+
+- heavy: 全体制限のgroup Aと、時間制限のgroup Bに所属する
+- light: group Aのみに所属する
+
+順番に取得する方式ではheavyがAの枠を保持したままBの時間制限を待つため、lightが進めなくなる
+
+poetry run python benchmarks/multi_group.py
+"""
+from __future__ import annotations
+
+import asyncio
+from time import perf_counter
+
+from exmachina.lib.time_semaphore import GCRASemaphore, TimeSemaphore, acquire_all, release_all
+
+DURATION = 2.0
+HEAVY = 50
+LIGHT = 50
+
+
+async def nested(semaphores: list[TimeSemaphore]):
+    """一つずつ順番に取得する(従来の方式)"""
+    for sem in semaphores:
+        await sem.acquire()
+
+
+async def measure(acquire) -> tuple[int, int]:
+    group_a = TimeSemaphore(entire_calls_limit=4)
+    group_b = GCRASemaphore(time_limit=1, time_calls_limit=5, burst=1)
+    done = {"heavy": 0, "light": 0}
+    deadline = perf_counter() + DURATION
+
+    async def worker(kind: str, semaphores: list[TimeSemaphore]):
+        while perf_counter() < deadline:
+            await acquire(semaphores)
+            try:
+                await asyncio.sleep(0.01)
+                done[kind] += 1
+            finally:
+                release_all(semaphores)
+
+    workers = [worker("heavy", [group_a, group_b]) for _ in range(HEAVY)]
+    workers += [worker("light", [group_a]) for _ in range(LIGHT)]
+    tasks = [asyncio.create_task(w) for w in workers]
+    await asyncio.sleep(DURATION)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return done["heavy"], done["light"]
+
+
+async def main():
+    for name, acquire in [("nested", nested), ("acquire_all", acquire_all)]:
+        heavy, light = await measure(acquire)
+        print(f"{name:<12}: heavy={heavy / DURATION:6.1f}/s, light={light / DURATION:7.1f}/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+"""失敗しない呼び出しにおけるRetryのオーバーヘッドを計測する
+
+poetry run python benchmarks/retry.py
+"""
+from __future__ import annotations
+
+import asyncio
+from functools import wraps
+from time import perf_counter
+
+from exmachina import Retry, RetryExponentialAndJitter, RetryFixed
+
+N = 1_000_000
+
+rules = [
+    RetryFixed(KeyError, wait_time=1, retries=3),
+    RetryExponentialAndJitter(ConnectionError, base_wait_time=1),
+]
+
+
+def legacy_rule(rule):
+    """呼び出し毎にクロージャとGeneratorを作成する旧実装のRetryRule.__call__"""
+
+    def logger_wrap(func):
+        retry_count = rule.retries
+        wait_time = rule.generate_wait_time()
+
+        @wraps(func)
+        async def inner(*args, **kwargs):
+            nonlocal retry_count
+            try:
+                return await func(*args, **kwargs)
+            except rule.exception:
+                await asyncio.sleep(next(wait_time))
+                return await inner(*args, **kwargs)
+
+        return inner
+
+    return logger_wrap
+
+
+def composite(base, decorators):
+    if len(decorators) == 0:
+        return base
+
+    @decorators[0]
+    async def wrap(*args, **kwargs):
+        return await base(*args, **kwargs)
+
+    return composite(wrap, decorators[1:])
+
+
+def legacy_retry(func):
+    """呼び出し毎にデコレータを合成する旧実装のRetry.__call__"""
+
+    @wraps(func)
+    async def generate_composite(*args, **kwargs):
+        return await composite(func, [legacy_rule(rule) for rule in rules])(*args, **kwargs)
+
+    return generate_composite
+
+
+async def task(x: int):
+    return x
+
+
+async def before():
+    func = legacy_retry(task)
+    start = perf_counter()
+    for i in range(N):
+        await func(i)
+    return perf_counter() - start
+
+
+async def after():
+    retry = Retry(rules)
+    start = perf_counter()
+    for i in range(N):
+        await retry.call(task, i)
+    return perf_counter() - start
+
+
+async def main():
+    b = await before()
+    a = await after()
+    print(f"before: {b / N * 1e6:.2f} us/call")
+    print(f"after : {a / N * 1e6:.2f} us/call ({b / a:.1f}x)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+"""emitから大量のexecuteをファンアウトした時の完了までの時間を計測する
+
+タスクの登録と削除がO(1)であれば、1タスクあたりの時間はタスク数によらずほぼ一定になる
+
+poetry run python benchmarks/task_registry.py
+"""
+from __future__ import annotations
+
+import asyncio
+from time import perf_counter
+
+from exmachina import Event, Machina
+
+
+async def fan_out(n: int) -> float:
+    bot = Machina()
+
+    @bot.execute()
+    async def execute():
+        await asyncio.sleep(0)
+
+    elapsed = 0.0
+
+    @bot.emit(count=1)
+    async def emit(event: Event):
+        nonlocal elapsed
+        start = perf_counter()
+        await asyncio.gather(*[event.execute("execute") for _ in range(n)])
+        elapsed = perf_counter() - start
+
+    await bot.run()
+    return elapsed
+
+
+async def main():
+    for n in [12_500, 25_000, 50_000, 100_000]:
+        elapsed = await fan_out(n)
+        print(f"n={n:>7}: {elapsed:.3f} s ({elapsed / n * 1e6:.2f} us/task)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
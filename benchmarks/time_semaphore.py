@@ -0,0 +1,51 @@
+"""TimeSemaphoreのengine毎に、登録されるタイマーの数と1秒あたりの取得回数を計測する
+
+poetry run python benchmarks/time_semaphore.py
+"""
+from __future__ import annotations
+
+import asyncio
+from time import perf_counter
+
+from exmachina.lib.time_semaphore import create_time_semaphore
+
+N = 20_000
+TIME_LIMIT = 0.1
+TIME_CALLS_LIMIT = 1_000  # 10,000回/秒
+
+
+async def measure(engine: str) -> tuple[int, float]:
+    loop = asyncio.get_running_loop()
+    timers = 0
+    call_at = loop.call_at
+
+    # call_laterも内部でcall_atを呼ぶ
+    def counted_call_at(*args, **kwargs):
+        nonlocal timers
+        timers += 1
+        return call_at(*args, **kwargs)
+
+    loop.call_at = counted_call_at  # type: ignore
+    try:
+        sem = create_time_semaphore(engine, time_limit=TIME_LIMIT, time_calls_limit=TIME_CALLS_LIMIT)  # type: ignore
+
+        async def acquire():
+            async with sem:
+                ...
+
+        start = perf_counter()
+        await asyncio.gather(*[acquire() for _ in range(N)])
+        elapsed = perf_counter() - start
+    finally:
+        loop.call_at = call_at  # type: ignore
+    return timers, N / elapsed
+
+
+async def main():
+    for engine in ["window", "gcra"]:
+        timers, rate = await measure(engine)
+        print(f"engine={engine:<6}: timers={timers:>6}, acquisitions/sec={rate:,.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+"""10k個のemit相当の周期タスクで、emit毎のasyncio.sleepとタイマーホイールのCPU時間と発火時刻のずれを比較する
+
+poetry run python benchmarks/timer_wheel.py
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+from time import process_time
+
+from exmachina.lib.timer_wheel import TimerWheel
+
+N = 10_000
+DURATION = 5.0
+
+
+async def sleep_until(deadline: float):
+    loop = asyncio.get_running_loop()
+    await asyncio.sleep(max(0, deadline - loop.time()))
+
+
+async def periodic(interval: float, sleep, lateness: list[float], end: float):
+    """entireモードのemitと同様に、前回の予定時刻からinterval秒毎に起床する"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + interval
+    while deadline < end:
+        await sleep(deadline)
+        lateness.append(loop.time() - deadline)
+        deadline += interval
+
+
+async def measure(name: str, sleep):
+    random.seed(0)
+    loop = asyncio.get_running_loop()
+    lateness: list[float] = []
+    end = loop.time() + DURATION
+    start = process_time()
+    await asyncio.gather(*[periodic(random.uniform(0.1, 2.0), sleep, lateness, end) for _ in range(N)])
+    cpu = process_time() - start
+    lateness.sort()
+    p50 = lateness[len(lateness) // 2] * 1e3
+    p99 = lateness[int(len(lateness) * 0.99)] * 1e3
+    print(f"{name:7}: cpu {cpu:.2f}s, fires {len(lateness)}, jitter p50 {p50:.2f}ms p99 {p99:.2f}ms")
+
+
+async def main():
+    await measure("asyncio", sleep_until)
+    await measure("wheel", TimerWheel(resolution=0.01).sleep_until)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
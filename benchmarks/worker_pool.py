@@ -0,0 +1,46 @@
+"""concurrent_groupのworkersの有無で、大量のexecuteが完了するまでの時間を比較する
+
+poetry run python benchmarks/worker_pool.py
+"""
+from __future__ import annotations
+
+import asyncio
+from time import perf_counter
+
+from exmachina import Event, Machina
+
+N = 100_000
+
+
+async def measure(workers: int | None) -> float:
+    bot = Machina()
+    cg = bot.create_concurrent_group(name="group", entire_calls_limit=100, workers=workers)
+
+    @bot.execute(concurrent_groups=["group"])
+    async def execute(x: int):
+        return x
+
+    elapsed = 0.0
+
+    @bot.emit(count=1)
+    async def emit(event: Event):
+        nonlocal elapsed
+        start = perf_counter()
+        await asyncio.gather(*[event.execute("execute", i) for i in range(N)])
+        elapsed = perf_counter() - start
+
+    await bot.run()
+    if cg.pool is not None:
+        stats = cg.pool.stats()
+        print(f"  average_wait={stats.average_wait * 1e3:.1f} ms, average_run={stats.average_run * 1e6:.1f} us")
+    return elapsed
+
+
+async def main():
+    for workers in [None, 100]:
+        elapsed = await measure(workers)
+        print(f"workers={workers}: {elapsed:.3f} s ({elapsed / N * 1e6:.2f} us/call)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,12 +1,101 @@
 __version__ = "0.0.0"
 
 import logging
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
 logging.getLogger(__name__).propagate = False
 
-from .core.depends_contoroller import get_depends  # noqa
-from .core.machina import Event, Machina  # noqa
-from .core.params_function import Depends  # noqa
-from .lib.retry import Retry, RetryExponentialAndJitter, RetryFibonacci, RetryFixed, RetryRange, RetryRule  # noqa
-from .lib.time_semaphore import TimeSemaphore  # noqa
+# 公開する名前 -> 定義しているモジュール. 最初にアクセスされた時にimportする
+_LAZY_ATTRIBUTES = {
+    "get_depends": ".core.depends_contoroller",
+    "Event": ".core.machina",
+    "Machina": ".core.machina",
+    "Depends": ".core.params_function",
+    "AIMD": ".lib.adaptive",
+    "AdaptiveLimit": ".lib.adaptive",
+    "Gradient": ".lib.adaptive",
+    "CircuitBreaker": ".lib.circuit_breaker",
+    "CircuitOpenError": ".lib.circuit_breaker",
+    "RetryBudget": ".lib.circuit_breaker",
+    "HistogramSnapshot": ".lib.metrics",
+    "MetricsRegistry": ".lib.metrics",
+    "MemoryRateBackend": ".lib.rate_backend",
+    "RateLimitBackend": ".lib.rate_backend",
+    "SharedMemoryRateBackend": ".lib.rate_backend",
+    "Retry": ".lib.retry",
+    "RetryExponentialAndJitter": ".lib.retry",
+    "RetryFibonacci": ".lib.retry",
+    "RetryFixed": ".lib.retry",
+    "RetryRange": ".lib.retry",
+    "RetryRule": ".lib.retry",
+    "Middleware": ".lib.tracing",
+    "OpenTelemetryMiddleware": ".lib.tracing",
+    "SamplingProfiler": ".lib.tracing",
+    "Span": ".lib.tracing",
+    "get_current_span": ".lib.tracing",
+    "GCRASemaphore": ".lib.time_semaphore",
+    "SlidingWindowSemaphore": ".lib.time_semaphore",
+    "TimeSemaphore": ".lib.time_semaphore",
+}
+
+# 型チェッカーが読めるように__all__は列挙する
+__all__ = [
+    "__version__",
+    "get_depends",
+    "Event",
+    "Machina",
+    "Depends",
+    "AIMD",
+    "AdaptiveLimit",
+    "Gradient",
+    "CircuitBreaker",
+    "CircuitOpenError",
+    "RetryBudget",
+    "HistogramSnapshot",
+    "MetricsRegistry",
+    "MemoryRateBackend",
+    "RateLimitBackend",
+    "SharedMemoryRateBackend",
+    "Retry",
+    "RetryExponentialAndJitter",
+    "RetryFibonacci",
+    "RetryFixed",
+    "RetryRange",
+    "RetryRule",
+    "Middleware",
+    "OpenTelemetryMiddleware",
+    "SamplingProfiler",
+    "Span",
+    "get_current_span",
+    "GCRASemaphore",
+    "SlidingWindowSemaphore",
+    "TimeSemaphore",
+]
+
+
+def __getattr__(name: str) -> Any:
+    module = _LAZY_ATTRIBUTES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
+
+
+if TYPE_CHECKING:
+    from .core.depends_contoroller import get_depends  # noqa
+    from .core.machina import Event, Machina  # noqa
+    from .core.params_function import Depends  # noqa
+    from .lib.adaptive import AIMD, AdaptiveLimit, Gradient  # noqa
+    from .lib.circuit_breaker import CircuitBreaker, CircuitOpenError, RetryBudget  # noqa
+    from .lib.metrics import HistogramSnapshot, MetricsRegistry  # noqa
+    from .lib.rate_backend import MemoryRateBackend, RateLimitBackend, SharedMemoryRateBackend  # noqa
+    from .lib.retry import Retry, RetryExponentialAndJitter, RetryFibonacci, RetryFixed, RetryRange, RetryRule  # noqa
+    from .lib.time_semaphore import GCRASemaphore, SlidingWindowSemaphore, TimeSemaphore  # noqa
+    from .lib.tracing import Middleware, OpenTelemetryMiddleware, SamplingProfiler, Span, get_current_span  # noqa
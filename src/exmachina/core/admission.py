@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Any, Awaitable, Callable
+
+from . import exception as E
+
+try:
+    from typing import Literal  # type: ignore
+except ImportError:
+    from typing_extensions import Literal
+
+Overflow = Literal["wait", "error", "drop_oldest"]
+
+
+@dataclass
+class Job:
+    """タスク化される前のexecuteの呼び出し"""
+
+    args: tuple[Any, ...]
+    kwargs: dict[str, Any]
+    future: asyncio.Future  # 呼び出し元に返す結果のハンドル
+    name: str = ""  # 呼び出すexecuteの名前
+    enqueued_at: float = field(default_factory=lambda: asyncio.get_running_loop().time())
+
+
+class AdmissionQueue:
+    def __init__(
+        self,
+        start: Callable[[Job], asyncio.Future],
+        *,
+        max_tasks: int,
+        queue_size: int | None = None,
+        overflow: Overflow = "wait",
+    ):
+        """タスクの数を制限し、あふれた呼び出しをタスク化せずに待機させるキュー
+
+        Args:
+            start (Callable[[Job], asyncio.Future]): Jobをタスク化して実行を開始する関数
+            max_tasks (int): 同時に存在できるタスクの最大数
+            queue_size (int, optional): タスク化を待つJobの最大数. Defaults to None. つまり無制限
+            overflow (Literal['wait', 'error', 'drop_oldest'], optional): キューが一杯の時の挙動. Defaults to "wait".
+                wait: putは空きが出るまで待機する. put_nowaitは待機できないのでerrorと同じ
+                error: QueueFullErrorを送出する
+                drop_oldest: 最も古いJobをQueueFullErrorで終了させて追加する. 終了させるJobがなければerrorと同じ
+        """
+        if max_tasks < 1:
+            raise E.MachinaException("max_tasksは1以上を指定してください")
+        if queue_size is not None and queue_size < 0:
+            raise E.MachinaException("queue_sizeは0以上を指定してください")
+        self._start = start
+        self.max_tasks = max_tasks
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self._running = 0
+        self._pending: deque[Job] = deque()
+        self._putters: deque[asyncio.Future] = deque()
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def qsize(self) -> int:
+        return len(self._pending)
+
+    def full(self) -> bool:
+        if self._running < self.max_tasks:
+            return False
+        return self.queue_size is not None and len(self._pending) >= self.queue_size
+
+    async def put(self, job: Job) -> None:
+        """キューに空きができるまで待機してからJobを追加する"""
+        while self.full() and self.overflow == "wait":
+            putter = asyncio.get_running_loop().create_future()
+            self._putters.append(putter)
+            try:
+                await putter
+            except BaseException:
+                putter.cancel()
+                if not self.full():
+                    self._wake_up_next_putter()
+                raise
+        self.put_nowait(job)
+        if not self.full():
+            self._wake_up_next_putter()
+
+    def put_nowait(self, job: Job) -> None:
+        if self._running < self.max_tasks and not self._pending:
+            self._run(job)
+            return
+        if self.full() and self.overflow == "drop_oldest":
+            self._drop_oldest()
+        if self.full():
+            raise E.QueueFullError(f"キューが一杯です: [size={self.queue_size}]")
+        self._pending.append(job)
+
+    def _drop_oldest(self):
+        while self._pending:
+            job = self._pending.popleft()
+            if not job.future.done():
+                job.future.set_exception(E.QueueFullError("キューが一杯のため破棄されました"))
+                return
+
+    def _run(self, job: Job):
+        self._running += 1
+        task = self._start(job)
+        task.add_done_callback(self._on_done)
+
+    def _on_done(self, _: asyncio.Future | None):
+        self._running -= 1
+        while self._pending and self._running < self.max_tasks:
+            job = self._pending.popleft()
+            # 待機中にキャンセルされたJobは実行しない
+            if job.future.done():
+                continue
+            self._run(job)
+        if not self.full():
+            self._wake_up_next_putter()
+
+    def _wake_up_next_putter(self):
+        while self._putters:
+            putter = self._putters.popleft()
+            if not putter.done():
+                putter.set_result(None)
+                return
+
+
+@dataclass(frozen=True)
+class PoolStats:
+    workers: int  # ワーカー数
+    running: int  # 実行中のJob数
+    queued: int  # ワーカーの空きを待っているJob数
+    completed: int  # 完了したJob数
+    average_wait: float  # キューに入ってから実行されるまでの平均時間[sec]
+    average_run: float  # 平均実行時間[sec]
+
+
+class WorkerPool(AdmissionQueue):
+    def __init__(
+        self,
+        run: Callable[[Job], Awaitable[Any]],
+        *,
+        workers: int,
+        queue_size: int | None = None,
+        overflow: Overflow = "wait",
+    ):
+        """固定数のワーカーがキューからJobを取り出して実行するプール
+
+        Jobの実行毎にタスクを作成しないため、大量の呼び出しでもオーバーヘッドが小さい
+
+        Args:
+            run (Callable[[Job], Awaitable[Any]]): Jobを実行するコルーチン関数
+            workers (int): ワーカー数
+            queue_size (int, optional): ワーカーの空きを待つJobの最大数. Defaults to None. つまり無制限
+            overflow (Literal['wait', 'error', 'drop_oldest'], optional): キューが一杯の時の挙動. Defaults to "wait".
+        """
+        if workers < 1:
+            raise E.MachinaException("workersは1以上を指定してください")
+        super().__init__(lambda job: job.future, max_tasks=workers, queue_size=queue_size, overflow=overflow)
+        self._job_runner = run
+        self._ready: deque[Job] = deque()
+        self._idle: deque[asyncio.Future] = deque()
+        self._workers: list[asyncio.Task] = []
+        self._current: dict[asyncio.Task, Job] = {}
+        self._closing = False
+        self._completed = 0
+        self._total_wait = 0.0
+        self._total_run = 0.0
+
+    def stats(self) -> PoolStats:
+        return PoolStats(
+            workers=len(self._workers),
+            running=len(self._current),
+            queued=self.qsize() + len(self._ready),
+            completed=self._completed,
+            average_wait=self._total_wait / self._completed if self._completed else 0.0,
+            average_run=self._total_run / self._completed if self._completed else 0.0,
+        )
+
+    async def close(self) -> None:
+        """全てのワーカーを停止し、実行されていないJobをキャンセルする"""
+        self._closing = True
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        for job in [*self._ready, *self._pending]:
+            job.future.cancel()
+        self._ready.clear()
+        self._pending.clear()
+        self._idle.clear()
+        self._workers = []
+        self._running = 0
+        self._closing = False
+
+    def _run(self, job: Job):
+        self._running += 1
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_tasks)]
+        self._ready.append(job)
+        while self._idle:
+            idle = self._idle.popleft()
+            if not idle.done():
+                idle.set_result(None)
+                return
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        worker = asyncio.current_task()
+        assert worker is not None
+        while True:
+            if not self._ready:
+                idle = loop.create_future()
+                self._idle.append(idle)
+                await idle
+                continue
+            job = self._ready.popleft()
+            if not job.future.done():
+                await self._run_job(worker, job)
+            self._on_done(None)
+
+    async def _run_job(self, worker: asyncio.Task, job: Job):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        self._current[worker] = job
+        job.future.add_done_callback(partial(self._cancel_worker, worker, job))
+        try:
+            res = await self._job_runner(job)
+        except asyncio.CancelledError:
+            if self._closing:
+                job.future.cancel()
+                raise
+            if job.future.cancelled():
+                # 呼び出し元からキャンセルされた場合はワーカーを止めずに次のJobへ進む
+                if hasattr(worker, "uncancel"):
+                    worker.uncancel()  # type: ignore
+            elif not job.future.done():
+                # Jobの中で発生したキャンセルは呼び出し元に伝える
+                job.future.cancel()
+        except BaseException as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(res)
+        finally:
+            del self._current[worker]
+            self._completed += 1
+            self._total_wait += start - job.enqueued_at
+            self._total_run += loop.time() - start
+
+    def _cancel_worker(self, worker: asyncio.Task, job: Job, future: asyncio.Future):
+        if future.cancelled() and self._current.get(worker) is job:
+            worker.cancel()
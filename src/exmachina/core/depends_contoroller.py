@@ -1,62 +1,396 @@
 from __future__ import annotations
 
+import asyncio
 import inspect
-from typing import Any, AsyncGenerator, Callable, Generator
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, AsyncContextManager, Awaitable, Callable, ContextManager, Hashable, Optional, Tuple, Union, cast
+
+from exmachina.lib.cache import MISSING, Finalizer, TTLCache
+from exmachina.lib.tracing import Tracer
 
 from . import exception as E
-from .params import Depends
+from .params import Depends, DependsScope
 
+try:
+    from typing import Literal  # type: ignore
+except ImportError:
+    from typing_extensions import Literal
 
-class DependsContoroller:
-    generators: list[AsyncGenerator | Generator] = []
-    caches: dict[Callable, Any] = {}
+DependsKind = Literal["async", "async_generator", "generator", "sync"]
+_MemoKey = Tuple[Callable, bool, DependsScope, Optional[float]]
+_Context = Union[AsyncContextManager, ContextManager]
+
+
+@dataclass(frozen=True)
+class DependsPlan:
+    """Dependsの実行計画
+
+    依存関係の木を登録時に一度だけ解析した結果で、同じDependsを参照するノードは同じオブジェクトを共有する
+    """
+
+    dependency: Callable[..., Any]
+    kind: DependsKind
+    awaits: bool  # 自身か依存先にasyncの関数を含むかどうか. 含まない場合は並行して実行しない
+    use_cache: bool
+    scope: DependsScope  # キャッシュを共有する範囲
+    ttl: float | None  # キャッシュの有効期間[sec]
+    cache_key: Hashable  # scopeがappの場合のキャッシュのキー. 他のscopeでは解決時に作成する. ttlが違えば別のキー
+    context: Callable[..., _Context] | None  # generatorの場合はyieldの前後をwithの出入りとして扱う関数
+    defaults: tuple[tuple[str, Any], ...]  # Depends以外のデフォルト引数
+    depends: tuple[tuple[str, DependsPlan], ...]  # 引数名とその依存先
+
+
+@dataclass(frozen=True)
+class CallPlan:
+    """emitやexecuteに登録された関数の呼び出し計画"""
+
+    func: Callable[..., Any]
+    args: tuple[str, ...]  # デフォルト値のない引数
+    defaults: tuple[tuple[str, Any], ...]  # Depends以外のデフォルト引数
+    depends: tuple[tuple[str, DependsPlan], ...]  # 引数名とその依存先
+    scopes: frozenset[DependsScope] = frozenset()  # 依存関係の木でキャッシュに使われるscope
+    teardown: bool = False  # 呼び出しの後に後処理が必要なgeneratorを含むかどうか
+
+    @property
+    def use_event(self) -> bool:
+        return "event" in self.args
+
+
+def _get_kind(func: Callable[..., Any]) -> DependsKind:
+    if inspect.iscoroutinefunction(func):
+        return "async"
+    elif inspect.isasyncgenfunction(func):
+        return "async_generator"
+    elif inspect.isgeneratorfunction(func):
+        return "generator"
+    elif inspect.isfunction(func) or inspect.ismethod(func):
+        return "sync"
+    raise E.MachinaException(f"funcが想定外のパターンです: {func}")
+
+
+class _Resolution:
+    """一回のDependsの解決で共有する状態"""
+
+    __slots__ = ("tracer", "cache", "owner", "stack", "local")
+
+    def __init__(self, tracer: Tracer | None, cache: TTLCache, owner: Hashable, stack: AsyncExitStack | None):
+        self.tracer = tracer
+        self.cache = cache
+        self.owner = owner  # emit/executeのscopeのキャッシュのキーに使う呼び出し元
+        self.stack = stack  # 呼び出しの後に後処理するgeneratorの登録先
+        self.local: dict[Callable, asyncio.Future] | None = None  # iterationのscopeのキャッシュ
+
+    def with_stack(self, stack: AsyncExitStack) -> _Resolution:
+        """後処理の登録先だけを変えた解決の状態. iterationのscopeのキャッシュは共有する"""
+        if self.local is None:
+            self.local = {}
+        resolution = _Resolution(self.tracer, self.cache, self.owner, stack)
+        resolution.local = self.local
+        return resolution
+
+
+def _is_cached(plan: DependsPlan) -> bool:
+    """解決の度ではなく、キャッシュから削除された時に後処理するかどうか"""
+    return plan.use_cache and plan.scope != "iteration"
 
+
+def _owns_teardown(plan: DependsPlan) -> bool:
+    """キャッシュするgeneratorで、依存先のキャッシュしないgeneratorの後処理を自身の後処理の後に行うかどうか"""
+    return plan.context is not None and _is_cached(plan) and bool(plan.depends)
+
+
+def _finalizer(close: Callable[[], Awaitable[Any]], owned: AsyncExitStack | None) -> Finalizer:
+    """キャッシュしたgeneratorの後処理. 自身の後処理の後に、依存先のキャッシュしないgeneratorを後処理する"""
+
+    async def finalize() -> None:
+        try:
+            await close()
+        finally:
+            if owned is not None:
+                await owned.aclose()
+
+    return finalize
+
+
+class DependsContoroller:
     @classmethod
-    async def get_depends_result(cls, func: Callable):
+    def compile(cls, func: Callable[..., Any]) -> CallPlan:
+        """関数のシグネチャを解析して呼び出し計画を作成する
+
+        Args:
+            func (Callable[..., Any]): emitやexecuteに登録する関数
+
+        Returns:
+            CallPlan: 呼び出し計画
+        """
         signature = inspect.signature(func)
+        memo: dict[_MemoKey, DependsPlan] = {}
 
-        kwargs = {}
+        args, defaults, depends = [], [], []
         for key, arg in signature.parameters.items():
-            if not isinstance(arg.default, Depends):
-                continue
-            kwargs[key] = await cls.recurrent_execute_depends(arg.default)
-        return kwargs
+            if arg.default is inspect.Parameter.empty:
+                args.append(key)
+            elif isinstance(arg.default, Depends):
+                depends.append((key, cls._compile_depends(arg.default, memo)))
+            else:
+                defaults.append((key, arg.default))
+        return CallPlan(
+            func=func,
+            args=tuple(args),
+            defaults=tuple(defaults),
+            depends=tuple(depends),
+            scopes=frozenset(plan.scope for plan in memo.values() if plan.use_cache),
+            teardown=any(plan.context is not None and not _is_cached(plan) for plan in memo.values()),
+        )
 
     @classmethod
-    async def recurrent_execute_depends(cls, depends: Depends):
+    def _compile_depends(
+        cls, depends: Depends, memo: dict[_MemoKey, DependsPlan], path: tuple[Callable, ...] = ()
+    ) -> DependsPlan:
         func = depends.dependency
-        signature = inspect.signature(func)
+        memo_key = (func, depends.use_cache, depends.scope, depends.ttl)
+        if memo_key in memo:
+            return memo[memo_key]
+        # 解析中の祖先に同じ関数があれば循環している
+        if func in path:
+            names = " -> ".join(getattr(f, "__name__", repr(f)) for f in path[path.index(func) :] + (func,))
+            raise E.MachinaException(f"Dependsが循環しています: {names}")
+        path += (func,)
 
-        if depends.use_cache and func in cls.caches:
-            return cls.caches[func]
+        signature = inspect.signature(func)
 
-        kwargs = {}
+        defaults, sub_depends = [], []
         for key, arg in signature.parameters.items():
             if arg.default is inspect.Parameter.empty:
                 raise E.MachinaException("Dependsにdefault値のない引数を宣言しないでください。")
             if not isinstance(arg.default, Depends):
-                kwargs[key] = arg.default
+                defaults.append((key, arg.default))
                 continue
-            kwargs[key] = await cls.recurrent_execute_depends(arg.default)
-
-        if inspect.iscoroutinefunction(func):
-            res = await func(**kwargs)
-        elif inspect.isasyncgenfunction(func):
-            gen = func(**kwargs)
-            cls.generators.append(gen)
-            res = await gen.__anext__()
-        elif inspect.isgeneratorfunction(func):
-            gen = func(**kwargs)
-            cls.generators.append(gen)
-            res = gen.__next__()
-        elif inspect.isfunction(func) or inspect.ismethod(func):
-            res = func(**kwargs)
+            sub_depends.append((key, cls._compile_depends(arg.default, memo, path)))
+
+        kind = _get_kind(func)
+        context = None
+        if kind == "async_generator":
+            context = asynccontextmanager(func)
+        elif kind == "generator":
+            context = contextmanager(func)
+        plan = DependsPlan(
+            dependency=func,
+            kind=kind,
+            awaits=kind in ("async", "async_generator") or any(sub.awaits for _, sub in sub_depends),
+            use_cache=depends.use_cache,
+            scope=depends.scope,
+            ttl=depends.ttl,
+            cache_key=("app", None, func, depends.ttl) if depends.scope == "app" else None,
+            context=context,
+            defaults=tuple(defaults),
+            depends=tuple(sub_depends),
+        )
+        memo[memo_key] = plan
+        return plan
+
+    @classmethod
+    async def get_depends_result(cls, func: Callable):
+        return await cls.execute_plan(cls.compile(func))
+
+    @classmethod
+    async def execute_plan(
+        cls,
+        plan: CallPlan,
+        tracer: Tracer | None = None,
+        cache: TTLCache | None = None,
+        owner: Hashable = None,
+        stack: AsyncExitStack | None = None,
+    ) -> dict[str, Any]:
+        """呼び出し計画に従ってDependsを解決する
+
+        generatorのDependsはyieldまで実行し、yield以降の後処理は
+        キャッシュするものはキャッシュから削除された時に、それ以外はstackを閉じた時に実行する
+        例外で閉じた場合はyieldの位置で例外を送出する
+
+        Args:
+            plan (CallPlan): 呼び出し計画
+            tracer (Tracer, optional): 指定した場合はDepends毎の実行をSpanとして記録する. Defaults to None.
+            cache (TTLCache, optional): 結果のキャッシュ. Defaults to None.
+                Noneの場合はこの呼び出しの間だけキャッシュし、stackを閉じた時に後処理する
+            owner (Hashable, optional): emit/executeのscopeのキャッシュを区別する呼び出し元. Defaults to None.
+            stack (AsyncExitStack, optional): キャッシュしないgeneratorの後処理の登録先. Defaults to None.
+                Noneの場合は戻る前に後処理する
+
+        Returns:
+            dict[str, Any]: 引数名とDependsの実行結果
+        """
+        if tracer is not None and not tracer.middlewares:
+            tracer = None
+        if stack is None and (cache is None or plan.teardown):
+            # 後処理の登録先がなければ戻る前に後処理する
+            async with AsyncExitStack() as stack:
+                return await cls.execute_plan(plan, tracer, cache, owner, stack)
+        if cache is None:
+            # Machinaの外ではプロセス全体のキャッシュを持たず、この呼び出しの間だけキャッシュする
+            cache = TTLCache(maxsize=None)
+            stack.push_async_callback(cache.aclose)  # type: ignore
+        return await cls._resolve_all(plan.depends, _Resolution(tracer, cache, owner, stack))
+
+    @classmethod
+    async def _resolve_all(
+        cls, depends: tuple[tuple[str, DependsPlan], ...], resolution: _Resolution
+    ) -> dict[str, Any]:
+        """Dependsをまとめて解決する. 互いに独立したasyncのDependsは並行して実行する
+
+        asyncの関数を含まないDependsは並行して実行しても速くならないので、タスクを作らずにその場で実行する
+        """
+        kwargs = {}
+        pending = []
+        for key, plan in depends:
+            # appのscopeでキャッシュ済みの場合はコルーチンを作らずに取得する
+            res = MISSING if plan.cache_key is None else resolution.cache.get(plan.cache_key)
+            if res is not MISSING:
+                kwargs[key] = res
+            elif plan.awaits:
+                pending.append((key, plan))
+            else:
+                kwargs[key] = await cls._execute_depends(plan, resolution)
+        if len(pending) == 1:
+            key, plan = pending[0]
+            kwargs[key] = await cls._execute_depends(plan, resolution)
+        elif pending:
+            tasks = [asyncio.create_task(cls._execute_depends(plan, resolution)) for _, plan in pending]
+            try:
+                results = await asyncio.gather(*tasks)
+            except BaseException:
+                # 一つでも失敗したら残りは止め、後処理の登録が終わるまで待つ
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            kwargs.update(zip([key for key, _ in pending], results))
+        return kwargs
+
+    @classmethod
+    async def recurrent_execute_depends(cls, depends: Depends, stack: AsyncExitStack | None = None):
+        """Machinaの外で一つのDependsを解決する
+
+        キャッシュはこの呼び出しの間だけ使い、generatorの後処理はstackを閉じた時に実行する
+        stackがNoneの場合は戻る前に後処理する
+        """
+        if stack is None:
+            async with AsyncExitStack() as stack:
+                return await cls.recurrent_execute_depends(depends, stack)
+        plan = cls._compile_depends(depends, {})
+        cache = TTLCache(maxsize=None)
+        stack.push_async_callback(cache.aclose)
+        return await cls._execute_depends(plan, _Resolution(None, cache, None, stack))
+
+    @classmethod
+    async def _execute_depends(cls, plan: DependsPlan, resolution: _Resolution):
+        if not plan.use_cache:
+            return await cls._call_depends(plan, resolution)
+
+        if plan.scope == "iteration":
+            return await cls._execute_local(plan, resolution)
+        key = cls._cache_key(plan, resolution)
+        res = resolution.cache.get(key)
+        if res is not MISSING:
+            return res
+        # 同時に同じキーを解決しようとした場合は一度だけ実行する
+        return await resolution.cache.get_or_create(key, partial(cls._call_depends, plan, resolution), plan.ttl)
+
+    @staticmethod
+    def _cache_key(plan: DependsPlan, resolution: _Resolution) -> Hashable:
+        if plan.cache_key is not None:
+            return plan.cache_key
+        return (plan.scope, resolution.owner, plan.dependency, plan.ttl)
+
+    @classmethod
+    async def _execute_local(cls, plan: DependsPlan, resolution: _Resolution):
+        """iterationのscopeのDependsを解決する. 並行して同じDependsを解決しようとした場合は結果を待つ"""
+        if resolution.local is None:
+            resolution.local = {}
+        future = resolution.local.get(plan.dependency)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = resolution.local[plan.dependency] = asyncio.get_running_loop().create_future()
+        try:
+            res = await cls._call_depends(plan, resolution)
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # 待っている呼び出しがなくても警告を出さないようにする
+                future.exception()
+            raise
+        future.set_result(res)
+        return res
+
+    @classmethod
+    async def _call_depends(cls, plan: DependsPlan, resolution: _Resolution):
+        if resolution.tracer is None:
+            return await cls._run_depends(plan, resolution)
+        with resolution.tracer.span("depends", plan.dependency.__qualname__):
+            return await cls._run_depends(plan, resolution)
+
+    @classmethod
+    async def _run_depends(cls, plan: DependsPlan, resolution: _Resolution):
+        if not _owns_teardown(plan):
+            return await cls._enter_depends(plan, resolution, resolution, None)
+
+        # キャッシュしたgeneratorが使い続けるので、依存先のキャッシュしないgeneratorは解決の後ではなく、
+        # このgeneratorの後処理の後に後処理する
+        owned = AsyncExitStack()
+        try:
+            return await cls._enter_depends(plan, resolution, resolution.with_stack(owned), owned)
+        except BaseException as e:
+            await owned.__aexit__(type(e), e, e.__traceback__)
+            raise
+
+    @classmethod
+    async def _enter_depends(
+        cls, plan: DependsPlan, resolution: _Resolution, sub_resolution: _Resolution, owned: AsyncExitStack | None
+    ):
+        func = plan.dependency
+        kwargs = dict(plan.defaults)
+        if plan.depends:
+            kwargs.update(await cls._resolve_all(plan.depends, sub_resolution))
+
+        if plan.kind == "async":
+            return await func(**kwargs)
+        if plan.kind == "sync":
+            return func(**kwargs)
+
+        if plan.kind == "async_generator":
+            async_context = cast(AsyncContextManager, plan.context(**kwargs))  # type: ignore
+            res = await async_context.__aenter__()
+            close = partial(async_context.__aexit__, None, None, None)
+            if not _is_cached(plan):
+                resolution.stack.push_async_exit(async_context)  # type: ignore
         else:
-            raise E.MachinaException("funcが想定外のパターンです: {func}")
-        if depends.use_cache:
-            cls.caches[func] = res
+            sync_context = cast(ContextManager, plan.context(**kwargs))  # type: ignore
+            res = sync_context.__enter__()
+            close = partial(_aexit_sync, sync_context)
+            if not _is_cached(plan):
+                resolution.stack.push(sync_context)  # type: ignore
+        if _is_cached(plan):
+            resolution.cache.set_finalizer(cls._cache_key(plan, resolution), _finalizer(close, owned))
         return res
 
 
-async def get_depends(func: Callable[..., Any]) -> Any:
-    return await DependsContoroller.recurrent_execute_depends(Depends(func))
+async def _aexit_sync(context: ContextManager) -> None:
+    context.__exit__(None, None, None)
+
+
+async def get_depends(func: Callable[..., Any], *, stack: AsyncExitStack | None = None) -> Any:
+    """botの外でfuncをDependsとして解決した結果を返す
+
+    generatorの後処理はstackを閉じた時に実行する. 結果を使い終わるまでgeneratorを閉じたくない場合はstackを渡す
+    stackを渡さない場合は、後処理を実行する先がないので戻る前に後処理する(閉じないと後処理されずに残り続ける)
+    つまり、generatorのfunc自体もyieldした値を返した後に後処理される
+
+    Args:
+        func (Callable[..., Any]): 解決する関数
+        stack (AsyncExitStack, optional): generatorの後処理の登録先. Defaults to None.
+    """
+    return await DependsContoroller.recurrent_execute_depends(Depends(func), stack)
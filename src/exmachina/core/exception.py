@@ -1,2 +1,6 @@
 class MachinaException(Exception):
     ...
+
+
+class QueueFullError(MachinaException):
+    ...
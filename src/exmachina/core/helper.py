@@ -1,31 +1,66 @@
 from __future__ import annotations
 
+import atexit
 import logging
+import queue
+from typing import TYPE_CHECKING
 
 try:
     from typing import Literal  # type: ignore
 except ImportError:
     from typing_extensions import Literal
 
+if TYPE_CHECKING:
+    from logging.handlers import QueueListener
+
 
 def set_verbose(
     logger: logging.Logger | None = None,
     verbose: Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] | None = None,
-):
+    use_queue: bool = False,
+) -> QueueListener | None:
     """exmachinaのログを表示する
 
     Args:
         verbose (Literal[): 10, 20, 30, 40, 50に相当
+        use_queue (bool, optional): Trueの場合、loggerにはQueueHandlerを登録し、
+            RichHandlerによる描画はバックグラウンドのスレッドで行う. Defaults to False.
+
+    Returns:
+        QueueListener | None: use_queue=Trueで新たに登録した場合はバックグラウンドのスレッドのリスナー
+            プロセスの終了時に自動で停止する
     """
+    if verbose is None:
+        return None
     try:
         from rich.logging import RichHandler
     except ModuleNotFoundError:
         raise ImportError("pip install exmachina[rich]")
 
-    if verbose is not None:
-        handler = RichHandler(rich_tracebacks=True, enable_link_path=False, level=verbose)
-        if logger is None:
-            logger = logging.getLogger("exmachina")
-        logger.setLevel(verbose)
-        if "RichHandler" not in [h.__class__.__name__ for h in logger.handlers]:
-            logger.addHandler(handler)
+    handler = RichHandler(rich_tracebacks=True, enable_link_path=False, level=verbose)
+    if logger is None:
+        logger = logging.getLogger("exmachina")
+    logger.setLevel(verbose)
+    handler_names = [h.__class__.__name__ for h in logger.handlers]
+    if any(name in ("RichHandler", "QueueHandler", "RecordQueueHandler") for name in handler_names):
+        return None
+    if not use_queue:
+        logger.addHandler(handler)
+        return None
+
+    from logging.handlers import QueueListener
+
+    from exmachina.lib.log_queue import RecordQueueHandler
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(_stop_listener, listener)
+    logger.addHandler(RecordQueueHandler(log_queue))
+    return listener
+
+
+def _stop_listener(listener: QueueListener) -> None:
+    """停止していなければ残りのログを処理してからリスナーを停止する"""
+    if getattr(listener, "_thread", None) is not None:
+        listener.stop()
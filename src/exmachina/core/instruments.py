@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+from exmachina.lib.metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+
+class ExecuteInstruments:
+    """一つのexecuteが記録するメトリクス"""
+
+    __slots__ = ("queue_wait", "duration", "ok", "error", "queued", "coalesced", "cache")
+
+    def __init__(
+        self,
+        queue_wait: Histogram,
+        duration: Histogram,
+        ok: Counter,
+        error: Counter,
+        queued: Gauge,
+        coalesced: Counter,
+        cache: dict[str, Counter],
+    ):
+        self.queue_wait = queue_wait  # キューに入ってから取り出されるまでの時間
+        self.duration = duration  # 関数の実行時間
+        self.ok = ok
+        self.error = error
+        self.queued = queued  # キューで待機中の呼び出しの数
+        self.coalesced = coalesced  # 実行中の同じ呼び出しにまとめた数
+        self.cache = cache  # 結果のキャッシュの hit/stale/miss -> 回数
+
+
+class GroupInstruments:
+    """一つのconcurrent_groupが記録するメトリクス"""
+
+    __slots__ = ("wait", "in_flight")
+
+    def __init__(self, wait: Histogram, in_flight: Gauge):
+        self.wait = wait  # 枠の取得にかかった時間
+        self.in_flight = in_flight  # 枠を取得して実行中の数
+
+
+class Instruments:
+    def __init__(self, registry: MetricsRegistry):
+        """Machinaが記録するメトリクスの定義
+
+        ラベル毎のメトリクスは登録時に一度だけ作成し、記録時は検索せずに直接更新する
+        """
+        self.registry = registry
+        self._emit_duration = registry.histogram("exmachina_emit_duration_seconds", "emitの一回の実行時間", labels=("emit",))
+        self._execute_queue_wait = registry.histogram(
+            "exmachina_execute_queue_wait_seconds", "executeの呼び出しがキューで待機した時間", labels=("execute",)
+        )
+        self._execute_duration = registry.histogram(
+            "exmachina_execute_duration_seconds", "executeの関数の実行時間", labels=("execute",)
+        )
+        self._execute_total = registry.counter(
+            "exmachina_execute_total", "executeの実行回数(リトライを含む)", labels=("execute", "status")
+        )
+        self._execute_queued = registry.gauge("exmachina_execute_queued", "executeのキューで待機中の呼び出しの数", labels=("execute",))
+        self._execute_coalesced = registry.counter(
+            "exmachina_execute_coalesced_total", "executeの実行中の同じ呼び出しにまとめた呼び出しの数", labels=("execute",)
+        )
+        self._execute_cache = registry.counter(
+            "exmachina_execute_cache_total", "executeの結果のキャッシュの参照回数", labels=("execute", "result")
+        )
+        self._group_wait = registry.histogram(
+            "exmachina_group_wait_seconds", "concurrent_groupの枠の取得にかかった時間", labels=("group",)
+        )
+        self._group_in_flight = registry.gauge(
+            "exmachina_group_in_flight", "concurrent_groupの枠を取得して実行中の数", labels=("group",)
+        )
+
+    def emit(self, name: str) -> Histogram:
+        return self._emit_duration.labels(name)
+
+    def execute(self, name: str) -> ExecuteInstruments:
+        return ExecuteInstruments(
+            queue_wait=self._execute_queue_wait.labels(name),
+            duration=self._execute_duration.labels(name),
+            ok=self._execute_total.labels(name, "ok"),
+            error=self._execute_total.labels(name, "error"),
+            queued=self._execute_queued.labels(name),
+            coalesced=self._execute_coalesced.labels(name),
+            cache={r: self._execute_cache.labels(name, r) for r in ("hit", "stale", "miss")},
+        )
+
+    def group(self, name: str) -> GroupInstruments:
+        return GroupInstruments(
+            wait=self._group_wait.labels(name),
+            in_flight=self._group_in_flight.labels(name),
+        )
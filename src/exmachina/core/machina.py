@@ -1,30 +1,52 @@
 from __future__ import annotations
 
 import asyncio
+import copy
 import functools
 import inspect
 import logging
-from collections import defaultdict
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import AsyncExitStack
 from dataclasses import InitVar, dataclass, field
+from datetime import datetime
 from functools import partial
-from time import perf_counter
-from typing import Any, Awaitable, Callable, Coroutine, NoReturn, TypeVar
-
-from exmachina.lib.helper import execute_functions, interval_to_second
-from exmachina.lib.retry import Retry
-from exmachina.lib.time_semaphore import TimeSemaphore
+from time import monotonic, perf_counter
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Coroutine, Hashable, NoReturn, TypeVar
+
+from exmachina.lib.adaptive import AdaptiveLimit
+from exmachina.lib.cache import MISSING, TTLCache
+from exmachina.lib.circuit_breaker import CircuitBreaker, CircuitOpenError
+from exmachina.lib.cron import Cron
+from exmachina.lib.helper import call_by_name, execute_functions, interval_to_second, run_in_executor, to_thread
+from exmachina.lib.metrics import Histogram, MetricsRegistry
+from exmachina.lib.rate_backend import BackendType, RateLimitBackend, create_rate_backend
+from exmachina.lib.retry import Retry, RetryState
+from exmachina.lib.time_semaphore import Engine, TimeSemaphore, acquire_all, create_time_semaphore, release_all
+from exmachina.lib.timer_wheel import TimerWheel
+from exmachina.lib.tracing import Middleware, Span, Tracer
 
 from . import exception as E
-from .depends_contoroller import DependsContoroller
+from .admission import AdmissionQueue, Job, Overflow, WorkerPool
+from .depends_contoroller import CallPlan, DependsContoroller
 from .helper import set_verbose
+from .instruments import ExecuteInstruments, GroupInstruments, Instruments
+from .task import MachinaStats, TaskRegistry
+
+if TYPE_CHECKING:
+    from .sharding import Shard
 
 try:
     from typing import Literal  # type: ignore
 except ImportError:
     from typing_extensions import Literal
 
+ExecutorType = Literal["thread", "process"]
+SchedulerType = Literal["asyncio", "wheel"]
+MissedTickPolicy = Literal["skip", "catch_up", "coalesce"]
 DecoratedCallable = TypeVar("DecoratedCallable", bound=Callable[..., Awaitable[None]])
-DecoratedResultCallable = TypeVar("DecoratedResultCallable", bound=Callable[..., Awaitable[Any]])
+# executorを指定した場合は同期関数も登録できる
+DecoratedResultCallable = TypeVar("DecoratedResultCallable", bound=Callable[..., Any])
+MiddlewareType = TypeVar("MiddlewareType", bound=Middleware)
 
 
 @dataclass
@@ -35,6 +57,15 @@ class Emit:
     mode: Literal["after", "entire"]
     alive: bool  # 動作中か非動作中か
     count: int | None = None  # ループの回数、未指定の場合無限回 (immutable)
+    cron: Cron | None = None  # 指定した場合はintervalの代わりにcron形式のスケジュールで実行する
+    missed: MissedTickPolicy = "coalesce"  # entireモードで実行予定時刻に遅れた時の挙動
+    max_in_flight: int = 1  # 前回の実行の終了を待たずに並行して実行できる数
+    instruments: Histogram | None = field(default=None, repr=False)  # 実行時間のメトリクス
+    plan: CallPlan = field(init=False, repr=False)  # 登録時に作成する呼び出し計画
+    stalled: bool = field(default=False, repr=False)  # 実行予定時刻に遅れている間はTrue. 遅延の警告は一度だけ出す
+
+    def __post_init__(self):
+        self.plan = DependsContoroller.compile(self.func)
 
 
 @dataclass
@@ -43,12 +74,42 @@ class Execute:
     func: Callable[..., Awaitable[Any]]
     concurrent_groups: list[ConcurrentGroup] = field(default_factory=list)
     retry: Retry | None = None
+    queue: AdmissionQueue | None = None  # 指定した場合はキューに入った呼び出しのみタスク化する
+    executor: ExecutorType | None = None  # 指定した場合は同期関数をスレッド/プロセスで実行する
+    max_workers: int | None = None  # executorの最大ワーカー数
+    coalescer: _Coalescer | None = None  # 指定した場合は実行中の同じ呼び出しを一つにまとめる
+    result_cache: _ResultCache | None = None  # 指定した場合は結果をキャッシュする
+    instruments: ExecuteInstruments | None = field(default=None, repr=False)  # 記録するメトリクス
+    plan: CallPlan = field(init=False, repr=False)  # 登録時に作成する呼び出し計画
+    semaphores: list[TimeSemaphore] = field(init=False, repr=False)  # concurrent_groupsのセマフォ
+    breakers: list[CircuitBreaker] = field(init=False, repr=False)  # concurrent_groupsのサーキットブレーカー
+
+    def __post_init__(self):
+        self.plan = DependsContoroller.compile(self.func)
+        self.semaphores = [cg.semaphore for cg in self.concurrent_groups]
+        self.breakers = [cg.breaker for cg in self.concurrent_groups if cg.breaker is not None]
+
+    @property
+    def requeue(self) -> bool:
+        """リトライの待機中にタスクを持たず、loop.call_laterで再投入するかどうか"""
+        return self.retry is not None and self.retry.requeue
 
 
 @dataclass
 class ConcurrentGroup:
     name: str
     semaphore: TimeSemaphore
+    pool: WorkerPool | None = None  # 指定した場合は所属するexecuteをワーカーで実行する
+    adaptive: AdaptiveLimit | None = None  # 指定した場合は実行結果から並列実行数を調整する
+    breaker: CircuitBreaker | None = None  # 指定した場合は連続した失敗で所属するexecuteを一時的に止める
+    instruments: GroupInstruments | None = field(default=None, repr=False)  # 記録するメトリクス
+
+    def observe(self, latency: float, error: bool):
+        """所属するexecuteの実行結果を記録する"""
+        if self.adaptive is not None:
+            limit = self.adaptive.update(latency, error)
+            if limit != self.semaphore.entire_calls_limit:
+                self.semaphore.resize(limit)
 
 
 @dataclass
@@ -62,27 +123,34 @@ class Event:
         self._bot = bot
 
     def stop(self, emit_name: str, force: bool = False):
-        if force:
-            task = self._bot._emit_tasks[emit_name]
-            task.cancel()
-        else:
-            self._bot._emits[emit_name].alive = False
-
-    def start(self, emit_name: str) -> asyncio.Task:
+        """emitを停止する. run(workers=N)で別のshardが担当するemitの場合はそのshardで停止する"""
+        shard = self._bot._shard
+        if shard is not None and shard.forward("stop", emit_name, force):
+            return
+        self._bot._stop_emit(emit_name, force)
+
+    def start(self, emit_name: str) -> asyncio.Task | None:
+        """emitを起動する. run(workers=N)で別のshardが担当するemitの場合はそのshardで起動し、Noneを返す"""
+        shard = self._bot._shard
+        if shard is not None and shard.forward("start", emit_name):
+            return None
         self._bot._add_emit_task(emit_name)
         return self._bot._emit_tasks[emit_name]
 
     def get(self, emit_name: str) -> asyncio.Task | None:
+        """emitのタスクを取得する. run(workers=N)で別のshardが担当するemitの場合はNone"""
         return self._bot._emit_tasks.get(emit_name)
 
-    def execute(self, execute_name: str, *args, **kwargs) -> asyncio.Task:
+    def execute(self, execute_name: str, *args, **kwargs) -> asyncio.Future:
         task = self._bot._add_execute_task(execute_name, *args, **kwargs)
         return task
 
+    async def submit(self, execute_name: str, *args, **kwargs) -> asyncio.Future:
+        """executeのキューに空きができるまで待機してから呼び出す
 
-class TaskManager:
-    emit_tasks: list[asyncio.Task[None]]
-    execute_tasks: list[asyncio.Task]
+        キューを持たないexecuteの場合はexecuteと同じ
+        """
+        return await self._bot._submit_execute_task(execute_name, *args, **kwargs)
 
 
 class Machina:
@@ -93,22 +161,60 @@ class Machina:
         on_shutdown: list[Callable[[], Coroutine[Any, Any, None]] | Callable[[], None]] = [],
         logger: logging.Logger | None = None,
         verbose: Literal["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"] | None = None,
+        log_queue: bool = False,
+        scheduler: SchedulerType = "asyncio",
+        timer_resolution: float = 0.01,
+        metrics: bool = True,
+        metrics_port: int | None = None,
+        metrics_host: str = "127.0.0.1",
+        depends_cache_size: int | None = 1024,
     ) -> None:
+        """
+        Args:
+            on_startup (list, optional): 起動時に実行する関数. Defaults to [].
+            on_shutdown (list, optional): 終了時に実行する関数. Defaults to [].
+            logger (logging.Logger, optional): ロガー. Defaults to None.
+            verbose (Literal['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], optional): ログレベル. Defaults to None.
+            log_queue (bool, optional): verboseで表示するログの描画をバックグラウンドのスレッドで行う. Defaults to False.
+            scheduler (Literal['asyncio', 'wheel'], optional): emitの待機の方式. Defaults to "asyncio".
+                asyncio: emit毎にasyncio.sleepで待機する
+                wheel: 全てのemitの次回の実行時刻をタイマーホイールでまとめて管理する. emitが多い場合に軽い
+                    置き換えるのはemit毎のタイマーのみで、待機中のemitもそれぞれタスクとして存在する
+            timer_resolution (float, optional): scheduler="wheel"の時の時刻の分解能[sec]. Defaults to 0.01.
+            metrics (bool, optional): emit/execute/concurrent_group/retryのメトリクスをbot.metricsに記録する. Defaults to True.
+            metrics_port (int, optional): 指定した場合は実行中にGET /metricsでPrometheusのテキスト形式を返す. Defaults to None.
+            metrics_host (str, optional): metrics_portで待ち受けるホスト. Defaults to "127.0.0.1".
+            depends_cache_size (int, optional): Dependsの結果をキャッシュする最大の件数. Defaults to 1024.
+                超えると最も長く使われていないものから削除する. Noneの場合は無制限
+        """
         self._emits: dict[str, Emit] = {}
         self._executes: dict[str, Execute] = {}
         self._concurrent_groups: dict[str, ConcurrentGroup] = {}
         self._emit_tasks: dict[str, asyncio.Task] = {}
-        self._execute_tasks: dict[str, list[asyncio.Task]] = defaultdict(list)
-        self._execute_task_executings: dict[str, int] = defaultdict(int)
+        # 生存中の全てのタスク、全てのタスクが終わったことの確認にも使う
+        self._registry = TaskRegistry()
+        # executeの名前毎のスレッド/プロセスプール
+        self._executors: dict[str, Executor] = {}
+        self.scheduler = scheduler
+        self.timer_resolution = timer_resolution
+        self._timer_wheel: TimerWheel | None = None
+        self.metrics = MetricsRegistry()
+        self._instruments = Instruments(self.metrics) if metrics else None
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self._metrics_server: asyncio.Server | None = None
+        self.tracer = Tracer()
+        # Dependsの結果のキャッシュ. botの終了時に破棄し、generatorのDependsは後処理する
+        self.depends_cache = TTLCache(maxsize=depends_cache_size)
         self.on_startup = on_startup
         self.on_shutdown = on_shutdown
         self.logger = logger or logging.getLogger(__name__)
-        # 全てのタスクが終わったことを確認するようの変数
-        self._unfinished_tasks = 0
         self.__finished = None
+        # run(workers=N)で起動したプロセスの場合、そのshard
+        self._shard: Shard | None = None
 
         if verbose is not None:
-            set_verbose(logger, verbose)
+            set_verbose(logger, verbose, use_queue=log_queue)
 
     @property
     def _finished(self):
@@ -117,10 +223,32 @@ class Machina:
             self.__finished = asyncio.Event()
         return self.__finished
 
-    async def run(self):
+    async def run(self, workers: int | None = None):
         """botを起動する関数
         全てのemitが停止するまで永遠に待機する
+
+        workersを指定すると、botをworkers個のプロセスにforkして実行する(shard)
+        各emitは名前のコンシステントハッシュで決まる一つのshardで実行し、executeは呼び出したshardで実行する
+        concurrent_groupの制限はshard間で分け合うので、全体でも指定した制限を超えない
+            entire_calls_limit, adaptive: shard毎に均等に分ける. workers以上を指定する必要がある
+            time_limit: engine='gcra'のみ指定でき、状態をbackend='shm'で共有する
+        on_startup/on_shutdownとミドルウェアはshard毎に実行し、全てのshardの起動が終わってからemitを開始する
+        ログは親プロセスのloggerにまとめて出力し、LogRecordのshard属性にshardの番号を設定する
+        metrics_portはshard毎に metrics_port + shardの番号 で待ち受ける
+
+        Args:
+            workers (int, optional): shardのプロセス数. Defaults to None. つまり、このプロセスのみで実行する
+
+        Raises:
+            E.MachinaException: いずれかのshardで例外が発生した時や、concurrent_groupの制限を分け合えない時の例外
         """
+        if workers is not None:
+            # multiprocessingのimportは重いので、使う時にimportする
+            from .sharding import run_sharded
+
+            await run_sharded(self, workers)
+            return
+
         await self._startup()
 
         try:
@@ -128,7 +256,7 @@ class Machina:
                 if emit.alive:
                     self._add_emit_task(emit.name)
 
-            if self._unfinished_tasks > 0:
+            if len(self._registry) > 0:
                 self._finished.clear()
                 await self._finished.wait()
                 for task in self._emit_tasks.values():
@@ -138,13 +266,117 @@ class Machina:
 
     async def _startup(self):
         self.__finished = None
+        if self.scheduler == "wheel":
+            self._timer_wheel = TimerWheel(resolution=self.timer_resolution)
+        if self.metrics_port is not None:
+            self._metrics_server = await self.metrics.serve(self.metrics_host, self.metrics_port)
+        for execute in self._executes.values():
+            if execute.executor is not None:
+                self._get_executor(execute)
+        for middleware in self.tracer.middlewares:
+            middleware.startup()
         await execute_functions(self.on_startup)
 
     async def _shutdown(self):
+        self._timer_wheel = None
+        # appのscopeなどでキャッシュしたgeneratorのDependsの後処理
+        await self.depends_cache.aclose()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            await self._metrics_server.wait_closed()
+            self._metrics_server = None
+        for execute in self._executes.values():
+            if execute.result_cache is not None:
+                execute.result_cache.clear()
+        for cg in self._concurrent_groups.values():
+            if cg.pool is not None:
+                await cg.pool.close()
+        executors, self._executors = self._executors, {}
+        for executor in executors.values():
+            await to_thread(executor.shutdown, wait=True)
+        for middleware in reversed(self.tracer.middlewares):
+            middleware.shutdown()
         await execute_functions(self.on_shutdown)
 
+    async def _sleep_until(self, deadline: float):
+        """loop.time()基準の時刻deadlineまで待機する"""
+        loop = asyncio.get_running_loop()
+        delay = deadline - loop.time()
+        if self._timer_wheel is None or delay <= 0:
+            await asyncio.sleep(max(0, delay))
+        else:
+            await self._timer_wheel.sleep_until(deadline)
+
+    def _get_executor(self, execute: Execute) -> Executor:
+        executor = self._executors.get(execute.name)
+        if executor is None:
+            if execute.executor == "process":
+                from concurrent.futures import ProcessPoolExecutor
+
+                executor = ProcessPoolExecutor(max_workers=execute.max_workers)
+            else:
+                executor = ThreadPoolExecutor(max_workers=execute.max_workers, thread_name_prefix=execute.name)
+            self._executors[execute.name] = executor
+        return executor
+
+    async def _call_execute(self, execute: Execute, *args, **kwargs) -> Any:
+        """executeに登録された関数を呼び出す、executorを指定している場合はスレッド/プロセスで実行する"""
+        if execute.executor is None:
+            return await execute.func(*args, **kwargs)
+        executor = self._get_executor(execute)
+        if execute.executor == "thread":
+            return await run_in_executor(executor, execute.func, *args, **kwargs)
+        func = execute.func
+        call = partial(call_by_name, func.__module__, func.__qualname__, args, kwargs)
+        return await asyncio.get_running_loop().run_in_executor(executor, call)
+
+    def add_middleware(self, middleware: MiddlewareType) -> MiddlewareType:
+        """emitの一回の実行、Dependsの解決、concurrent_groupの枠の取得、executeの実行、リトライの待機の
+        開始と終了に呼ばれるミドルウェアを登録する
+
+        各区間はSpanとしてミドルウェアに渡され、親子関係はcontextvarsで引き継がれる
+        ミドルウェアを登録しない場合はSpanを作成しない
+
+        Args:
+            middleware (Middleware): 登録するミドルウェア. before/after/startup/shutdownをオーバーライドする
+
+        Returns:
+            Middleware: 登録したミドルウェア
+        """
+        self.tracer.add(middleware)
+        return middleware
+
+    def tasks(self, name: str | None = None) -> list[asyncio.Task]:
+        """生存中のexecuteのタスクを取得する
+
+        Args:
+            name (str, optional): executeの名前、省略すると全てのexecuteのタスクを返す
+
+        Returns:
+            list[asyncio.Task]: 生存中(待機中+実行中)のタスク
+        """
+        return self._registry.tasks("execute", name)  # type: ignore
+
+    def stats(self) -> MachinaStats:
+        """生存中のタスク数の統計を取得する"""
+        return self._registry.stats(list(self._executes))
+
     def create_concurrent_group(
-        self, name: str, entire_calls_limit: int | None = None, time_limit: float = 0, time_calls_limit: int = 1
+        self,
+        name: str,
+        entire_calls_limit: int | None = None,
+        time_limit: float = 0,
+        time_calls_limit: float = 1,
+        *,
+        engine: Engine = "window",
+        burst: int | None = None,
+        adaptive: AdaptiveLimit | None = None,
+        breaker: CircuitBreaker | None = None,
+        workers: int | None = None,
+        queue_size: int | None = None,
+        overflow: Overflow = "wait",
+        backend: BackendType | RateLimitBackend = "memory",
+        key: str | None = None,
     ) -> ConcurrentGroup:
         """並列実行の制限グループを作成する
 
@@ -152,27 +384,69 @@ class Machina:
         time_limit = 1, time_calls_limit = 5, entire_calls_limit = 6
         とする
 
+        adaptiveを指定すると、所属するexecuteの処理時間と例外から最大並列実行数を実行中に調整する
+        breakerを指定すると、それが開いている間は所属するexecuteを枠を取らずにCircuitOpenErrorで失敗させる
+        workersを指定すると、所属するexecuteは呼び出し毎にタスクを作らず、固定数のワーカーで実行される
+        backend="shm"を指定すると、同じkeyを使う同じホストの全てのプロセスで時間あたりの実行回数制限を共有する
+
         Args:
             name (str): 名前
             entire_calls_limit (int, optional): グループ全体での最大並列実行数. Defaults to None.
             time_limit (float, optional): 制限時間[sec]. Defaults to 0.
-            time_calls_limit (int, optional): 制限時間あたりの最大並列実行数. Defaults to 1.
+            time_calls_limit (float, optional): 制限時間あたりの最大並列実行数. Defaults to 1.
+                小数を指定できるのはengine="gcra"のみ
+            engine (Literal['window', 'gcra', 'sliding_log', 'sliding_counter'], optional):
+                時間あたりの実行回数制限の方式. Defaults to "window".
+                window: 実行開始からtime_limit秒後に枠を返却する
+                gcra: time_limit / time_calls_limit 秒に1回のペースに均して実行を許可する. タイマーの数を抑えられる
+                sliding_log: 任意のtime_limit秒間にtime_calls_limit回までを実行開始時刻の記録から厳密に制限する
+                sliding_counter: sliding_logを直前と現在の固定ウィンドウの回数から近似する. メモリが一定
+            burst (int, optional): engine="gcra"の時に連続して実行できる回数. Defaults to None.
+            adaptive (AdaptiveLimit, optional): 最大並列実行数を調整するアルゴリズム(AIMD, Gradient). Defaults to None.
+                指定した場合、entire_calls_limitの初期値はadaptive.limitになる
+            breaker (CircuitBreaker, optional): 所属するexecuteの失敗を監視するサーキットブレーカー. Defaults to None.
+            workers (int, optional): ワーカー数. Defaults to None. つまり、ワーカーを使わない
+            queue_size (int, optional): ワーカーの空きを待つ呼び出しの最大数. Defaults to None. つまり無制限
+            overflow (Literal['wait', 'error', 'drop_oldest'], optional): キューが一杯の時の挙動. Defaults to "wait".
+            backend (Literal['memory', 'shm'] | RateLimitBackend, optional):
+                時間あたりの実行回数制限の状態の保存先. Defaults to "memory". memory以外はengine="gcra"のみ指定できる
+                memory: このプロセスのメモリ
+                shm: 同じホストのプロセス間で共有するメモリマップドファイル. keyが必要
+            key (str, optional): backend="shm"の時に共有する状態の名前. Defaults to None.
 
         Raises:
-            E.MachinaException: 同じ名前を登録しようとした時の例外
+            E.MachinaException: 同じ名前を登録しようとした時や、制限やbackendの指定が不正な時の例外
 
         Returns:
             ConcurrentGroup: 並列実行の制限グループ
         """
         if name in self._concurrent_groups:
             raise E.MachinaException(f"このconcurrent_groupはすでに登録されています別の名前にしてください: [{name}]")
+        if adaptive is not None:
+            if entire_calls_limit is not None:
+                raise E.MachinaException(f"adaptiveとentire_calls_limitは同時に指定できません: [{name}]")
+            entire_calls_limit = adaptive.limit
+        semaphore = _create_semaphore(
+            name,
+            engine,
+            entire_calls_limit=entire_calls_limit,
+            time_limit=time_limit,
+            time_calls_limit=time_calls_limit,
+            burst=burst,
+            backend=backend,
+            key=key,
+        )
 
         cg = ConcurrentGroup(
             name=name,
-            semaphore=TimeSemaphore(
-                entire_calls_limit=entire_calls_limit, time_limit=time_limit, time_calls_limit=time_calls_limit
-            ),
+            semaphore=semaphore,
+            adaptive=adaptive,
+            breaker=breaker,
         )
+        if self._instruments is not None:
+            cg.instruments = self._instruments.group(name)
+        if workers is not None:
+            cg.pool = WorkerPool(self._run_pooled_job, workers=workers, queue_size=queue_size, overflow=overflow)
         self._concurrent_groups[name] = cg
         return cg
 
@@ -184,6 +458,9 @@ class Machina:
         interval: str = "0s",
         mode: Literal["after", "entire"] = "after",
         alive: bool = True,
+        cron: str | None = None,
+        missed: MissedTickPolicy = "coalesce",
+        max_in_flight: int = 1,
     ) -> Callable[[Callable[..., Awaitable[None]]], Callable[[], NoReturn]]:
         """Emitを登録します
 
@@ -196,17 +473,45 @@ class Machina:
             interval (str, optional): 次の実行までの待機時間. Defaults to "0s".
             mode (Literal['after', 'entire'], optional): 待機時間に処理時間を含むかどうか. Defaults to "after".
                 after: 処理の後interval秒待機する
-                entire: intervalから処理時間を引いた時間待機する
+                entire: 前回の実行予定時刻からinterval秒後まで待機する. 処理時間や待機の誤差が蓄積しない
             alive (bool, optional): ループを稼働するかどうか. Defaults to True.
+            cron (str, optional): "分 時 日 月 曜日"のcron形式のスケジュール. Defaults to None.
+                指定した場合はintervalとmodeの代わりに、最初の実行も含めてスケジュールに一致する時刻に実行する
+                解析できないか一致する時刻がない場合はMachinaExceptionを送出する
+            missed (Literal['skip', 'catch_up', 'coalesce'], optional):
+                entireモードで処理が長引いて実行予定時刻を過ぎた時の挙動. Defaults to "coalesce".
+                skip: 過ぎた回は実行せず、次の実行予定時刻まで待機する
+                catch_up: 過ぎた回を待機せずに全て実行する
+                coalesce: 過ぎた回をまとめて一回だけすぐに実行し、その後は元の実行予定時刻に戻る
+            max_in_flight (int, optional): 前回の実行の終了を待たずに並行して実行できる数. Defaults to 1.
+                2以上はentireモードかcronを指定した場合のみ使える
+
+        Raises:
+            E.MachinaException: 引数の指定が不正な時の例外
         """
-        if count is not None and count < 0:
-            raise E.MachinaException("countは0以上を指定してください")
+        _cron = _validate_emit_options(
+            count=count, interval=interval, mode=mode, cron=cron, missed=missed, max_in_flight=max_in_flight
+        )
 
         def decorator(func: Callable[..., Awaitable[None]]):
             _name = func.__name__ if name is None else name
-            emit = Emit(name=_name, func=func, interval=interval, alive=alive, mode=mode, count=count)
+            emit = Emit(
+                name=_name,
+                func=func,
+                interval=interval,
+                alive=alive,
+                mode=mode,
+                count=count,
+                cron=_cron,
+                missed=missed,
+                max_in_flight=max_in_flight,
+            )
             if _name in self._emits:
                 raise E.MachinaException(f"このemitはすでには登録されています、別の名前にしてください: [{_name}]")
+            if "execute" in emit.plan.scopes:
+                raise E.MachinaException(f"emitのDependsにscope='execute'は指定できません: [{_name}]")
+            if self._instruments is not None:
+                emit.instruments = self._instruments.emit(_name)
             self._emits[_name] = emit
 
             def no_return():
@@ -216,13 +521,98 @@ class Machina:
 
         return decorator
 
-    def execute(self, *, name: str | None = None, concurrent_groups: list[str] = [], retry: Retry | None = None):
+    def execute(
+        self,
+        *,
+        name: str | None = None,
+        concurrent_groups: list[str] = [],
+        retry: Retry | None = None,
+        max_tasks: int | None = None,
+        queue_size: int | None = None,
+        overflow: Overflow = "wait",
+        executor: ExecutorType | None = None,
+        max_workers: int | None = None,
+        coalesce: bool = False,
+        key: Callable[..., Hashable] | None = None,
+        cache_ttl: float | None = None,
+        cache_size: int | None = 1024,
+        cache_errors: float | None = None,
+        stale_while_revalidate: float = 0,
+    ):
+        """Executeを登録します
+
+        max_tasksかqueue_sizeを指定すると、呼び出しはキューに入りmax_tasks個までしかタスク化されない
+        executorを指定すると、同期関数をbotが管理するスレッドプール/プロセスプールで実行する
+        coalesce=Trueにすると、同じ引数の呼び出しが実行中の間はそれにまとめ、タスクも枠も新たに取らずに同じ結果を返す
+        cache_ttlを指定すると、結果をその秒数キャッシュし、同じ引数の呼び出しには実行せずに返す
+
+        Args:
+            name (str, optional): 名前(ユニーク),省略するとデコレートした関数名を使用する
+            concurrent_groups (list[str], optional): 所属するconcurrent_groupの名前. Defaults to [].
+            retry (Retry, optional): リトライの設定. Defaults to None.
+            max_tasks (int, optional): 同時に存在できるタスクの最大数. Defaults to None.
+                queue_size のみ指定した場合はconcurrent_groupsのentire_calls_limitの最小値を使用する
+            queue_size (int, optional): タスク化を待つ呼び出しの最大数. Defaults to None. つまり無制限
+            overflow (Literal['wait', 'error', 'drop_oldest'], optional): キューが一杯の時の挙動. Defaults to "wait".
+                wait: event.submitは空きが出るまで待機する. event.executeはQueueFullErrorを送出する
+                error: QueueFullErrorを送出する
+                drop_oldest: 最も古い呼び出しをQueueFullErrorで終了させる
+            executor (Literal['thread', 'process'], optional): 同期関数を実行するプールの種類. Defaults to None.
+                thread: ThreadPoolExecutorで実行する. I/Oを伴う同期関数向け
+                process: ProcessPoolExecutorで実行する. CPUを使う処理向け、関数はモジュールのトップレベルで定義すること
+            max_workers (int, optional): executorの最大ワーカー数. Defaults to None. つまり、各Executorのデフォルト
+            coalesce (bool, optional): 実行中の同じ呼び出しをまとめるかどうか. Defaults to False.
+                呼び出しは全てFutureを返し、一部の呼び出し元がキャンセルしても残りの呼び出し元がいる間は実行を続ける
+            key (Callable, optional): 同じ呼び出しとみなすキーを引数から作る関数. Defaults to None.
+                つまり、全ての引数. キーがハッシュできない呼び出しはまとめず、キャッシュもしない
+            cache_ttl (float, optional): 結果をキャッシュする時間[sec]. Defaults to None. つまり、キャッシュしない
+                指定した場合、キャッシュにない同じ呼び出しはcoalesce=Trueと同様に一つの実行にまとめる
+            cache_size (int, optional): キャッシュする最大の件数. 超えると最も長く使われていないものから削除する.
+                Defaults to 1024. Noneの場合は無制限
+            cache_errors (float, optional): 例外で終わった結果をキャッシュする時間[sec]. Defaults to None.
+                つまり、例外はキャッシュしない
+            stale_while_revalidate (float, optional): cache_ttlを過ぎた後も古い結果を返す時間[sec]. Defaults to 0.
+                この間の呼び出しには古い結果をすぐに返し、concurrent_groupの制限の中で一度だけ再実行して更新する
+        """
+        _validate_cache_options(
+            key=key,
+            coalesce=coalesce,
+            cache_ttl=cache_ttl,
+            cache_errors=cache_errors,
+            stale_while_revalidate=stale_while_revalidate,
+        )
+
         def decorator(func: DecoratedResultCallable) -> DecoratedResultCallable:
             _name = func.__name__ if name is None else name
             _concurrent_groups = [self._concurrent_groups[cg_name] for cg_name in concurrent_groups]
-            execute = Execute(name=_name, func=func, concurrent_groups=_concurrent_groups, retry=retry)
+            execute = Execute(
+                name=_name,
+                func=func,
+                concurrent_groups=_concurrent_groups,
+                retry=retry,
+                executor=executor,
+                max_workers=max_workers,
+                coalescer=_Coalescer(key) if coalesce or cache_ttl is not None else None,
+            )
+            if cache_ttl is not None:
+                execute.result_cache = _ResultCache(
+                    cache_ttl, maxsize=cache_size, error_ttl=cache_errors, stale_ttl=stale_while_revalidate
+                )
             if _name in self._executes:
                 raise E.MachinaException(f"このexecuteはすでには登録されています、別の名前にしてください: [{_name}]")
+            if "emit" in execute.plan.scopes:
+                raise E.MachinaException(f"executeのDependsにscope='emit'は指定できません: [{_name}]")
+            if executor is not None:
+                _validate_executor(_name, func, executor)
+            self._set_execute_queue(execute, max_tasks=max_tasks, queue_size=queue_size, overflow=overflow)
+            if self._instruments is not None:
+                execute.instruments = self._instruments.execute(_name)
+                if execute.queue is not None:
+                    execute.instruments.queued.set_function(execute.queue.qsize)
+            if retry is not None:
+                # 共有されたRetryは変更せず、このbotの記録先を使うコピーをexecute毎に持つ
+                metrics = self.metrics if self._instruments is not None else None
+                execute.retry = retry.bind(metrics=metrics, tracer=self.tracer)
             self._executes[_name] = execute
 
             @functools.wraps(func)
@@ -234,6 +624,32 @@ class Machina:
 
         return decorator
 
+    def _set_execute_queue(
+        self, execute: Execute, *, max_tasks: int | None, queue_size: int | None, overflow: Overflow
+    ) -> None:
+        """workersを持つconcurrent_groupかmax_tasks, queue_sizeの指定に応じて、executeの呼び出しを待たせるキューを設定する"""
+        pools = [cg.pool for cg in execute.concurrent_groups if cg.pool is not None]
+        if len(pools) > 1:
+            raise E.MachinaException(f"workersを持つconcurrent_groupは一つまでしか指定できません: [{execute.name}]")
+        if pools and (max_tasks is not None or queue_size is not None):
+            raise E.MachinaException(f"workersを持つconcurrent_groupとmax_tasksは同時に指定できません: [{execute.name}]")
+        if pools:
+            execute.queue = pools[0]
+            return
+        if max_tasks is None and queue_size is None:
+            return
+        if max_tasks is None:
+            limits = [cg.semaphore.entire_calls_limit for cg in execute.concurrent_groups]
+            max_tasks = min([limit for limit in limits if limit is not None], default=None)
+        if max_tasks is None:
+            raise E.MachinaException(f"max_tasksを指定してください: [{execute.name}]")
+        execute.queue = AdmissionQueue(
+            partial(self._start_execute_job, execute),
+            max_tasks=max_tasks,
+            queue_size=queue_size,
+            overflow=overflow,
+        )
+
     def _add_emit_task(self, name: str) -> str:
         emit = self._emits.get(name)
         if emit is None:
@@ -254,49 +670,511 @@ class Machina:
         task = asyncio.create_task(func())
         task.add_done_callback(partial(self._emit_task_done, emit))
         self._emit_tasks[emit.name] = task
-        self._unfinished_tasks += 1
+        self._registry.add("emit", emit.name, task)
 
         return name
 
-    def _emit_task_done(self, emit: Emit, _: asyncio.Task):
+    def _stop_emit(self, name: str, force: bool = False):
+        if force:
+            task = self._emit_tasks[name]
+            task.cancel()
+        else:
+            self._emits[name].alive = False
+
+    def _emit_task_done(self, emit: Emit, task: asyncio.Task):
         """emitのtaskが終了した時(cancelも含む)に呼ばれるcallback関数
-        タスクが全て終わったことを確認するための変数を更新する
+        タスクが全て終わったことを確認するためにレジストリから削除する
         """
-        self._unfinished_tasks -= 1
+        self._registry.remove(task)
         emit.alive = False
-        self.logger.debug(f'Done emit task: "{emit.name}", remain tasks: {self._unfinished_tasks}')
-        if self._unfinished_tasks == 0:
+        self.logger.debug('Done emit task: "%s", remain tasks: %d', emit.name, len(self._registry))
+        if len(self._registry) == 0:
             self._finished.set()
 
-    def _add_execute_task(self, name: str, *args, **kwargs) -> asyncio.Task:
+    def _get_execute(self, name: str) -> Execute:
         execute = self._executes.get(name)
         if execute is None:
             raise E.MachinaException(f"executesに存在しないnameを指定しています: [{name}]")
-
-        tasks = self._execute_tasks[name]
-
-        @cancelled_wrapper(name, "execute", self.logger)
+        return execute
+
+    def _add_execute_task(self, name: str, *args, **kwargs) -> asyncio.Future:
+        execute = self._get_execute(name)
+        coalescer = execute.coalescer
+        if coalescer is None:
+            return self._start_execute_task(execute, args, kwargs)
+
+        key = coalescer.make_key(args, kwargs)
+        if key is None:
+            return self._start_execute_task(execute, args, kwargs)
+        future = self._find_execute_result(execute, key, args, kwargs)
+        if future is not None:
+            return future
+        return self._watch_execute_result(execute, key, self._start_execute_task(execute, args, kwargs))
+
+    def _start_execute_task(self, execute: Execute, args: tuple, kwargs: dict) -> asyncio.Future:
+        if execute.requeue:
+            requeued = _RequeuedExecute(self, execute, args, kwargs)
+            requeued.start()
+            return self._register_execute_task(execute, requeued.future)
+
+        if execute.queue is not None:
+            job = Job(args=args, kwargs=kwargs, future=asyncio.get_running_loop().create_future(), name=execute.name)
+            execute.queue.put_nowait(job)
+            return self._register_execute_task(execute, job.future)
+
+        return self._register_execute_task(execute, self._create_execute_task(execute, *args, **kwargs))
+
+    async def _submit_execute_task(self, name: str, *args, **kwargs) -> asyncio.Future:
+        execute = self._get_execute(name)
+
+        if execute.queue is None:
+            return self._add_execute_task(name, *args, **kwargs)
+
+        coalescer = execute.coalescer
+        if coalescer is None:
+            return await self._submit_start_execute_task(execute, args, kwargs)
+
+        key = coalescer.make_key(args, kwargs)
+        if key is None:
+            return await self._submit_start_execute_task(execute, args, kwargs)
+        # キャッシュした結果やまとめられる呼び出しはキューの空きを待たない
+        future = self._find_execute_result(execute, key, args, kwargs)
+        if future is not None:
+            return future
+        return self._watch_execute_result(execute, key, await self._submit_start_execute_task(execute, args, kwargs))
+
+    def _find_execute_result(self, execute: Execute, key: Hashable, args: tuple, kwargs: dict) -> asyncio.Future | None:
+        """キャッシュした結果か、実行中の同じ呼び出しの結果を受け取るFutureを返す. どちらもなければNone"""
+        cache = execute.result_cache
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                if cached.stale and cache.begin_refresh(key):
+                    # 古い結果をすぐに返し、一度だけ再実行して更新する
+                    _observe_cache(execute, "stale")
+                    try:
+                        work = self._start_execute_task(execute, args, kwargs)
+                        refresh = self._watch_execute_result(execute, key, work)
+                    except E.QueueFullError:
+                        cache.end_refresh(key)
+                    else:
+                        # 再実行の結果は誰も受け取らないので、失敗しても未取得の例外として警告させない
+                        refresh.add_done_callback(_retrieve_exception)
+                else:
+                    _observe_cache(execute, "hit")
+                return cached.future()
+            _observe_cache(execute, "miss")
+
+        future = execute.coalescer.join(key)  # type: ignore
+        if future is not None:
+            _observe_coalesced(execute)
+        return future
+
+    def _watch_execute_result(self, execute: Execute, key: Hashable, work: asyncio.Future) -> asyncio.Future:
+        """新たに開始した実行の結果をキャッシュし、同じ呼び出しをまとめられるようにする"""
+        if execute.result_cache is not None:
+            execute.result_cache.watch(key, work)
+        return execute.coalescer.start(key, work)  # type: ignore
+
+    async def _submit_start_execute_task(self, execute: Execute, args: tuple, kwargs: dict) -> asyncio.Future:
+        if execute.requeue:
+            requeued = _RequeuedExecute(self, execute, args, kwargs)
+            await requeued.submit()
+            return self._register_execute_task(execute, requeued.future)
+
+        job = Job(args=args, kwargs=kwargs, future=asyncio.get_running_loop().create_future(), name=execute.name)
+        await execute.queue.put(job)  # type: ignore
+        return self._register_execute_task(execute, job.future)
+
+    def _create_execute_task(self, execute: Execute, *args, **kwargs) -> asyncio.Task:
+        if execute.requeue:
+            # 試行毎のタスク. ログはリトライを管理する_RequeuedExecuteが最終的な結果に対して出す
+            return asyncio.create_task(execute_wrapper(execute, self, *args, **kwargs))
+
+        @cancelled_wrapper(execute.name, "execute", self.logger)
         async def func():
             return await execute_wrapper(execute, self, *args, **kwargs)
 
-        task = asyncio.create_task(func())
-        task.add_done_callback(partial(self._execute_task_done, execute))
-        tasks.append(task)
+        return asyncio.create_task(func())
 
-        self._unfinished_tasks += 1
+    def _start_execute_job(self, execute: Execute, job: Job) -> asyncio.Task:
+        """キューから取り出された呼び出しをタスク化する"""
+        _observe_queue_wait(execute, job)
+        task = self._create_execute_task(execute, *job.args, **job.kwargs)
+        task.add_done_callback(partial(_chain_future, job.future))
+        job.future.add_done_callback(lambda future: task.cancel() if future.cancelled() else None)
+        return task
 
+    async def _run_pooled_job(self, job: Job) -> Any:
+        """ワーカーからキューに入った呼び出しを実行する"""
+        execute = self._executes[job.name]
+        _observe_queue_wait(execute, job)
+        if execute.requeue:
+            return await execute_wrapper(execute, self, *job.args, **job.kwargs)
+        try:
+            return await execute_wrapper(execute, self, *job.args, **job.kwargs)
+        except asyncio.CancelledError:
+            self.logger.debug('Cancelled execute task: "%s"', execute.name)
+            raise
+        except BaseException:
+            self.logger.error(f'Uncatched error execute task: "{execute.name}"', exc_info=True)
+            raise
+
+    def _register_execute_task(self, execute: Execute, task: asyncio.Future) -> asyncio.Future:
+        task.add_done_callback(self._execute_task_done)
+        self._registry.add("execute", execute.name, task)
         return task
 
-    def _execute_task_done(self, execute: Execute, task: asyncio.Task):
-        self._unfinished_tasks -= 1
-        tasks = self._execute_tasks[execute.name]
-        # 終了したこのタスク自身をリストから消去
-        tasks.pop(tasks.index(task))
+    def _execute_task_done(self, task: asyncio.Future):
+        # 終了したこのタスク自身をレジストリから消去
+        self._registry.remove(task)
 
-        if self._unfinished_tasks == 0:
+        if len(self._registry) == 0:
             self._finished.set()
 
 
+class _Coalescer:
+    def __init__(self, key: Callable[..., Hashable] | None = None):
+        """coalesce=Trueのexecuteで、同じキーの実行中の呼び出しを一つの実行にまとめる
+
+        呼び出し元には実行の結果をコピーするFutureを返し、全ての呼び出し元がキャンセルした時だけ実行をキャンセルする
+
+        Args:
+            key (Callable, optional): 引数からキーを作る関数. Defaults to None. つまり、全ての引数
+        """
+        self.key = key
+        self._in_flight: dict[Hashable, _Flight] = {}
+
+    def make_key(self, args: tuple, kwargs: dict) -> Hashable | None:
+        """呼び出しのキー. ハッシュできない場合はまとめないのでNone"""
+        key = (args, tuple(sorted(kwargs.items()))) if self.key is None else self.key(*args, **kwargs)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def join(self, key: Hashable) -> asyncio.Future | None:
+        """同じキーの呼び出しが実行中ならその結果を受け取るFutureを返す"""
+        flight = self._in_flight.get(key)
+        return None if flight is None else flight.attach()
+
+    def start(self, key: Hashable, work: asyncio.Future) -> asyncio.Future:
+        """新たに開始した実行を登録し、その結果を受け取るFutureを返す"""
+        flight = _Flight(work)
+        # submitでキューの空きを待つ間に同じキーの実行が始まっていた場合は、後から来た呼び出しはそちらにまとめる
+        if key not in self._in_flight:
+            self._in_flight[key] = flight
+            work.add_done_callback(partial(self._finish, key, flight))
+        return flight.attach()
+
+    def _finish(self, key: Hashable, flight: _Flight, work: asyncio.Future) -> None:
+        if self._in_flight.get(key) is flight:
+            del self._in_flight[key]
+
+
+class _CachedResult:
+    """キャッシュしたexecuteの結果"""
+
+    __slots__ = ("value", "error", "fresh_until")
+
+    def __init__(self, value: Any, error: BaseException | None, fresh_until: float):
+        self.value = value
+        self.error = error
+        self.fresh_until = fresh_until  # これを過ぎるとstale_while_revalidateの間だけ古い結果として返す
+
+    @property
+    def stale(self) -> bool:
+        return monotonic() >= self.fresh_until
+
+    def future(self) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if self.error is None:
+            future.set_result(self.value)
+        else:
+            # 同じ例外を何度も送出するとtracebackが伸び続けるので、呼び出し毎にコピーを送出する
+            future.set_exception(_copy_exception(self.error))
+        return future
+
+
+def _copy_exception(error: BaseException) -> BaseException:
+    """tracebackを持たない例外のコピー. コピーできない例外はtracebackを消して返す"""
+    try:
+        copied = copy.copy(error)
+    except Exception:
+        return error.with_traceback(None)
+    copied.__cause__ = error.__cause__
+    copied.__suppress_context__ = error.__suppress_context__
+    return copied.with_traceback(None)
+
+
+class _ResultCache:
+    def __init__(self, ttl: float, *, maxsize: int | None, error_ttl: float | None, stale_ttl: float):
+        """executeの結果のキャッシュ
+
+        Args:
+            ttl (float): 結果を新しいとみなす時間[sec]
+            maxsize (int, optional): 最大の件数
+            error_ttl (float, optional): 例外をキャッシュする時間[sec]. Noneの場合はキャッシュしない
+            stale_ttl (float): ttlを過ぎた後も古い結果を返す時間[sec]
+        """
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.stale_ttl = stale_ttl
+        self._cache = TTLCache(maxsize=maxsize)
+        self._refreshing: set[Hashable] = set()  # 古い結果を更新するために再実行中のキー
+
+    def get(self, key: Hashable) -> _CachedResult | None:
+        cached = self._cache.get(key)
+        return None if cached is MISSING else cached
+
+    def begin_refresh(self, key: Hashable) -> bool:
+        """再実行中でなければ再実行中にしてTrueを返す"""
+        if key in self._refreshing:
+            return False
+        self._refreshing.add(key)
+        return True
+
+    def end_refresh(self, key: Hashable) -> None:
+        self._refreshing.discard(key)
+
+    def watch(self, key: Hashable, work: asyncio.Future) -> None:
+        """workが終わったら結果をキャッシュする"""
+        work.add_done_callback(partial(self._store, key))
+
+    def _store(self, key: Hashable, work: asyncio.Future) -> None:
+        self.end_refresh(key)
+        if work.cancelled():
+            return
+        error = work.exception()
+        if error is None:
+            cached = _CachedResult(work.result(), None, monotonic() + self.ttl)
+            self._cache.set(key, cached, self.ttl + self.stale_ttl)
+        # 再実行が失敗した場合は古い結果を残す
+        elif self.error_ttl is not None and self.get(key) is None:
+            self._cache.set(key, _CachedResult(None, error, monotonic() + self.error_ttl), self.error_ttl)
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self._refreshing.clear()
+
+
+class _Flight:
+    """まとめた呼び出しの一つの実行"""
+
+    __slots__ = ("work", "waiters")
+
+    def __init__(self, work: asyncio.Future):
+        self.work = work
+        self.waiters = 0  # キャンセルしていない呼び出し元の数
+
+    def attach(self) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters += 1
+        self.work.add_done_callback(partial(_chain_future, future))
+        future.add_done_callback(self._on_waiter_done)
+        return future
+
+    def _on_waiter_done(self, future: asyncio.Future) -> None:
+        if not future.cancelled() or self.work.done():
+            return
+        self.waiters -= 1
+        if self.waiters == 0:
+            self.work.cancel()
+
+
+class _RequeuedExecute:
+    """requeueモードのRetryを指定したexecuteの一回の呼び出し
+
+    試行毎にタスク(キューを使う場合はJob)を作成し、リトライの待機中はタスクも並列実行数の枠も持たずに
+    loop.call_laterで次の試行を再投入する
+    """
+
+    def __init__(self, bot: Machina, execute: Execute, args: tuple, kwargs: dict):
+        self.bot = bot
+        self.execute = execute
+        self.retry: Retry = execute.retry  # type: ignore
+        self.args = args
+        self.kwargs = kwargs
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()  # 呼び出し元に返す、全ての試行を通した結果
+        self.state: RetryState | None = None
+        self.attempt: asyncio.Future | None = None
+        self.timer: asyncio.TimerHandle | None = None
+        self.span: Span | None = None  # リトライの待機のSpan
+        self.trial: int | None = None  # 今の試行のbreakerの試行番号
+        self.retry.begin()
+        self.future.add_done_callback(self._on_future_done)
+
+    def start(self) -> None:
+        """次の試行を開始する"""
+        self.timer = None
+        self.bot.tracer.finish(self.span)
+        self.span = None
+        if not self._before_attempt():
+            return
+        execute = self.execute
+        if execute.queue is None:
+            self._attach(self.bot._create_execute_task(execute, *self.args, **dict(self.kwargs)))
+            return
+        job = self._create_job()
+        try:
+            execute.queue.put_nowait(job)
+        except BaseException as e:
+            self.retry.on_cancel(self.trial)
+            if self.state is None:
+                # 最初の試行はキューを使わない場合と同様に呼び出し元に例外を送出する
+                self.future.cancel()
+                raise
+            self._finish(e)
+            return
+        self._attach(job.future)
+
+    async def submit(self) -> None:
+        """最初の試行をキューの空きを待って投入する"""
+        if not self._before_attempt():
+            return
+        job = self._create_job()
+        try:
+            await self.execute.queue.put(job)  # type: ignore
+        except BaseException:
+            self.retry.on_cancel(self.trial)
+            self.future.cancel()
+            raise
+        self._attach(job.future)
+
+    def _before_attempt(self) -> bool:
+        try:
+            self.trial = self.retry.before_attempt()
+        except CircuitOpenError as e:
+            self._finish(e)
+            return False
+        return True
+
+    def _create_job(self) -> Job:
+        return Job(args=self.args, kwargs=dict(self.kwargs), future=self.loop.create_future(), name=self.execute.name)
+
+    def _attach(self, attempt: asyncio.Future) -> None:
+        self.attempt = attempt
+        attempt.add_done_callback(self._on_attempt_done)
+
+    def _on_attempt_done(self, attempt: asyncio.Future) -> None:
+        self.attempt = None
+        if self.future.done():
+            # 呼び出し元がキャンセルした試行の枠を返却する
+            self.retry.on_cancel(self.trial)
+            return
+        if attempt.cancelled():
+            self.retry.on_cancel(self.trial)
+            self.future.cancel()
+            return
+        e = attempt.exception()
+        if e is None:
+            self.retry.on_success(self.trial)
+            self.future.set_result(attempt.result())
+            return
+        self.state, sleep = self.retry.on_error(self.state, e, self.trial)
+        if sleep is None:
+            self._finish(e)
+            return
+        self.span = self.bot.tracer.start("retry", self.retry.label(self.state.rule), sleep=sleep)  # type: ignore
+        self.timer = self.loop.call_later(sleep, self.start)
+
+    def _finish(self, e: BaseException) -> None:
+        self.bot.logger.error(f'Uncatched error execute task: "{self.execute.name}"', exc_info=e)
+        self.future.set_exception(e)
+
+    def _on_future_done(self, future: asyncio.Future) -> None:
+        if not future.cancelled():
+            return
+        self.bot.logger.debug('Cancelled execute task: "%s"', self.execute.name)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+            self.bot.tracer.finish(self.span, asyncio.CancelledError())
+            self.span = None
+        if self.attempt is not None:
+            self.attempt.cancel()
+
+
+def _validate_cache_options(
+    *,
+    key: Callable[..., Hashable] | None,
+    coalesce: bool,
+    cache_ttl: float | None,
+    cache_errors: float | None,
+    stale_while_revalidate: float,
+) -> None:
+    """executeのcoalesceとキャッシュの引数を検証する"""
+    if cache_ttl is None:
+        if key is not None and not coalesce:
+            raise E.MachinaException("keyはcoalesce=Trueかcache_ttlを指定した場合のみ指定できます")
+        if cache_errors is not None or stale_while_revalidate != 0:
+            raise E.MachinaException("cache_errorsとstale_while_revalidateはcache_ttlを指定した場合のみ指定できます")
+    elif cache_ttl <= 0 or (cache_errors is not None and cache_errors <= 0) or stale_while_revalidate < 0:
+        raise E.MachinaException("cache_ttlとcache_errorsは0より大きく、stale_while_revalidateは0以上を指定してください")
+
+
+def _validate_executor(name: str, func: Callable[..., Any], executor: ExecutorType) -> None:
+    """executorで実行できる関数かどうかを検証する"""
+    if inspect.iscoroutinefunction(func):
+        raise E.MachinaException(f"executorには同期関数のみ指定できます: [{name}]")
+    if executor == "process" and "<locals>" in func.__qualname__:
+        raise E.MachinaException(f"executor='process'はモジュールのトップレベルの関数のみ指定できます: [{name}]")
+
+
+def _create_semaphore(
+    name: str,
+    engine: Engine,
+    *,
+    entire_calls_limit: int | None,
+    time_limit: float,
+    time_calls_limit: float,
+    burst: int | None,
+    backend: BackendType | RateLimitBackend,
+    key: str | None,
+) -> TimeSemaphore:
+    """concurrent_groupのsemaphoreを作る. 指定が不正な場合はMachinaExceptionを送出する"""
+    rate_backend = None
+    if backend != "memory":
+        if engine != "gcra":
+            raise E.MachinaException(f"backendを指定する場合はengine='gcra'にしてください: [{name}]")
+        try:
+            rate_backend = create_rate_backend(backend, key)
+        except ValueError as e:
+            raise E.MachinaException(f"{e}: [{name}]") from e
+
+    try:
+        return create_time_semaphore(
+            engine,
+            entire_calls_limit=entire_calls_limit,
+            time_limit=time_limit,
+            time_calls_limit=time_calls_limit,
+            burst=burst,
+            backend=rate_backend,
+        )
+    except ValueError as e:
+        raise E.MachinaException(f"{e}: [{name}]") from e
+
+
+def _retrieve_exception(future: asyncio.Future) -> None:
+    """結果を受け取らないFutureの例外を取得済みにする"""
+    if not future.cancelled():
+        future.exception()
+
+
+def _chain_future(future: asyncio.Future, task: asyncio.Future):
+    """taskの結果をfutureにコピーする"""
+    if future.done():
+        return
+    if task.cancelled():
+        future.cancel()
+    elif task.exception() is not None:
+        future.set_exception(task.exception())  # type: ignore
+    else:
+        future.set_result(task.result())
+
+
 def cancelled_wrapper(name: str, type: Literal["emit", "execute"], logger: logging.Logger):
     def decorator(afunc: Callable[[], Awaitable[Any]]):
         @functools.wraps(afunc)
@@ -304,7 +1182,7 @@ def cancelled_wrapper(name: str, type: Literal["emit", "execute"], logger: loggi
             try:
                 return await afunc()
             except asyncio.CancelledError:
-                logger.debug(f'Cancelled {type} task: "{name}"')
+                logger.debug('Cancelled %s task: "%s"', type, name)
             except BaseException:
                 logger.error(f'Uncatched error {type} task: "{name}"', exc_info=True)
                 raise
@@ -314,74 +1192,325 @@ def cancelled_wrapper(name: str, type: Literal["emit", "execute"], logger: loggi
     return decorator
 
 
-def get_args(func) -> tuple[list[str], dict[str, Any]]:
-    signature = inspect.signature(func)
-    args = [k for k, v in signature.parameters.items() if v.default is inspect.Parameter.empty]
-    kwargs = {k: v.default for k, v in signature.parameters.items() if v.default is not inspect.Parameter.empty}
-    return args, kwargs
+def _validate_emit_options(
+    *,
+    count: int | None,
+    interval: str,
+    mode: Literal["after", "entire"],
+    cron: str | None,
+    missed: MissedTickPolicy,
+    max_in_flight: int,
+) -> Cron | None:
+    """emitの引数を検証し、cronを指定した場合は解析したCronを返す"""
+    if count is not None and count < 0:
+        raise E.MachinaException("countは0以上を指定してください")
+    if cron is not None and interval != "0s":
+        raise E.MachinaException("cronとintervalは同時に指定できません")
+    if missed not in ("skip", "catch_up", "coalesce"):
+        raise E.MachinaException(f"missedには'skip', 'catch_up', 'coalesce'のいずれかを指定してください: [{missed}]")
+    if max_in_flight < 1:
+        raise E.MachinaException("max_in_flightは1以上を指定してください")
+    if max_in_flight > 1 and mode == "after" and cron is None:
+        raise E.MachinaException("max_in_flightはentireモードかcronを指定した場合のみ使えます")
+    if cron is None:
+        return None
+    try:
+        _cron = Cron(cron)
+        # 一致する時刻がないスケジュールは実行中ではなく登録時に検出する
+        _cron.next(datetime.now())
+    except ValueError as e:
+        raise E.MachinaException(str(e)) from e
+    return _cron
+
+
+def _next_cron_deadline(cron: Cron, loop: asyncio.AbstractEventLoop) -> float:
+    """cronの次の実行時刻をloop.time()基準に変換する"""
+    now = datetime.now()
+    return loop.time() + (cron.next(now) - now).total_seconds()
+
+
+async def _run_emit(emit: Emit, event: Event) -> float:
+    """emitを一回実行して処理時間を返す"""
+    plan = emit.plan
+    bot = event._bot
+    with bot.tracer.span("emit", emit.name, epoch=event.epoch):
+        # キャッシュしないgeneratorのDependsは実行後に後処理する
+        async with AsyncExitStack() if plan.teardown else _NO_TEARDOWN as stack:
+            # 引数の設定
+            kwargs = dict(plan.defaults)
+            if plan.use_event:
+                kwargs["event"] = event
+            # Dependsの実行
+            depends = await DependsContoroller.execute_plan(
+                plan, bot.tracer, bot.depends_cache, ("emit", emit.name), stack
+            )
+            kwargs.update(depends)
+            start = perf_counter()
+            # 実行
+            await emit.func(**kwargs)
+            # 計測
+            return perf_counter() - start
+
+
+def _next_deadline(emit: Emit, bot: Machina, deadline: float, interval: float, now: float) -> float:
+    """entireモードの次の実行予定時刻を返す
+
+    実行予定時刻は前回の実行予定時刻から数えるので、処理時間や待機の誤差が蓄積しない
+    遅延の警告は遅れ始めた時に一度だけ出し、catch_upで遅れを取り戻している間は出さない
+    """
+    deadline += interval
+    if deadline >= now or interval <= 0:
+        emit.stalled = False
+        return max(deadline, now)
+    delay = now - deadline
+    # 過ぎてしまった実行予定時刻のうち最後のもの
+    latest = deadline + (delay // interval) * interval
+    if not emit.stalled:
+        emit.stalled = True
+        bot.logger.warning(f"指定されたインターバルより{delay:.0f}秒以上遅延しています. [{emit.name}: {emit.missed}]")
+    if emit.missed == "skip":
+        return latest + interval
+    if emit.missed == "coalesce":
+        return latest
+    return deadline
+
+
+class _EmitRunner:
+    def __init__(self, emit: Emit):
+        """emitを一回ずつ実行し、max_in_flightが2以上の場合は前回の終了を待たずに並行して実行する"""
+        self.emit = emit
+        self.previous_execution_time = 0.0
+        self.in_flight: set[asyncio.Task] = set()  # 並行して実行中のタスク
+        self.failed: list[BaseException] = []
+
+    async def run(self, event: Event) -> None:
+        if self.emit.max_in_flight == 1:
+            self._record(await _run_emit(self.emit, event))
+            return
+        # 実行中の数が上限に達している場合は一つ終わるまで待機する
+        while len(self.in_flight) >= self.emit.max_in_flight and not self.failed:
+            await asyncio.wait(self.in_flight, return_when=asyncio.FIRST_COMPLETED)
+        self.check()
+        task = asyncio.create_task(_run_emit(self.emit, event))
+        task.add_done_callback(self._on_done)
+        self.in_flight.add(task)
+
+    def check(self) -> None:
+        """並行して実行したタスクが失敗していれば、その例外を送出する"""
+        if self.failed:
+            raise self.failed[0]
+
+    async def join(self) -> None:
+        """並行して実行中のタスクの終了を待つ"""
+        if self.in_flight:
+            await asyncio.wait(self.in_flight)
+        self.check()
+
+    def cancel(self) -> None:
+        for task in self.in_flight:
+            task.cancel()
+
+    def _record(self, execution_time: float) -> None:
+        self.previous_execution_time = execution_time
+        if self.emit.instruments is not None:
+            self.emit.instruments.observe(execution_time)
+
+    def _on_done(self, task: asyncio.Task) -> None:
+        self.in_flight.discard(task)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            self.failed.append(error)
+        else:
+            self._record(task.result())
+
+
+def _following_deadline(
+    emit: Emit, bot: Machina, deadline: float, interval: float, loop: asyncio.AbstractEventLoop
+) -> float:
+    """modeとcronに応じて、今回の実行予定時刻から次の実行予定時刻を求める"""
+    if emit.cron is not None:
+        return _next_cron_deadline(emit.cron, loop)
+    if emit.mode == "after":
+        return loop.time() + interval
+    return _next_deadline(emit, bot, deadline, interval, loop.time())
 
 
 async def set_interval(emit: Emit, bot: Machina):
-    bot.logger.debug(f'Start emit task: "{emit.name}"')
+    bot.logger.debug('Start emit task: "%s"', emit.name)
+    loop = asyncio.get_running_loop()
     interval = interval_to_second(emit.interval)
-    previous_execution_time = 0.0
     epoch = 1
     count = emit.count
-    while count is None or count > 0:
-        # デバッグ用の変数
-        event = Event(
-            epoch=epoch,
-            previous_execution_time=previous_execution_time,
-            bot=bot,
-        )
-        # 引数の設定
-        args, kwargs = get_args(emit.func)
-        if "event" in args:
-            kwargs.update({"event": event})
-        # Dependsの実行
-        kwargs.update(await DependsContoroller.get_depends_result(emit.func))
-        start = perf_counter()
-        # 実行
-        await emit.func(**kwargs)
-        # 計測
-        previous_execution_time = perf_counter() - start
-        epoch += 1
-        if count is not None:
-            count -= 1
-            if count <= 0:
+    runner = _EmitRunner(emit)
+
+    emit.stalled = False
+    if emit.cron is not None:
+        await bot._sleep_until(_next_cron_deadline(emit.cron, loop))
+    deadline = loop.time()  # 今回の実行予定時刻
+    try:
+        while count is None or count > 0:
+            # デバッグ用の変数
+            event = Event(
+                epoch=epoch,
+                previous_execution_time=runner.previous_execution_time,
+                bot=bot,
+            )
+            await runner.run(event)
+            epoch += 1
+            if count is not None:
+                count -= 1
+                if count <= 0:
+                    break
+            if not emit.alive:
                 break
-        if not emit.alive:
-            break
-        # 待機
-        if emit.mode == "after":
-            await asyncio.sleep(interval)
-        else:
-            wait = interval - previous_execution_time
-            if wait < 0:
-                bot.logger.warning(f"指定されたインターバルより{-wait:.0f}秒以上遅延しています.")
-            await asyncio.sleep(0 if wait < 0 else wait)
+            # 待機
+            deadline = _following_deadline(emit, bot, deadline, interval, loop)
+            await bot._sleep_until(deadline)
+            runner.check()
+        await runner.join()
+    finally:
+        runner.cancel()
 
 
-async def execute_wrapper(execute: Execute, bot: Machina, *args, **kwargs):
+def _observe(execute: Execute, latency: float, error: bool):
+    instruments = execute.instruments
+    if instruments is not None:
+        instruments.duration.observe(latency)
+        (instruments.error if error else instruments.ok).inc()
+    for cg in execute.concurrent_groups:
+        cg.observe(latency, error)
+
+
+def _observe_coalesced(execute: Execute):
+    if execute.instruments is not None:
+        execute.instruments.coalesced.inc()
+
+
+def _observe_cache(execute: Execute, result: Literal["hit", "stale", "miss"]):
+    if execute.instruments is not None:
+        execute.instruments.cache[result].inc()
+
+
+def _observe_queue_wait(execute: Execute, job: Job):
+    if execute.instruments is not None:
+        execute.instruments.queue_wait.observe(asyncio.get_running_loop().time() - job.enqueued_at)
+
+
+def _observe_acquired(execute: Execute, wait: float):
+    for cg in execute.concurrent_groups:
+        if cg.instruments is not None:
+            cg.instruments.wait.observe(wait)
+            cg.instruments.in_flight.inc()
 
-    retry = execute.retry or (lambda func: func)
 
-    @retry
-    async def nest(concurrent_groups: list[ConcurrentGroup]):
-        if concurrent_groups != []:
-            async with concurrent_groups[0].semaphore:
-                return await nest(concurrent_groups[1:])
+def _observe_released(execute: Execute):
+    for cg in execute.concurrent_groups:
+        if cg.instruments is not None:
+            cg.instruments.in_flight.dec()
+
+
+class _NoTeardown:
+    """後処理が不要な場合にAsyncExitStackの代わりに使う"""
+
+    async def __aenter__(self) -> None:
+        return None
+
+    async def __aexit__(self, *exc_info) -> None:
+        return None
+
+
+_NO_TEARDOWN = _NoTeardown()
+
+
+def _acquire_breakers(breakers: list[CircuitBreaker]) -> list[int | None]:
+    """全てのbreakerの許可を取り、それぞれの試行番号を返す. 一つでも開いていれば取った試行枠を返却する"""
+    trials: list[int | None] = []
+    for breaker in breakers:
+        try:
+            trials.append(breaker.acquire())
+        except CircuitOpenError:
+            for acquired, trial in zip(breakers, trials):
+                acquired.cancel(trial)
+            raise
+    return trials
+
+
+def _record_breakers(breakers: list[CircuitBreaker], trials: list[int | None], error: bool | None):
+    for breaker, trial in zip(breakers, trials):
+        if error is None:
+            breaker.cancel(trial)
         else:
-            bot._execute_task_executings[execute.name] += 1
-            _t = len(bot._execute_tasks[execute.name])
-            _e = bot._execute_task_executings[execute.name]
-            bot.logger.debug(f'Start execute task: "{execute.name}" [tasks={_t}, executings={_e}]')
-            try:
+            breaker.record(error, trial)
+
+
+async def _acquire_semaphores(execute: Execute, bot: Machina):
+    """全てのconcurrent_groupの枠をまとめて取得する"""
+    start = perf_counter()
+    span = bot.tracer.start("acquire", execute.name)
+    try:
+        await acquire_all(execute.semaphores)
+    except BaseException as e:
+        bot.tracer.finish(span, e)
+        raise
+    bot.tracer.finish(span)
+    _observe_acquired(execute, perf_counter() - start)
+
+
+async def _run_execute(execute: Execute, bot: Machina, args: tuple, kwargs: dict):
+    semaphores = execute.semaphores
+    # サーキットブレーカーが開いているグループがあれば枠を取らずに失敗させる
+    trials = _acquire_breakers(execute.breakers)
+    error: bool | None = None  # 実行結果. Noneは実行まで至らなかったことを表す
+    try:
+        if semaphores:
+            await _acquire_semaphores(execute, bot)
+        bot._registry.start_execution(execute.name)
+        # ログを出さない場合は件数の集計も省く
+        if bot.logger.isEnabledFor(logging.DEBUG):
+            _t = bot._registry.count("execute", execute.name)
+            _e = bot._registry.executings(execute.name)
+            bot.logger.debug('Start execute task: "%s" [tasks=%d, executings=%d]', execute.name, _t, _e)
+        try:
+            # キャッシュしないgeneratorのDependsは実行後、枠を返却する前に後処理する
+            async with AsyncExitStack() if execute.plan.teardown else _NO_TEARDOWN as stack:
                 # Dependsの実行
-                kwargs.update(await DependsContoroller.get_depends_result(execute.func))
-                res = await execute.func(*args, **kwargs)
-            finally:
-                bot._execute_task_executings[execute.name] -= 1
-            return res
+                if execute.plan.depends:
+                    depends = await DependsContoroller.execute_plan(
+                        execute.plan, bot.tracer, bot.depends_cache, ("execute", execute.name), stack
+                    )
+                    kwargs.update(depends)
+                start = perf_counter()
+                try:
+                    res = await bot._call_execute(execute, *args, **kwargs)
+                except asyncio.CancelledError:
+                    raise
+                except BaseException:
+                    error = True
+                    _observe(execute, perf_counter() - start, True)
+                    raise
+                error = False
+                _observe(execute, perf_counter() - start, False)
+                return res
+        finally:
+            bot._registry.finish_execution(execute.name)
+            release_all(semaphores)
+            _observe_released(execute)
+    finally:
+        _record_breakers(execute.breakers, trials, error)
 
-    return await nest(execute.concurrent_groups)
+
+async def _run_execute_with_retry(execute: Execute, bot: Machina, args: tuple, kwargs: dict):
+    # requeueモードのリトライは_RequeuedExecuteが試行の外側で行う
+    if execute.retry is None or execute.retry.requeue:
+        return await _run_execute(execute, bot, args, kwargs)
+    return await execute.retry.call(_run_execute, execute, bot, args, kwargs)
+
+
+async def execute_wrapper(execute: Execute, bot: Machina, *args, **kwargs):
+    # ミドルウェアがない場合はSpanの作成を省く
+    if not bot.tracer.middlewares:
+        return await _run_execute_with_retry(execute, bot, args, kwargs)
+    with bot.tracer.span("execute", execute.name):
+        return await _run_execute_with_retry(execute, bot, args, kwargs)
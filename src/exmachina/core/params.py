@@ -2,13 +2,35 @@ from __future__ import annotations
 
 from typing import Any, Callable
 
+from . import exception as E
+
+try:
+    from typing import Literal  # type: ignore
+except ImportError:
+    from typing_extensions import Literal
+
+DependsScope = Literal["app", "emit", "execute", "iteration"]
+
 
 class Depends:
-    def __init__(self, dependency: Callable[..., Any], *, use_cache: bool = True):
+    def __init__(
+        self,
+        dependency: Callable[..., Any],
+        *,
+        use_cache: bool = True,
+        scope: DependsScope = "app",
+        ttl: float | None = None,
+    ):
+        if scope not in ("app", "emit", "execute", "iteration"):
+            raise E.MachinaException(f"scopeには'app', 'emit', 'execute', 'iteration'のいずれかを指定してください: [{scope}]")
         self.dependency = dependency
         self.use_cache = use_cache
+        self.scope: DependsScope = scope
+        self.ttl = ttl
 
     def __repr__(self) -> str:
         attr = getattr(self.dependency, "__name__", type(self.dependency).__name__)
         cache = "" if self.use_cache else ", use_cache=False"
-        return f"{self.__class__.__name__}({attr}{cache})"
+        scope = "" if self.scope == "app" else f", scope={self.scope!r}"
+        ttl = "" if self.ttl is None else f", ttl={self.ttl}"
+        return f"{self.__class__.__name__}({attr}{cache}{scope}{ttl})"
@@ -5,5 +5,24 @@ from typing import Any, Callable
 from . import params
 
 
-def Depends(dependency: Callable[..., Any], *, use_cache: bool = True) -> Any:  # noqa: N802
-    return params.Depends(dependency=dependency, use_cache=use_cache)
+def Depends(  # noqa: N802
+    dependency: Callable[..., Any],
+    *,
+    use_cache: bool = True,
+    scope: params.DependsScope = "app",
+    ttl: float | None = None,
+) -> Any:
+    """依存関係を宣言する
+
+    Args:
+        dependency (Callable[..., Any]): 引数に渡す値を返す関数
+        use_cache (bool, optional): 結果をscopeの範囲でキャッシュする. Defaults to True.
+        scope (Literal['app', 'emit', 'execute', 'iteration'], optional): キャッシュを共有する範囲. Defaults to "app".
+            app: botの全てのemitとexecute
+            emit: 同じemitの全ての実行. emitのDependsのみ指定できる
+            execute: 同じexecuteの全ての呼び出し. executeのDependsのみ指定できる
+            iteration: emitの一回の実行、またはexecuteの一回の呼び出しの間
+        ttl (float, optional): キャッシュの有効期間[sec]. Defaults to None. つまり、期限なし
+            iterationでは使わない
+    """
+    return params.Depends(dependency=dependency, use_cache=use_cache, scope=scope, ttl=ttl)
@@ -0,0 +1,389 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing.connection import Connection
+from typing import TYPE_CHECKING, Any, Callable
+
+from exmachina.lib.hash_ring import HashRing
+from exmachina.lib.helper import to_thread
+from exmachina.lib.rate_backend import SharedMemoryRateBackend
+from exmachina.lib.time_semaphore import GCRASemaphore
+
+from . import exception as E
+
+if TYPE_CHECKING:
+    from .machina import Machina
+
+# shardと親プロセスの間のメッセージ. 先頭の要素がコマンド
+#   shard -> 親: ("ready",), ("start", emit名), ("stop", emit名, force), ("idle", 受け取ったstartの数), ("done", 例外)
+#   親 -> shard: ("go", 開始するか), ("start", emit名), ("stop", emit名, force), ("exit",)
+
+
+def _share(value: int, index: int, workers: int) -> int:
+    """valueをworkers個に分けた時のindex番目の取り分"""
+    return value // workers + (1 if index < value % workers else 0)
+
+
+def _rate_key(token: str, index: int) -> str:
+    return f"{token}-{index}"
+
+
+def _shares_rate(semaphore: GCRASemaphore) -> bool:
+    """shard間で時間あたりの制限の状態を共有するために、shmのbackendを設定するかどうか"""
+    return semaphore._time_limit > 0 and semaphore.backend is None
+
+
+class Shard:
+    def __init__(self, bot: Machina, index: int, workers: int, conn: Connection, token: str):
+        """run(workers=N)で起動したプロセスの一つ. bot._shardに設定される
+
+        emitは名前のコンシステントハッシュで担当のshardを決め、担当のemitのみを実行する
+        executeは呼び出したshardで実行する
+
+        Args:
+            bot (Machina): fork元から引き継いだbot
+            index (int): 何番目のshardか
+            workers (int): shardの数
+            conn (Connection): 親プロセスとの通信路
+            token (str): 今回の起動で共有する状態の名前の接頭辞
+        """
+        self.bot = bot
+        self.index = index
+        self.workers = workers
+        self.token = token
+        self.received = 0  # 親プロセスから受け取ったstartの数
+        self._conn = conn
+        self._ring = HashRing(range(workers))
+
+    def owner(self, emit_name: str) -> int:
+        """emitを担当するshardの番号"""
+        return self._ring.get(emit_name)
+
+    def forward(self, *message: Any) -> bool:
+        """emitを担当するのが別のshardなら親プロセス経由でメッセージを送り、Trueを返す"""
+        emit_name = message[1]
+        if emit_name not in self.bot._emits:
+            raise E.MachinaException(f"emitsに存在しないnameを指定しています: [{emit_name}]")
+        if self.owner(emit_name) == self.index:
+            return False
+        self.send(*message)
+        return True
+
+    def send(self, *message: Any) -> None:
+        self._conn.send(message)
+
+    def configure(self, log_queue: Any) -> None:
+        """concurrent_groupの制限をshard間で分け合い、ログを親プロセスに送るようにする"""
+        bot = self.bot
+        for i, cg in enumerate(bot._concurrent_groups.values()):
+            semaphore = cg.semaphore
+            if isinstance(semaphore, GCRASemaphore) and _shares_rate(semaphore):
+                semaphore.backend = SharedMemoryRateBackend(_rate_key(self.token, i))
+            if cg.adaptive is not None:
+                adaptive = cg.adaptive
+                max_limit = _share(adaptive.max_limit, self.index, self.workers)
+                min_limit = min(max(1, _share(adaptive.min_limit, self.index, self.workers)), max_limit)
+                adaptive.min_limit, adaptive.max_limit = min_limit, max_limit
+                adaptive._limit = float(min(max(adaptive.limit // self.workers, min_limit), max_limit))
+                semaphore.resize(adaptive.limit)
+            elif semaphore.entire_calls_limit is not None:
+                semaphore.resize(_share(semaphore.entire_calls_limit, self.index, self.workers))
+        if bot.metrics_port is not None:
+            bot.metrics_port += self.index
+
+        logger = bot.logger
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        handler = QueueHandler(log_queue)
+        handler.addFilter(_ShardFilter(self.index))
+        logger.addHandler(handler)
+        logger.propagate = False
+
+    async def run(self) -> None:
+        """起動処理の後、親プロセスの合図で担当のemitを開始し、全てのshardが止まるまで待機する"""
+        bot = self.bot
+        loop = asyncio.get_running_loop()
+        self._go: asyncio.Future[bool] = loop.create_future()
+        self._exit: asyncio.Future[None] = loop.create_future()
+        self._wakeup = asyncio.Event()
+        loop.add_reader(self._conn.fileno(), self._on_message)
+        try:
+            try:
+                await bot._startup()
+            except Exception as e:
+                bot.logger.error("shard %d の起動に失敗しました", self.index, exc_info=True)
+                self.send("done", repr(e))
+                return
+            self.send("ready")
+
+            error = None
+            try:
+                if await self._go:
+                    await self._serve()
+            except Exception as e:
+                error = e
+            finally:
+                try:
+                    await bot._shutdown()
+                except Exception as e:
+                    error = error or e
+            self.send("done", None if error is None else repr(error))
+        finally:
+            loop.remove_reader(self._conn.fileno())
+
+    async def _serve(self) -> None:
+        bot = self.bot
+        for emit in bot._emits.values():
+            if emit.alive and self.owner(emit.name) == self.index:
+                bot._add_emit_task(emit.name)
+
+        while not self._exit.done():
+            if len(bot._registry) == 0:
+                # 別のshardからstartが届くかもしれないので、親プロセスが終了を指示するまで待つ
+                self.send("idle", self.received)
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            else:
+                bot._finished.clear()
+                await bot._finished.wait()
+        for task in bot._emit_tasks.values():
+            await task
+
+    def _on_message(self) -> None:
+        try:
+            message = self._conn.recv()
+        except EOFError:
+            # 親プロセスが終了した
+            asyncio.get_running_loop().remove_reader(self._conn.fileno())
+            self._on_exit()
+            return
+
+        command = message[0]
+        if command == "go":
+            self._go.set_result(message[1])
+        elif command == "start":
+            self.received += 1
+            self.bot._add_emit_task(message[1])
+            self._wakeup.set()
+        elif command == "stop":
+            self.bot._stop_emit(message[1], message[2])
+        elif command == "exit":
+            self._on_exit()
+
+    def _on_exit(self) -> None:
+        if not self._go.done():
+            self._go.set_result(False)
+        if not self._exit.done():
+            self._exit.set_result(None)
+        for task in self.bot._emit_tasks.values():
+            task.cancel()
+        self._wakeup.set()
+
+
+class _ShardFilter(logging.Filter):
+    def __init__(self, index: int):
+        super().__init__()
+        self.index = index
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.shard = self.index
+        return True
+
+
+class _LogDispatcher(logging.Handler):
+    """shardから受け取ったログを親プロセスの同名のloggerで処理する"""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+
+def _shard_main(
+    bot: Machina, index: int, workers: int, conn: Connection, log_queue: Any, token: str, inherited: list[Connection]
+) -> None:
+    # 先に起動したshardとの通信路の親プロセス側の端を引き継いでいるので閉じる
+    # 閉じないと、親プロセスが異常終了してもそれらのshardにEOFが届かない
+    for other in inherited:
+        other.close()
+    # Ctrl+Cは親プロセスが受け取り、exitで各shardを止める
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # forkした時点で実行中だった親プロセスのイベントループを引き継がない
+    asyncio.events._set_running_loop(None)
+    shard = Shard(bot, index, workers, conn, token)
+    bot._shard = shard
+    shard.configure(log_queue)
+    try:
+        asyncio.run(shard.run())
+    finally:
+        conn.close()
+
+
+class _Supervisor:
+    def __init__(self, workers: int):
+        """親プロセス側でshardのメッセージを中継し、起動と終了をまとめる"""
+        self.conns: list[Connection] = []  # 起動したshardとの通信路
+        self.processes: list[Any] = []
+        self.workers = workers
+        self.exiting = False  # exitを送った後に起動したshardにもexitを送る
+        self.forwarded = [0] * self.workers  # shard毎の転送したstartの数
+        self.idle = [False] * self.workers
+        self.ready: set[int] = set()
+        self.done: dict[int, str | None] = {}  # 終了したshard -> 例外
+        self.finished: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._ring = HashRing(range(self.workers))
+
+    def send(self, index: int, *message: Any) -> None:
+        if index in self.done:
+            return
+        try:
+            self.conns[index].send(message)
+        except OSError:
+            pass
+
+    def add(self, conn: Connection, process: Any) -> None:
+        """起動したshardのメッセージと終了を監視する"""
+        index = len(self.conns)
+        self.conns.append(conn)
+        self.processes.append(process)
+        loop = asyncio.get_running_loop()
+        loop.add_reader(conn.fileno(), self.on_message, index)
+        loop.add_reader(process.sentinel, self.on_exit, index)
+        if self.exiting:
+            self.send(index, "exit")
+
+    def broadcast(self, *message: Any) -> None:
+        for index in range(len(self.conns)):
+            self.send(index, *message)
+
+    def exit(self) -> None:
+        """全てのshardを止める"""
+        self.exiting = True
+        self.broadcast("exit")
+
+    def on_exit(self, index: int) -> None:
+        """shardのプロセスが終了した. doneを送らずに終了した場合(SIGKILLなど)は異常終了として扱う"""
+        asyncio.get_running_loop().remove_reader(self.processes[index].sentinel)
+        conn = self.conns[index]
+        # 終了する前に送られたメッセージを先に処理する
+        while index not in self.done and conn.poll():
+            self.on_message(index)
+        if index not in self.done:
+            asyncio.get_running_loop().remove_reader(conn.fileno())
+            self.on_message(index, ("done", "shardのプロセスが異常終了しました"))
+
+    def on_message(self, index: int, message: Any = None) -> None:
+        if message is None:
+            try:
+                message = self.conns[index].recv()
+            except EOFError:
+                asyncio.get_running_loop().remove_reader(self.conns[index].fileno())
+                message = ("done", "shardのプロセスが異常終了しました")
+
+        handlers: dict[str, Callable[..., None]] = {
+            "ready": self._on_ready,
+            "start": self._on_forward,
+            "stop": self._on_forward,
+            "idle": self._on_idle,
+            "done": self._on_done,
+        }
+        handler = handlers.get(message[0])
+        if handler is not None:
+            handler(index, *message)
+
+    def _on_ready(self, index: int, command: str) -> None:
+        self.ready.add(index)
+        if len(self.ready) == self.workers:
+            self.broadcast("go", True)
+
+    def _on_forward(self, index: int, command: str, emit_name: str, *args: Any) -> None:
+        """start/stopをemitを担当するshardへ転送する"""
+        owner = self._ring.get(emit_name)
+        if command == "start":
+            self.forwarded[owner] += 1
+            self.idle[owner] = False
+        self.send(owner, command, emit_name, *args)
+
+    def _on_idle(self, index: int, command: str, received: int) -> None:
+        # 転送したstartを全て受け取った後のidleのみ有効
+        self.idle[index] = received == self.forwarded[index]
+        if all(self.idle):
+            self.exit()
+
+    def _on_done(self, index: int, command: str, error: str | None) -> None:
+        if index in self.done:
+            return
+        self.done[index] = error
+        if error is not None:
+            # 一つのshardが失敗したら全て止める
+            self.exit()
+        if len(self.done) == self.workers and not self.finished.done():
+            self.finished.set_result(None)
+
+
+def validate(bot: Machina, workers: int) -> None:
+    """concurrent_groupの制限をshard間で分け合えるか確認する"""
+    if workers < 1:
+        raise E.MachinaException("workersは1以上を指定してください")
+    for cg in bot._concurrent_groups.values():
+        semaphore = cg.semaphore
+        if semaphore._time_limit > 0 and not isinstance(semaphore, GCRASemaphore):
+            raise E.MachinaException(
+                f"workersを指定する場合、time_limitを指定したconcurrent_groupはengine='gcra'にしてください: [{cg.name}]"
+            )
+        if cg.adaptive is not None:
+            if cg.adaptive.max_limit < workers:
+                raise E.MachinaException(f"adaptiveのmax_limitはworkers以上にしてください: [{cg.name}]")
+        elif semaphore.entire_calls_limit is not None and semaphore.entire_calls_limit < workers:
+            raise E.MachinaException(f"entire_calls_limitはworkers以上にしてください: [{cg.name}]")
+
+
+async def run_sharded(bot: Machina, workers: int) -> None:
+    """botをworkers個のプロセスにforkして実行し、全てのshardが停止するまで待機する"""
+    validate(bot, workers)
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        raise E.MachinaException("workersはforkが使える環境でのみ指定できます")
+
+    loop = asyncio.get_running_loop()
+    token = f"shard-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    log_queue = context.Queue()
+    listener = QueueListener(log_queue, _LogDispatcher())
+    listener.start()
+    supervisor = _Supervisor(workers)
+    try:
+        for index in range(workers):
+            # 通信路はforkの直前に作り、後から起動するshardが別のshardの子プロセス側の端を持たないようにする
+            # 持っていると、そのshardが異常終了してもEOFが届かない
+            parent, child = context.Pipe()
+            process = context.Process(
+                target=_shard_main,
+                args=(bot, index, workers, child, log_queue, token, list(supervisor.conns)),
+                name=f"exmachina-shard-{index}",
+                daemon=True,
+            )
+            process.start()
+            child.close()
+            supervisor.add(parent, process)
+        await supervisor.finished
+    finally:
+        supervisor.exit()
+        for process in supervisor.processes:
+            await to_thread(process.join)
+            loop.remove_reader(process.sentinel)
+        for conn in supervisor.conns:
+            loop.remove_reader(conn.fileno())
+            conn.close()
+        listener.stop()
+        for i, cg in enumerate(bot._concurrent_groups.values()):
+            if isinstance(cg.semaphore, GCRASemaphore) and _shares_rate(cg.semaphore):
+                SharedMemoryRateBackend(_rate_key(token, i)).unlink()
+
+    errors = [f"shard {index}: {error}" for index, error in sorted(supervisor.done.items()) if error is not None]
+    if errors:
+        raise E.MachinaException("shardで例外が発生しました. " + ", ".join(errors))
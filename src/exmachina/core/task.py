@@ -1,9 +1,107 @@
 from __future__ import annotations
 
 import asyncio
-from dataclasses import dataclass, field
+from collections import defaultdict
+from dataclasses import dataclass
 
+try:
+    from typing import Literal  # type: ignore
+except ImportError:
+    from typing_extensions import Literal
 
-@dataclass
-class TaskManager:
-    emit_tasks: dict[str, asyncio.Task] = field(default_factory=dict)
+TaskKind = Literal["emit", "execute"]
+
+
+@dataclass(frozen=True)
+class TaskStats:
+    tasks: int  # 生存中(待機中+実行中)のタスク数
+    executings: int  # 実行中のタスク数
+
+
+@dataclass(frozen=True)
+class MachinaStats:
+    emits: int  # 生存中のemitのタスク数
+    executes: int  # 生存中のexecuteのタスク数
+    executings: int  # 実行中のexecuteのタスク数
+    by_execute: dict[str, TaskStats]  # execute毎の内訳
+
+
+class TaskRegistry:
+    """生存中のemit/executeのタスクを管理するレジストリ
+
+    タスクの追加と削除、件数の取得はO(1)で行える
+    """
+
+    def __init__(self) -> None:
+        self._tasks: dict[int, tuple[TaskKind, str, asyncio.Future]] = {}
+        self._by_name: dict[tuple[TaskKind, str], dict[int, asyncio.Future]] = defaultdict(dict)
+        self._counts: dict[TaskKind, int] = defaultdict(int)
+        self._executings: dict[str, int] = defaultdict(int)
+        self._total_executings = 0
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def add(self, kind: TaskKind, name: str, task: asyncio.Future) -> int:
+        """タスクを登録する
+
+        Returns:
+            int: タスクのid
+        """
+        task_id = id(task)
+        self._tasks[task_id] = (kind, name, task)
+        self._by_name[(kind, name)][task_id] = task
+        self._counts[kind] += 1
+        return task_id
+
+    def remove(self, task: asyncio.Future) -> None:
+        """登録済みのタスクを削除する、未登録の場合は何もしない"""
+        task_id = id(task)
+        entry = self._tasks.pop(task_id, None)
+        if entry is None:
+            return
+        kind, name, _ = entry
+        tasks = self._by_name[(kind, name)]
+        del tasks[task_id]
+        if not tasks:
+            del self._by_name[(kind, name)]
+        self._counts[kind] -= 1
+
+    def get(self, task_id: int) -> asyncio.Future | None:
+        entry = self._tasks.get(task_id)
+        return None if entry is None else entry[2]
+
+    def tasks(self, kind: TaskKind, name: str | None = None) -> list[asyncio.Future]:
+        if name is None:
+            return [task for _kind, _, task in self._tasks.values() if _kind == kind]
+        return list(self._by_name.get((kind, name), {}).values())
+
+    def count(self, kind: TaskKind, name: str | None = None) -> int:
+        if name is None:
+            return self._counts[kind]
+        return len(self._by_name.get((kind, name), ()))
+
+    def executings(self, name: str | None = None) -> int:
+        if name is None:
+            return self._total_executings
+        return self._executings.get(name, 0)
+
+    def start_execution(self, name: str) -> None:
+        self._executings[name] += 1
+        self._total_executings += 1
+
+    def finish_execution(self, name: str) -> None:
+        self._executings[name] -= 1
+        self._total_executings -= 1
+        if self._executings[name] == 0:
+            del self._executings[name]
+
+    def stats(self, names: list[str]) -> MachinaStats:
+        return MachinaStats(
+            emits=self._counts["emit"],
+            executes=self._counts["execute"],
+            executings=self._total_executings,
+            by_execute={
+                name: TaskStats(tasks=self.count("execute", name), executings=self.executings(name)) for name in names
+            },
+        )
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import math
+from abc import ABC, abstractmethod
+
+
+class AdaptiveLimit(ABC):
+    def __init__(self, *, initial_limit: int, min_limit: int = 1, max_limit: int = 1000):
+        """観測した処理時間とエラーから並列実行数の上限を調整するアルゴリズムの基底クラス
+
+        Args:
+            initial_limit (int): 初期の並列実行数
+            min_limit (int, optional): 並列実行数の下限. Defaults to 1.
+            max_limit (int, optional): 並列実行数の上限. Defaults to 1000.
+        """
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError("1 <= min_limit <= initial_limit <= max_limit となるように指定してください")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self._limit = float(initial_limit)
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def update(self, latency: float, error: bool) -> int:
+        """一回の実行結果を反映して新しい並列実行数を返す
+
+        Args:
+            latency (float): 実行時間[sec]
+            error (bool): 例外が発生したかどうか
+
+        Returns:
+            int: 新しい並列実行数
+        """
+        limit = self._next_limit(latency, error)
+        self._limit = min(max(limit, self.min_limit), self.max_limit)
+        return self.limit
+
+    @abstractmethod
+    def _next_limit(self, latency: float, error: bool) -> float:
+        raise NotImplementedError
+
+
+class AIMD(AdaptiveLimit):
+    def __init__(
+        self,
+        *,
+        initial_limit: int,
+        min_limit: int = 1,
+        max_limit: int = 1000,
+        increase: float = 1.0,
+        backoff: float = 0.9,
+        latency_threshold: float | None = None,
+    ):
+        """AIMD(Additive Increase Multiplicative Decrease)で並列実行数を調整する
+
+        成功するたびに 並列実行数あたりincrease ずつ増やし(おおよそ並列実行数分の成功で+increase)、
+        エラーかlatency_thresholdを超える処理時間を観測した時にbackoff倍に減らす
+
+        Args:
+            initial_limit (int): 初期の並列実行数
+            min_limit (int, optional): 並列実行数の下限. Defaults to 1.
+            max_limit (int, optional): 並列実行数の上限. Defaults to 1000.
+            increase (float, optional): 増加量. Defaults to 1.0.
+            backoff (float, optional): 減少時の倍率. Defaults to 0.9.
+            latency_threshold (float, optional): 遅延とみなす処理時間[sec]. Defaults to None. つまり、エラーのみで減らす
+        """
+        if not 0 < backoff < 1:
+            raise ValueError("backoffは0より大きく1より小さい値を指定してください")
+        super().__init__(initial_limit=initial_limit, min_limit=min_limit, max_limit=max_limit)
+        self.increase = increase
+        self.backoff = backoff
+        self.latency_threshold = latency_threshold
+
+    def _next_limit(self, latency: float, error: bool) -> float:
+        if error or (self.latency_threshold is not None and latency > self.latency_threshold):
+            return self._limit * self.backoff
+        return self._limit + self.increase / self._limit
+
+
+class Gradient(AdaptiveLimit):
+    def __init__(
+        self,
+        *,
+        initial_limit: int,
+        min_limit: int = 1,
+        max_limit: int = 1000,
+        smoothing: float = 0.2,
+        tolerance: float = 1.5,
+        long_window: int = 600,
+        backoff: float = 0.9,
+    ):
+        """処理時間の長期平均と直近の値の比(勾配)で並列実行数を調整する
+
+        直近の処理時間が長期平均のtolerance倍以内であれば増やし、それを超えて遅くなると比に応じて減らす
+        エラーを観測した時はbackoff倍に減らす
+
+        Args:
+            initial_limit (int): 初期の並列実行数
+            min_limit (int, optional): 並列実行数の下限. Defaults to 1.
+            max_limit (int, optional): 並列実行数の上限. Defaults to 1000.
+            smoothing (float, optional): 新しい並列実行数を反映する割合. Defaults to 0.2.
+            tolerance (float, optional): 長期平均に対して許容する処理時間の倍率. Defaults to 1.5.
+            long_window (int, optional): 長期平均に使うおおよそのサンプル数. Defaults to 600.
+            backoff (float, optional): エラー時の倍率. Defaults to 0.9.
+        """
+        super().__init__(initial_limit=initial_limit, min_limit=min_limit, max_limit=max_limit)
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self._long_alpha = 2 / (long_window + 1)
+        self._long_latency: float | None = None
+
+    def _next_limit(self, latency: float, error: bool) -> float:
+        if error:
+            return self._limit * self.backoff
+        if self._long_latency is None:
+            self._long_latency = latency
+        else:
+            self._long_latency += (latency - self._long_latency) * self._long_alpha
+        if latency <= 0:
+            return self._limit
+
+        gradient = max(0.5, min(1.0, self.tolerance * self._long_latency / latency))
+        # 待ち行列の余裕として並列実行数の平方根だけ上乗せする
+        new_limit = self._limit * gradient + math.sqrt(self._limit)
+        return self._limit * (1 - self.smoothing) + new_limit * self.smoothing
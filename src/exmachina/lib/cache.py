@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Awaitable, Callable, Coroutine, Hashable
+
+MISSING: Any = object()  # キャッシュにないことを表す値
+Finalizer = Callable[[], Coroutine[Any, Any, None]]
+
+
+class TTLCache:
+    def __init__(self, *, maxsize: int | None = 1024):
+        """有効期限とLRUによる削除を持つキャッシュ
+
+        get_or_createでは同じキーの計算が実行中なら新たに計算せず、その結果を待つ(single-flight)
+        set_finalizerで登録した後処理は、期限切れや上限を超えたことで値が削除された時にタスクとして実行する
+
+        Args:
+            maxsize (int, optional): 保持する最大の件数. 超えると最も長く使われていないものから削除する.
+                Defaults to 1024. Noneの場合は無制限
+        """
+        if maxsize is not None and maxsize < 1:
+            raise ValueError("maxsizeは1以上を指定してください")
+        self.maxsize = maxsize
+        self._data: OrderedDict[Hashable, tuple[Any, float | None]] = OrderedDict()  # キー -> (値, 有効期限)
+        self._pending: dict[Hashable, asyncio.Future] = {}  # 計算中のキー -> 結果
+        self._finalizers: dict[Hashable, Finalizer] = {}  # キー -> 値が削除された時の後処理
+        self._closing: set[asyncio.Task] = set()  # 実行中の後処理
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not MISSING
+
+    def get(self, key: Hashable) -> Any:
+        """有効な値を取得する. ない場合はMISSINGを返す"""
+        item = self._data.get(key)
+        if item is None:
+            return MISSING
+        if item[1] is not None and item[1] <= monotonic():
+            del self._data[key]
+            self._finalize(key)
+            return MISSING
+        self._data.move_to_end(key)
+        return item[0]
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        """値を登録する
+
+        Args:
+            ttl (float, optional): 有効期間[sec]. Defaults to None. つまり、削除されるまで有効
+        """
+        self._data[key] = (value, None if ttl is None else monotonic() + ttl)
+        self._data.move_to_end(key)
+        if self.maxsize is not None and len(self._data) > self.maxsize:
+            evicted, _ = self._data.popitem(last=False)
+            self._finalize(evicted)
+
+    def set_finalizer(self, key: Hashable, finalizer: Finalizer) -> None:
+        """keyの値が削除された時に実行する後処理を登録する. 値を登録する前に登録してもよい"""
+        self._finalizers[key] = finalizer
+
+    def discard(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+        self._finalize(key)
+
+    def clear(self) -> None:
+        """全ての値を削除する. 後処理はタスクとして実行する"""
+        self._data.clear()
+        for key in list(self._finalizers):
+            self._finalize(key)
+
+    async def aclose(self) -> None:
+        """全ての値を削除し、後処理を登録の逆順に実行して終了を待つ
+
+        後処理の例外はloopのexception handlerに渡し、残りの後処理は続行する
+        """
+        self._data.clear()
+        finalizers, self._finalizers = self._finalizers, {}
+        for finalizer in reversed(list(finalizers.values())):
+            try:
+                await finalizer()
+            except Exception as e:
+                _report(e)
+        if self._closing:
+            await asyncio.wait(self._closing)
+
+    def _finalize(self, key: Hashable) -> None:
+        finalizer = self._finalizers.pop(key, None)
+        if finalizer is None:
+            return
+        task = asyncio.get_running_loop().create_task(finalizer())
+        self._closing.add(task)
+        task.add_done_callback(self._on_finalized)
+
+    def _on_finalized(self, task: asyncio.Task) -> None:
+        self._closing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            _report(task.exception())  # type: ignore
+
+    async def get_or_create(
+        self, key: Hashable, factory: Callable[[], Awaitable[Any]], ttl: float | None = None
+    ) -> Any:
+        """値を取得し、なければfactoryで計算して登録する
+
+        同じキーの計算が実行中の場合はその結果を待つ
+        計算が例外で終わった場合は待っていた全ての呼び出しに送出し、登録しない
+        計算していた呼び出しがキャンセルされた場合は、待っていた呼び出しのうち一つが計算し直す
+        """
+        while True:
+            value = self.get(key)
+            if value is not MISSING:
+                return value
+            pending = self._pending.get(key)
+            if pending is None:
+                break
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await factory()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 待っている呼び出しがなくても警告を出さないようにする
+            future.exception()
+            raise
+        else:
+            self.set(key, value, ttl)
+            future.set_result(value)
+            return value
+        finally:
+            del self._pending[key]
+
+
+def _report(e: BaseException) -> None:
+    asyncio.get_running_loop().call_exception_handler({"message": "キャッシュの後処理で例外が発生しました", "exception": e})
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import math
+from time import monotonic
+
+try:
+    from typing import Literal  # type: ignore
+except ImportError:
+    from typing_extensions import Literal
+
+CircuitState = Literal["closed", "open", "half_open"]
+
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーが開いているため実行しなかったことを表す例外"""
+
+    def __init__(self, name: str, retry_after: float):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"サーキットブレーカー({name})が開いています: {retry_after:.1f}秒後に再開します")
+
+
+class RetryBudget:
+    def __init__(self, *, ratio: float = 0.2, min_retries: int = 10, window: float = 10.0, buckets: int = 10):
+        """直近の呼び出し数に対する割合でリトライ回数を制限する予算
+
+        直近window秒間のリトライ回数が min_retries + 呼び出し回数 * ratio 未満の間だけリトライを許可する
+        複数のRetryで共有すると、それらの合計で制限される
+
+        Args:
+            ratio (float, optional): 呼び出し回数に対して許可するリトライ回数の割合. Defaults to 0.2.
+            min_retries (int, optional): 呼び出し回数によらず許可するリトライ回数. Defaults to 10.
+            window (float, optional): 集計する期間[sec]. Defaults to 10.0.
+            buckets (int, optional): windowの分割数. Defaults to 10.
+        """
+        if ratio < 0 or min_retries < 0:
+            raise ValueError("ratioとmin_retriesは0以上を指定してください")
+        if window <= 0 or buckets < 1:
+            raise ValueError("windowは0より大きく、bucketsは1以上を指定してください")
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._width = window / buckets
+        self._calls = [0] * buckets
+        self._retries = [0] * buckets
+        self._epochs = [-1] * buckets  # 各バケットが集計している期間の番号
+
+    def _bucket(self) -> int:
+        epoch = math.floor(monotonic() / self._width)
+        i = epoch % len(self._epochs)
+        if self._epochs[i] != epoch:
+            self._epochs[i] = epoch
+            self._calls[i] = 0
+            self._retries[i] = 0
+        return i
+
+    def _totals(self) -> tuple[int, int]:
+        oldest = math.floor(monotonic() / self._width) - len(self._epochs)
+        calls = retries = 0
+        for i, epoch in enumerate(self._epochs):
+            if epoch > oldest:
+                calls += self._calls[i]
+                retries += self._retries[i]
+        return calls, retries
+
+    def remaining(self) -> int:
+        """今リトライできる回数"""
+        calls, retries = self._totals()
+        return max(0, math.floor(self.min_retries + calls * self.ratio) - retries)
+
+    def record_call(self) -> None:
+        """呼び出しを記録する"""
+        self._calls[self._bucket()] += 1
+
+    def try_retry(self) -> bool:
+        """予算が残っていればリトライを記録してTrueを返す"""
+        if self.remaining() <= 0:
+            return False
+        self._retries[self._bucket()] += 1
+        return True
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        *,
+        name: str = "default",
+        failure_threshold: int = 5,
+        recovery_time: float = 30.0,
+        half_open_calls: int = 1,
+    ):
+        """連続した失敗を検知して呼び出しを一時的に止めるサーキットブレーカー
+
+        closed: 通常状態. failure_threshold回連続で失敗するとopenになる
+        open: 呼び出しをCircuitOpenErrorで即座に失敗させる. recovery_time秒経過するとhalf_openになる
+        half_open: half_open_calls回まで試しに呼び出し、全て成功するとclosed、一度でも失敗するとopenに戻る
+
+        Args:
+            name (str, optional): ログや例外に表示する名前. Defaults to "default".
+            failure_threshold (int, optional): openになる連続失敗回数. Defaults to 5.
+            recovery_time (float, optional): openからhalf_openになるまでの時間[sec]. Defaults to 30.0.
+            half_open_calls (int, optional): half_openで試す呼び出しの数. Defaults to 1.
+        """
+        if failure_threshold < 1 or half_open_calls < 1:
+            raise ValueError("failure_thresholdとhalf_open_callsは1以上を指定してください")
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.half_open_calls = half_open_calls
+        self._state: CircuitState = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trials = 0  # half_openで実行中の試行数
+        self._successes = 0  # half_openで成功した試行数
+        self._half_opens = 0  # half_openになった回数. 試行がどのhalf_openで許可されたかを区別する
+
+    @property
+    def state(self) -> CircuitState:
+        if self._state == "open" and monotonic() - self._opened_at >= self.recovery_time:
+            self._state = "half_open"
+            self._trials = 0
+            self._successes = 0
+            self._half_opens += 1
+        return self._state
+
+    def acquire(self) -> int | None:
+        """呼び出し前に確認する
+
+        Raises:
+            CircuitOpenError: openか、half_openで試行数の上限に達している場合
+
+        Returns:
+            int | None: half_openの試行として許可した場合はその試行の番号、closedで許可した場合はNone
+                record, cancelにそのまま渡す
+        """
+        state = self.state
+        if state == "closed":
+            return None
+        if state == "half_open" and self._trials + self._successes < self.half_open_calls:
+            self._trials += 1
+            return self._half_opens
+        retry_after = max(0.0, self._opened_at + self.recovery_time - monotonic())
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record(self, error: bool, trial: int | None = None) -> None:
+        """acquireした呼び出しの結果を記録する
+
+        half_openの間は、今のhalf_openで試行として許可した呼び出しの結果だけを数える
+
+        Args:
+            error (bool): 失敗したかどうか
+            trial (int, optional): acquireの戻り値. Defaults to None.
+        """
+        if self._state == "half_open":
+            if not self._is_trial(trial):
+                # closedの間や前回のhalf_openで許可された呼び出しは試行数に含まれていない
+                return
+            self._trials -= 1
+            if error:
+                self._open()
+                return
+            self._successes += 1
+            if self._successes >= self.half_open_calls:
+                self._state = "closed"
+                self._failures = 0
+            return
+        if not error:
+            self._failures = 0
+            return
+        self._failures += 1
+        if self._state == "closed" and self._failures >= self.failure_threshold:
+            self._open()
+
+    def cancel(self, trial: int | None = None) -> None:
+        """acquireした呼び出しが結果を得ずに終わった場合に試行枠を返却する
+
+        Args:
+            trial (int, optional): acquireの戻り値. Defaults to None.
+        """
+        if self._is_trial(trial):
+            self._trials -= 1
+
+    def _is_trial(self, trial: int | None) -> bool:
+        return self._state == "half_open" and trial == self._half_opens
+
+    def _open(self) -> None:
+        self._state = "open"
+        self._opened_at = monotonic()
+        self._failures = 0
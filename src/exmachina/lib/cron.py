@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+
+# (最小値, 最大値)
+_FIELDS = {
+    "minute": (0, 59),
+    "hour": (0, 23),
+    "day": (1, 31),
+    "month": (1, 12),
+    "weekday": (0, 7),
+}
+
+_ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+
+
+def _parse_field(value: str, name: str) -> frozenset[int]:
+    low, high = _FIELDS[name]
+    values: set[int] = set()
+    for part in value.split(","):
+        step = 1
+        if "/" in part:
+            part, _step = part.split("/", 1)
+            step = int(_step)
+            if step < 1:
+                raise ValueError
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            _start, _end = part.split("-", 1)
+            start, end = int(_start), int(_end)
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if not low <= start <= end <= high:
+            raise ValueError
+        values.update(range(start, end + 1, step))
+    if name == "weekday" and 7 in values:
+        # 日曜日は0と7のどちらでも指定できる
+        values.discard(7)
+        values.add(0)
+    return frozenset(values)
+
+
+class Cron:
+    def __init__(self, expression: str):
+        """cron形式の実行スケジュール
+
+        "分 時 日 月 曜日" の5つのフィールドを空白区切りで指定する
+        各フィールドには * , - / を使える. 曜日は0(日曜日)から6(土曜日)で、7も日曜日として扱う
+        日と曜日の両方を指定した場合はcronと同様にどちらかに一致すれば実行する
+        @hourly, @daily, @weekly, @monthly, @yearly も指定できる
+
+        Args:
+            expression (str): cron形式の文字列. 例: "*/5 9-17 * * 1-5"
+
+        Raises:
+            ValueError: 解析できなかったときの例外
+        """
+        self.expression = expression
+        fields = _ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != len(_FIELDS):
+            raise ValueError(f'cronは"分 時 日 月 曜日"の5つのフィールドで指定してください。入力: "{expression}"')
+        try:
+            self.minutes, self.hours, self.days, self.months, self.weekdays = (
+                _parse_field(value, name) for value, name in zip(fields, _FIELDS)
+            )
+        except ValueError:
+            raise ValueError(f'cronの値が不正です。入力: "{expression}"') from None
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def __repr__(self) -> str:
+        return f"Cron({self.expression!r})"
+
+    def _match_day(self, dt: datetime) -> bool:
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next(self, dt: datetime) -> datetime:
+        """dtより後で最初にスケジュールに一致する時刻を返す
+
+        Args:
+            dt (datetime): 基準の時刻
+
+        Returns:
+            datetime: 次の実行時刻(秒以下は0)
+        """
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # 閏年の2/29のみのような指定でも見つかるように、5年分を探索する
+        limit = dt + timedelta(days=366 * 5)
+        while dt <= limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+                continue
+            if not self._match_day(dt):
+                dt = (dt + timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if dt.hour not in self.hours:
+                dt = (dt + timedelta(hours=1)).replace(minute=0)
+                continue
+            if dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+                continue
+            return dt
+        raise ValueError(f'cronに一致する時刻がありません。入力: "{self.expression}"')
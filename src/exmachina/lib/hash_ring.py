@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import bisect
+import hashlib
+from typing import Generic, Hashable, Iterable, TypeVar
+
+T = TypeVar("T", bound=Hashable)
+
+
+def _hash(key: str) -> int:
+    # hash()はプロセス毎に値が変わるので、プロセス間で一致するハッシュを使う
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing(Generic[T]):
+    def __init__(self, nodes: Iterable[T], *, replicas: int = 64):
+        """コンシステントハッシュでキーをノードに割り当てる
+
+        ノードを追加・削除しても、割り当てが変わるキーは全体の 1 / ノード数 程度に収まる
+        ハッシュはプロセスに依存しないので、どのプロセスで計算しても同じノードになる
+
+        Args:
+            nodes (Iterable): ノード. str()が一意になる値を指定する
+            replicas (int, optional): 1ノードあたりのリング上の点の数. 多いほど偏りが小さくなる. Defaults to 64.
+        """
+        if replicas < 1:
+            raise ValueError("replicasは1以上を指定してください")
+        self.replicas = replicas
+        self._points: list[int] = []
+        self._nodes: list[T] = []
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self) -> int:
+        return len(set(self._nodes))
+
+    def add(self, node: T) -> None:
+        for i in range(self.replicas):
+            point = _hash(f"{node}#{i}")
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._nodes.insert(index, node)
+
+    def remove(self, node: T) -> None:
+        pairs = [(p, n) for p, n in zip(self._points, self._nodes) if n != node]
+        self._points = [p for p, _ in pairs]
+        self._nodes = [n for _, n in pairs]
+
+    def get(self, key: str) -> T:
+        """keyを担当するノードを取得する"""
+        if not self._points:
+            raise LookupError("ノードが登録されていません")
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._nodes[index]
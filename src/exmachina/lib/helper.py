@@ -3,8 +3,10 @@ from __future__ import annotations
 import asyncio
 import contextvars
 import functools
+import importlib
 import inspect
 import re
+from concurrent.futures import Executor
 from typing import Any, Callable, Coroutine
 
 _times = dict(d=86400.0, h=3600.0, m=60.0, s=1.0, ms=0.001)
@@ -50,10 +52,30 @@ async def to_thread(func, *args, **kwargs):
 
     Return a coroutine that can be awaited to get the eventual result of *func*.
     """
+    return await run_in_executor(None, func, *args, **kwargs)
+
+
+async def run_in_executor(executor: Executor | None, func, *args, **kwargs):
+    """Asynchronously run function *func* in a thread of *executor*.
+
+    Same as :func:`to_thread`, but the thread pool can be specified.
+    If *executor* is None, the default executor of the loop is used.
+    """
     loop = asyncio.get_running_loop()
     ctx = contextvars.copy_context()
     func_call = functools.partial(ctx.run, func, *args, **kwargs)
-    return await loop.run_in_executor(None, func_call)
+    return await loop.run_in_executor(executor, func_call)
+
+
+def call_by_name(module: str, qualname: str, args: tuple[Any, ...], kwargs: dict[str, Any]) -> Any:
+    """モジュール名と修飾名から関数を取得して呼び出す
+
+    デコレートされて元の関数をpickleできない場合でも、別プロセスで元の関数を呼び出すために使う
+    """
+    obj: Any = importlib.import_module(module)
+    for name in qualname.split("."):
+        obj = getattr(obj, name)
+    return inspect.unwrap(obj)(*args, **kwargs)
 
 
 async def execute_functions(funcs: list[Callable[[], Coroutine[Any, Any, None]] | Callable[[], None]]):
@@ -0,0 +1,16 @@
+from __future__ import annotations
+
+import logging
+from logging.handlers import QueueHandler
+
+
+class RecordQueueHandler(QueueHandler):
+    """同じプロセスのQueueListenerにLogRecordをそのまま渡すQueueHandler
+
+    QueueHandler.prepareはプロセス間で送れるようにメッセージを整形し、argsとexc_infoを消してしまう
+    同じプロセスのスレッドで処理する場合は不要な上に、RichHandlerがトレースバックを描画できなくなるので、
+    整形はリスナー側のハンドラーに任せる
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+import asyncio
+import math
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Any, Callable, Generic, TypeVar, Union
+
+try:
+    from typing import Literal  # type: ignore
+except ImportError:
+    from typing_extensions import Literal
+
+MetricType = Literal["counter", "gauge", "histogram"]
+
+# 処理時間[sec]向けのデフォルトのバケット
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter:
+    """増加のみする値"""
+
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def get(self) -> float:
+        return self.value
+
+
+class Gauge:
+    """増減する値. set_functionで取得時に計算する値も登録できる"""
+
+    __slots__ = ("value", "_function")
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def get(self) -> float:
+        if self._function is not None:
+            return float(self._function())
+        return self.value
+
+
+@dataclass(frozen=True)
+class HistogramSnapshot:
+    buckets: tuple[tuple[float, int], ...]  # (上限, 上限以下の観測数の累積)
+    sum: float
+    count: int
+
+    def quantile(self, q: float) -> float:
+        """バケットから分位点を線形補間で推定する"""
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        lower, previous = 0.0, 0
+        for upper, cumulative in self.buckets:
+            if cumulative >= rank:
+                if math.isinf(upper):
+                    return lower
+                width = cumulative - previous
+                return lower + (upper - lower) * ((rank - previous) / width if width else 0.0)
+            lower, previous = upper, cumulative
+        return lower
+
+
+class Histogram:
+    """固定バケットのヒストグラム. 観測は二分探索と加算のみ"""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)  # 最後は+Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get(self) -> HistogramSnapshot:
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.bounds + (math.inf,), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return HistogramSnapshot(buckets=tuple(buckets), sum=self.sum, count=self.count)
+
+
+Metric = Union[Counter, Gauge, Histogram]
+Value = Union[float, HistogramSnapshot]
+M = TypeVar("M", Counter, Gauge, Histogram)
+
+
+class MetricFamily(Generic[M]):
+    def __init__(self, name: str, help: str, type: MetricType, label_names: tuple[str, ...], factory: Callable[[], M]):
+        """同じ名前でラベルの値が異なるメトリクスの集まり"""
+        self.name = name
+        self.help = help
+        self.type = type
+        self.label_names = label_names
+        self._factory = factory
+        self._children: dict[tuple[str, ...], M] = {}
+
+    def labels(self, *values: str) -> M:
+        """ラベルの値に対応するメトリクスを取得する. 呼び出し側で保持しておくと記録毎の検索を省ける"""
+        if len(values) != len(self.label_names):
+            raise ValueError(f"ラベルの数が一致しません: {self.name}{self.label_names}")
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._factory()
+        return child
+
+    def snapshot(self) -> dict[tuple[str, ...], Value]:
+        return {values: child.get() for values, child in list(self._children.items())}
+
+
+class MetricsRegistry:
+    """プロセス内のメトリクスの登録先"""
+
+    def __init__(self) -> None:
+        self._families: dict[str, MetricFamily[Any]] = {}
+
+    def _register(
+        self, name: str, help: str, type: MetricType, labels: tuple[str, ...], factory: Callable[[], M]
+    ) -> MetricFamily[M]:
+        family = self._families.get(name)
+        if family is not None:
+            if family.type != type or family.label_names != labels:
+                raise ValueError(f"同じ名前で異なるメトリクスが登録されています: {name}")
+            return family
+        family = self._families[name] = MetricFamily(name, help, type, labels, factory)
+        return family
+
+    def counter(self, name: str, help: str = "", labels: tuple[str, ...] = ()) -> MetricFamily[Counter]:
+        return self._register(name, help, "counter", labels, Counter)
+
+    def gauge(self, name: str, help: str = "", labels: tuple[str, ...] = ()) -> MetricFamily[Gauge]:
+        return self._register(name, help, "gauge", labels, Gauge)
+
+    def histogram(
+        self, name: str, help: str = "", labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> MetricFamily[Histogram]:
+        return self._register(name, help, "histogram", labels, lambda: Histogram(buckets))
+
+    def get(self, name: str) -> MetricFamily[Any] | None:
+        return self._families.get(name)
+
+    def snapshot(self) -> dict[str, dict[tuple[str, ...], Value]]:
+        """全てのメトリクスの現在の値を取得する
+
+        Returns:
+            dict[str, dict[tuple[str, ...], Value]]: メトリクス名 -> ラベルの値 -> 値(ヒストグラムはHistogramSnapshot)
+        """
+        return {name: family.snapshot() for name, family in self._families.items()}
+
+    def render_prometheus(self) -> str:
+        """Prometheusのテキスト形式に変換する"""
+        lines = []
+        for family in self._families.values():
+            lines.append(f"# HELP {family.name} {_escape_help(family.help)}")
+            lines.append(f"# TYPE {family.name} {family.type}")
+            for values, value in family.snapshot().items():
+                labels = list(zip(family.label_names, values))
+                if isinstance(value, HistogramSnapshot):
+                    for bound, cumulative in value.buckets:
+                        le = "+Inf" if math.isinf(bound) else repr(float(bound))
+                        lines.append(f"{family.name}_bucket{_format_labels(labels + [('le', le)])} {cumulative}")
+                    lines.append(f"{family.name}_sum{_format_labels(labels)} {_format_value(value.sum)}")
+                    lines.append(f"{family.name}_count{_format_labels(labels)} {value.count}")
+                else:
+                    lines.append(f"{family.name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 9100) -> asyncio.Server:
+        """GET /metrics でPrometheusのテキスト形式を返すHTTPサーバーを起動する
+
+        Args:
+            host (str, optional): 待ち受けるホスト. Defaults to "127.0.0.1".
+            port (int, optional): 待ち受けるポート. 0の場合は空いているポートを使う. Defaults to 9100.
+
+        Returns:
+            asyncio.Server: 起動したサーバー. close()で停止する
+        """
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await reader.readline()
+            # ヘッダーは読み捨てる
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.render_prometheus().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: list[tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label(str(value))}"' for key, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import mmap
+import os
+import re
+import struct
+import time
+from abc import ABC, abstractmethod
+from functools import lru_cache
+
+try:
+    from typing import Literal  # type: ignore
+except ImportError:
+    from typing_extensions import Literal
+
+BackendType = Literal["memory", "shm"]
+
+# 共有する状態のレイアウト: (記録した時の起動のID, time.monotonic()の基準時刻, 理論上の到着時刻(TAT))
+_STATE = struct.Struct("16sdd")
+_BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+# 起動のIDがない環境で、基準時刻のずれをこれ以上検出した場合は別の起動で記録された状態とみなす[sec]
+_EPOCH_TOLERANCE = 1.0
+
+
+@lru_cache(maxsize=None)
+def _boot_id() -> bytes:
+    """起動毎に変わるID(Linuxのboot_id). 取得できない環境では空"""
+    try:
+        with open(_BOOT_ID_PATH) as f:
+            return bytes.fromhex(f.read().strip().replace("-", ""))
+    except (OSError, ValueError):
+        return b""
+
+
+def _clock_epoch() -> float:
+    """time.monotonic()が0になる時刻(UNIX時間). 再起動すると変わるが、時刻の調整でも変わる"""
+    return time.time() - time.monotonic()
+
+
+def _same_boot(boot_id: bytes, epoch: float) -> bool:
+    """記録された状態が現在の起動のものかどうか"""
+    current = _boot_id()
+    if current:
+        return boot_id == current
+    # boot_idがない環境では基準時刻で判断する. 1秒を超える時刻の調整でも破棄される
+    return abs(epoch - _clock_epoch()) <= _EPOCH_TOLERANCE
+
+
+class RateLimitBackend(ABC):
+    """GCRAの状態(理論上の到着時刻)を保持し、不可分に更新する保存先
+
+    時刻はloop.time()と同じ基準(time.monotonic())で受け渡す
+    Redisなどの外部の保存先を使う場合はこのクラスを継承し、各メソッドを不可分な操作として実装する
+    """
+
+    @abstractmethod
+    def take(self, now: float, interval: float, tolerance: float) -> bool:
+        """実行できる場合は理論上の到着時刻をintervalだけ進めてTrueを返す
+
+        Args:
+            now (float): 現在時刻
+            interval (float): 1回の実行で進める時間[sec]
+            tolerance (float): 許容する前倒しの時間[sec]
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def refund(self, interval: float) -> None:
+        """takeで進めた理論上の到着時刻を戻す"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def tat(self) -> float:
+        """現在の理論上の到着時刻"""
+        raise NotImplementedError
+
+
+def _take(tat: float, now: float, interval: float, tolerance: float) -> float | None:
+    """GCRAの判定. 実行できる場合は新しい理論上の到着時刻を返す"""
+    tat = max(tat, now)
+    if tat - now > tolerance + 1e-9:
+        return None
+    return tat + interval
+
+
+class MemoryRateBackend(RateLimitBackend):
+    """プロセス内のメモリに状態を保持する"""
+
+    def __init__(self) -> None:
+        self._tat = 0.0
+
+    def take(self, now: float, interval: float, tolerance: float) -> bool:
+        tat = _take(self._tat, now, interval, tolerance)
+        if tat is None:
+            return False
+        self._tat = tat
+        return True
+
+    def refund(self, interval: float) -> None:
+        self._tat -= interval
+
+    def tat(self) -> float:
+        return self._tat
+
+
+class SharedMemoryRateBackend(RateLimitBackend):
+    def __init__(self, key: str, *, directory: str | None = None):
+        """同じホストのプロセス間で共有するメモリマップドファイルに状態を保持する
+
+        更新はファイルロック(fcntl.flock)の中で行うので、複数のプロセスから同時に呼んでも不可分になる
+        flockのロックは開いたファイルごとに持つので、fork後の子プロセスでは最初の操作でファイルを開き直す
+        同じkeyを使う全てのプロセスで同じ制限の設定を使うこと
+
+        状態は起動のID(Linuxのboot_id)と合わせて記録し、再起動を跨いだ状態は破棄する
+        そのため、/dev/shmがなく一時ディレクトリにファイルを置く環境でも再起動前の状態で止まり続けることはない
+        boot_idがない環境ではtime.monotonic()の基準時刻で代用する
+
+        Args:
+            key (str): 共有する状態の名前. 英数字と_.-のみ使える
+            directory (str, optional): ファイルを置くディレクトリ. Defaults to None. つまり、/dev/shmか一時ディレクトリ
+        """
+        try:
+            import fcntl
+        except ModuleNotFoundError:
+            raise ImportError("backend='shm'はfcntlが使える環境でのみ使えます")
+
+        if not re.fullmatch(r"[A-Za-z0-9_.-]+", key):
+            raise ValueError(f"keyには英数字と_.-のみ使えます: {key}")
+        if directory is None:
+            import tempfile
+
+            directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        self.key = key
+        self.path = os.path.join(directory, f"exmachina-rate-{key}")
+        self._fcntl = fcntl
+        self._open()
+
+    def _open(self) -> None:
+        self._pid = os.getpid()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < _STATE.size:
+            with _FileLock(self._fcntl, self._fd):
+                if os.fstat(self._fd).st_size < _STATE.size:
+                    os.ftruncate(self._fd, _STATE.size)
+        self._map = mmap.mmap(self._fd, _STATE.size)
+
+    def _lock(self) -> _FileLock:
+        if self._pid != os.getpid():
+            # forkで引き継いだfdは親プロセスとロックを共有してしまうので、子プロセスで開き直す
+            self.close()
+            self._open()
+        return _FileLock(self._fcntl, self._fd)
+
+    def _read(self) -> float:
+        boot_id, epoch, tat = _STATE.unpack_from(self._map)
+        if not _same_boot(boot_id, epoch):
+            return 0.0
+        return tat
+
+    def _write(self, tat: float) -> None:
+        _STATE.pack_into(self._map, 0, _boot_id(), _clock_epoch(), tat)
+
+    def take(self, now: float, interval: float, tolerance: float) -> bool:
+        with self._lock():
+            new_tat = _take(self._read(), now, interval, tolerance)
+            if new_tat is None:
+                return False
+            self._write(new_tat)
+        return True
+
+    def refund(self, interval: float) -> None:
+        with self._lock():
+            self._write(self._read() - interval)
+
+    def tat(self) -> float:
+        with self._lock():
+            return self._read()
+
+    def close(self) -> None:
+        if self._fd < 0:
+            return
+        self._map.close()
+        os.close(self._fd)
+        self._fd = -1
+
+    def unlink(self) -> None:
+        """共有している状態のファイルを削除する"""
+        self.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class _FileLock:
+    __slots__ = ("fcntl", "fd")
+
+    def __init__(self, fcntl, fd: int):
+        self.fcntl = fcntl
+        self.fd = fd
+
+    def __enter__(self) -> None:
+        self.fcntl.flock(self.fd, self.fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info) -> None:
+        self.fcntl.flock(self.fd, self.fcntl.LOCK_UN)
+
+
+def create_rate_backend(backend: BackendType | RateLimitBackend, key: str | None = None) -> RateLimitBackend:
+    """backendの指定からRateLimitBackendを作成する
+
+    Args:
+        backend (Literal['memory', 'shm'] | RateLimitBackend): 保存先の種類、または作成済みの保存先
+        key (str, optional): backend='shm'の時に共有する状態の名前
+    """
+    if isinstance(backend, RateLimitBackend):
+        return backend
+    if backend == "memory":
+        return MemoryRateBackend()
+    if backend == "shm":
+        if key is None:
+            raise ValueError("backend='shm'の場合はkeyを指定してください")
+        return SharedMemoryRateBackend(key)
+    raise ValueError(f"backendが想定外の値です: {backend}")
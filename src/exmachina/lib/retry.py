@@ -2,59 +2,36 @@ from __future__ import annotations
 
 import asyncio
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from functools import wraps
 from logging import Logger, getLogger
 from random import uniform
-from typing import Callable, Generator, Optional, Type, TypeVar
+from typing import Any, Callable, Generator, Optional, Tuple, Type, TypeVar, Union
+
+from .circuit_breaker import CircuitBreaker, CircuitOpenError, RetryBudget
+from .metrics import Counter, Histogram, MetricsRegistry
+from .tracing import Tracer
 
 T = TypeVar("T", bound=BaseException)
+# 例外クラスか、isinstanceと同様にそのタプル
+ExceptionTypes = Union[Type[T], Tuple[Type[T], ...]]
 
 
 class RetryRule(ABC):
     def __init__(
         self,
-        exception: Type[T],
+        exception: ExceptionTypes[T],
         retries: Optional[int] = None,
         filter: Optional[Callable[[T], bool]] = None,
     ):
         self.exception = exception
         self.retries = retries
-        self.filter = filter
+        # 一致した例外のみ渡すが、型はExceptionTypesのどの例外かまで絞り込めないのでAnyで受ける
+        self.filter: Optional[Callable[[Any], bool]] = filter
 
     def __call__(self, logger: Optional[Logger] = None):
-        logger = logger or getLogger(__name__)
-
-        def logger_wrap(func):
-            retry_count = self.retries
-            wait_time = self.generate_wait_time()
-
-            @wraps(func)
-            async def inner(*args, **kwargs):
-                nonlocal retry_count
-                try:
-                    return await func(*args, **kwargs)
-                except self.exception as e:
-                    # filter条件を満たさないエラーはraise
-                    if self.filter is not None and self.filter(e) is False:
-                        raise
-                    # カウントが0以下ならエラーをraise
-                    if retry_count is not None:
-                        if retry_count <= 0:
-                            raise
-                        else:
-                            retry_count -= 1
-                    sleep = next(wait_time)
-                    cnt_text = "∞" if retry_count is None else retry_count
-                    logger.warning(f"[Retry] {e.__class__.__name__}を検知: {sleep}秒後に再実行します (残り{cnt_text}回)")
-                    await asyncio.sleep(sleep)
-                    return await inner(*args, **kwargs)
-                except BaseException:
-                    raise
-
-            return inner
-
-        return logger_wrap
+        """このルールのみのRetryとしてデコレータを返す"""
+        return Retry([self], logger or getLogger(__name__))
 
     @abstractmethod
     def generate_wait_time(self) -> Generator[float, None, None]:
@@ -65,7 +42,7 @@ class RetryRule(ABC):
 class RetryFixed(RetryRule):
     def __init__(
         self,
-        exception: Type[T],
+        exception: ExceptionTypes[T],
         *,
         wait_time: float,
         retries: Optional[int] = None,
@@ -90,7 +67,7 @@ class RetryFibonacci(RetryRule):
 class RetryRange(RetryRule):
     def __init__(
         self,
-        exception: Type[T],
+        exception: ExceptionTypes[T],
         *,
         min: float,
         max: float,
@@ -109,7 +86,7 @@ class RetryRange(RetryRule):
 class RetryExponentialAndJitter(RetryRule):
     def __init__(
         self,
-        exception: Type[T],
+        exception: ExceptionTypes[T],
         *,
         base_wait_time: float = 1.0,
         cap: float = 60 * 60,
@@ -128,27 +105,198 @@ class RetryExponentialAndJitter(RetryRule):
             yield uniform(0, min(self.cap, self.base_wait_time * (2**retry_count)))
 
 
+class RetryState:
+    """一回の呼び出しにおける各ルールの残りリトライ回数と待機時間の状態
+
+    最初に例外が発生した時に作成され、待機時間のGeneratorはそのルールが初めて使われた時に作成する
+    """
+
+    __slots__ = ("retries", "wait_times", "rule")
+
+    def __init__(self, rules: list[RetryRule]):
+        self.retries = [rule.retries for rule in rules]
+        self.wait_times: list[Optional[Generator[float, None, None]]] = [None] * len(rules)
+        self.rule = -1  # 最後にリトライを決めたルールのindex
+
+
 @dataclass
 class Retry:
     rules: list[RetryRule]
     logger: Logger = getLogger(__name__)
+    budget: Optional[RetryBudget] = None  # 複数のRetryで共有できるリトライの予算
+    breaker: Optional[CircuitBreaker] = None  # 複数のRetryで共有できるサーキットブレーカー
+    requeue: bool = False  # Machinaで使う場合、待機中の呼び出しをタスクにせずloop.call_laterで再投入する
+    metrics: Optional[MetricsRegistry] = None  # ルール毎のリトライ回数と待機時間の記録先. Machinaではexecute毎に設定する
+    tracer: Optional[Tracer] = None  # リトライの待機をSpanとして記録する. Machinaではexecute毎に設定する
+
+    def __post_init__(self):
+        self._exceptions = tuple(rule.exception for rule in self.rules)
+        # 例外クラス毎にマッチするルールのindexを登録順にキャッシュする
+        self._table: dict[type, tuple[int, ...]] = {}
+        # ルールのindex毎の(リトライ回数, 待機時間)のメトリクス
+        self._instruments: dict[int, tuple[Counter, Histogram]] = {}
+
+    def bind(self, *, metrics: Optional[MetricsRegistry] = None, tracer: Optional[Tracer] = None) -> Retry:
+        """metricsとtracerが未設定なら指定したものを使うコピーを返す
+
+        rules, budget, breakerはコピー元と共有するため、複数のMachinaで一つのRetryを使っても記録先が混ざらない
+        """
+        return replace(
+            self,
+            metrics=metrics if self.metrics is None else self.metrics,
+            tracer=tracer if self.tracer is None else self.tracer,
+        )
 
     def __call__(self, func: Callable):
         @wraps(func)
-        async def generate_composite(*args, **kwargs):
-            return await composite(func, [rule(self.logger) for rule in self.rules])(*args, **kwargs)
+        async def inner(*args, **kwargs):
+            return await self.call(func, *args, **kwargs)
+
+        return inner
+
+    async def call(self, func: Callable, *args, **kwargs):
+        """funcを実行し、ルールにマッチする例外が発生した場合は待機して再実行する
+
+        ルールは先頭から順に評価し、filterを満たさないかリトライ回数を使い切ったルールは次のルールに譲る
+        breakerが開いている場合とbudgetを使い切った場合は待機せずに例外を送出する
+        """
+        self.begin()
+        state: Optional[RetryState] = None
+        while True:
+            trial = self.before_attempt()
+            try:
+                res = await func(*args, **kwargs)
+            except BaseException as e:
+                state, sleep = self.on_error(state, e, trial)
+                if sleep is None:
+                    raise
+            else:
+                self.on_success(trial)
+                return res
+            if self.tracer is None:
+                await asyncio.sleep(sleep)
+                continue
+            with self.tracer.span("retry", self.label(state.rule), sleep=sleep):  # type: ignore
+                await asyncio.sleep(sleep)
+
+    def begin(self) -> None:
+        """呼び出しの開始時に一度だけ呼ぶ"""
+        if self.budget is not None:
+            self.budget.record_call()
+
+    def before_attempt(self) -> Optional[int]:
+        """各試行の前に呼ぶ
+
+        Raises:
+            CircuitOpenError: breakerが開いている場合
+
+        Returns:
+            Optional[int]: breakerのhalf_openの試行として許可された場合はその番号. 試行の結果と一緒に渡す
+        """
+        if self.breaker is not None:
+            return self.breaker.acquire()
+        return None
+
+    def on_success(self, trial: Optional[int] = None) -> None:
+        """試行が成功した時に呼ぶ"""
+        if self.breaker is not None:
+            self.breaker.record(False, trial)
+
+    def on_cancel(self, trial: Optional[int] = None) -> None:
+        """試行が結果を得ずに終わった時に呼ぶ"""
+        if self.breaker is not None:
+            self.breaker.cancel(trial)
+
+    def on_error(
+        self, state: Optional[RetryState], e: BaseException, trial: Optional[int] = None
+    ) -> tuple[Optional[RetryState], Optional[float]]:
+        """試行が例外で終わった時に呼ぶ
+
+        Args:
+            state (RetryState, optional): この呼び出しの状態. 最初の例外ではNone
+            e (BaseException): 発生した例外
+            trial (int, optional): before_attemptの戻り値. Defaults to None.
 
-        return generate_composite
+        Returns:
+            tuple[Optional[RetryState], Optional[float]]: 更新した状態と次の試行までの待機時間[sec]
+                待機時間がNoneの場合はリトライしない
+        """
+        if isinstance(e, (asyncio.CancelledError, CircuitOpenError)):
+            self.on_cancel(trial)
+        elif self.breaker is not None:
+            self.breaker.record(True, trial)
+        if not isinstance(e, self._exceptions):
+            return state, None
+        if state is None:
+            state = RetryState(self.rules)
+        return state, self._next_wait_time(state, e)
 
+    def _match(self, exception_type: type) -> tuple[int, ...]:
+        indexes = self._table.get(exception_type)
+        if indexes is None:
+            indexes = tuple(i for i, rule in enumerate(self.rules) if issubclass(exception_type, rule.exception))
+            self._table[exception_type] = indexes
+        return indexes
 
-def composite(base, decorators: list[Callable]):
-    if len(decorators) == 0:
-        return base
+    def label(self, index: int) -> str:
+        """メトリクスやSpanに使うルールの名前"""
+        rule = self.rules[index]
+        exceptions = rule.exception if isinstance(rule.exception, tuple) else (rule.exception,)
+        return f"{rule.__class__.__name__}({', '.join(exception.__name__ for exception in exceptions)})"
 
-    func = decorators[0]
+    def _record(self, index: int, sleep: float) -> None:
+        instruments = self._instruments.get(index)
+        if instruments is None:
+            label = self.label(index)
+            attempts = self.metrics.counter(  # type: ignore
+                "exmachina_retry_attempts_total", "リトライルール毎のリトライ回数", labels=("rule",)
+            )
+            sleeps = self.metrics.histogram(  # type: ignore
+                "exmachina_retry_sleep_seconds", "リトライルール毎の待機時間", labels=("rule",)
+            )
+            instruments = self._instruments[index] = (attempts.labels(label), sleeps.labels(label))
+        attempts, sleeps = instruments
+        attempts.inc()
+        sleeps.observe(sleep)
 
-    @func
-    async def wrap(*args, **kwargs):
-        return await base(*args, **kwargs)
+    def _can_retry(self, e: BaseException) -> bool:
+        """ルールによらず、サーキットブレーカーやリトライの予算でリトライできるかどうか"""
+        # サーキットブレーカーで止められた呼び出しはリトライせずに即座に失敗させる
+        if isinstance(e, CircuitOpenError):
+            return False
+        if self.breaker is not None and self.breaker.state == "open":
+            self.logger.warning(f"[Retry] サーキットブレーカー({self.breaker.name})が開いているため再実行しません")
+            return False
+        if self.budget is not None and self.budget.remaining() <= 0:
+            self.logger.warning("[Retry] リトライの予算を使い切ったため再実行しません")
+            return False
+        return True
 
-    return composite(wrap, decorators[1:])
+    def _next_wait_time(self, state: RetryState, e: BaseException) -> Optional[float]:
+        if not self._can_retry(e):
+            return None
+        for i in self._match(type(e)):
+            rule = self.rules[i]
+            # filter条件を満たさないエラーは次のルールへ
+            if rule.filter is not None and rule.filter(e) is False:
+                continue
+            # カウントが0以下なら次のルールへ
+            retry_count = state.retries[i]
+            if retry_count is not None:
+                if retry_count <= 0:
+                    continue
+                retry_count -= 1
+                state.retries[i] = retry_count
+            if self.budget is not None:
+                self.budget.try_retry()
+            wait_time = state.wait_times[i]
+            if wait_time is None:
+                wait_time = state.wait_times[i] = rule.generate_wait_time()
+            sleep = next(wait_time)
+            state.rule = i
+            if self.metrics is not None:
+                self._record(i, sleep)
+            cnt_text = "∞" if retry_count is None else retry_count
+            self.logger.warning(f"[Retry] {e.__class__.__name__}を検知: {sleep}秒後に再実行します (残り{cnt_text}回)")
+            return sleep
+        return None
@@ -2,7 +2,26 @@ from __future__ import annotations
 
 import asyncio
 import functools
+import itertools
+import math
+from array import array
 from collections import deque
+from typing import Iterable
+
+from .rate_backend import RateLimitBackend
+
+try:
+    from typing import Literal  # type: ignore
+except ImportError:
+    from typing_extensions import Literal
+
+Engine = Literal["window", "gcra", "sliding_log", "sliding_counter"]
+
+
+# 複数のSemaphoreをまとめて取得する時の順序
+_order = itertools.count()
+# acquire_allが全てを同時に取得しようとして先を越されてよい回数. 超えると一つずつ待ち行列に並んで取得する
+_MAX_PASSED_OVER = 3
 
 
 class _DummySemaphore:
@@ -12,6 +31,60 @@ class _DummySemaphore:
     def release(self):
         ...
 
+    def locked(self) -> bool:
+        return False
+
+
+class _ResizableSemaphore:
+    """実行中に上限を変更できるSemaphore"""
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._count = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @limit.setter
+    def limit(self, value: int):
+        self._limit = value
+        self._wake_up()
+
+    def locked(self) -> bool:
+        return self._count >= self._limit or bool(self._waiters)
+
+    async def acquire(self) -> bool:
+        if not self.locked():
+            self._count += 1
+            return True
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # 枠を取得した直後にキャンセルされた場合は枠を返却する
+                self._count -= 1
+            else:
+                self._waiters.remove(fut)
+            self._wake_up()
+            raise
+        return True
+
+    def release(self):
+        self._count -= 1
+        self._wake_up()
+
+    def _wake_up(self):
+        while self._waiters and self._count < self._limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self._count += 1
+                fut.set_result(None)
+
 
 class TimeSemaphore:
     def __init__(
@@ -34,6 +107,9 @@ class TimeSemaphore:
         self._waiters = deque()
         self.entire_calls_limit = entire_calls_limit
         self.__sem = None
+        self._order = next(_order)
+        self._watchers: list[asyncio.Future] = []
+        self._refills: deque[float] = deque()  # 枠が返却される予定の時刻
 
     async def __aenter__(self) -> None:
         await self.acquire()
@@ -59,16 +135,36 @@ class TimeSemaphore:
     def _sem(self):
         if self.__sem is None:
             self.__sem = (
-                _DummySemaphore() if self.entire_calls_limit is None else asyncio.Semaphore(self.entire_calls_limit)
+                _DummySemaphore() if self.entire_calls_limit is None else _ResizableSemaphore(self.entire_calls_limit)
             )
         return self.__sem
 
+    def resize(self, entire_calls_limit: int) -> None:
+        """全体の最大並列実行数を変更する. 減らした場合は実行中のタスクが終わるまで新たに実行を開始しない"""
+        if self.entire_calls_limit is None:
+            raise ValueError("entire_calls_limitを指定していないSemaphoreはresizeできません")
+        if entire_calls_limit < 1:
+            raise ValueError("entire_calls_limitは1以上を指定してください")
+        self.entire_calls_limit = entire_calls_limit
+        if self.__sem is not None:
+            self.__sem.limit = entire_calls_limit  # type: ignore
+            self._notify()
+
     async def acquire(self) -> bool:
         await self._sem.acquire()
 
         if self._time_limit == 0.0:
             return True
 
+        try:
+            await self._acquire_time()
+        except BaseException:
+            self._sem.release()
+            raise
+        return True
+
+    async def _acquire_time(self) -> None:
+        """時間あたりの実行回数制限の枠を取得する"""
         while self._value <= 0:
             fut = self._loop.create_future()
             self._waiters.append(fut)
@@ -81,11 +177,53 @@ class TimeSemaphore:
                     self._wake_up_next()
                 raise
         self._value -= 1
-        self._loop.call_later(self._time_limit, self._wake_up_next)
-        return True
+        self._refills.append(self._loop.time() + self._time_limit)
+        self._loop.call_later(self._time_limit, self._refill)
+
+    def _refill(self):
+        self._refills.popleft()
+        self._wake_up_next()
+
+    def remaining(self) -> int | float:
+        """今すぐ実行を開始できる回数. 時間制限がない場合はinf"""
+        if self._time_limit == 0.0:
+            return math.inf
+        return max(self._value, 0)
+
+    def next_available_at(self) -> float:
+        """時間制限の上で次に実行を開始できる時刻(loop.time()基準)"""
+        now = self._loop.time()
+        if self._value > 0 or not self._refills:
+            return now
+        return max(self._refills[0], now)
 
     def release(self):
         self._sem.release()
+        self._notify()
+
+    def locked(self) -> bool:
+        """acquireがすぐに完了できない場合はTrueを返す"""
+        return self._sem.locked() or self._time_locked()
+
+    def _time_locked(self) -> bool:
+        return self._time_limit != 0.0 and self._value <= 0
+
+    async def wait(self) -> None:
+        """acquireがすぐに完了できる可能性がある状態になるまで待機する. 枠は取得しない"""
+        fut = self._loop.create_future()
+        self._watchers.append(fut)
+        self._on_watch()
+        await fut
+
+    def _on_watch(self):
+        """waitの待機が始まった時に呼ばれる"""
+
+    def _notify(self):
+        """waitで待機しているタスクを全て起こす"""
+        watchers, self._watchers = self._watchers, []
+        for watcher in watchers:
+            if not watcher.done():
+                watcher.set_result(None)
 
     def _wake_up_next(self):
         self._value += 1
@@ -93,4 +231,350 @@ class TimeSemaphore:
             waiter = self._waiters.popleft()
             if not waiter.done():
                 waiter.set_result(None)
-                return
+                break
+        # acquireで待機しているタスクを優先するため後から起こす
+        self._notify()
+
+
+class _ScheduledTimeSemaphore(TimeSemaphore):
+    """次に実行できる時刻を計算で求め、待機中のタスクがいる時だけタイマーを一つ登録するSemaphoreの基底クラス"""
+
+    def __init__(self, *, entire_calls_limit: int | None = None, time_limit: float = 0.0):
+        super().__init__(entire_calls_limit=entire_calls_limit, time_limit=time_limit, time_calls_limit=1)
+        self._timer: asyncio.TimerHandle | None = None
+
+    def _try_take(self, now: float) -> bool:
+        """実行できる場合は枠を消費してTrueを返す"""
+        raise NotImplementedError
+
+    def _refund(self) -> None:
+        """_try_takeで消費した枠を返却する"""
+
+    async def _acquire_time(self) -> None:
+        if not self._waiters and self._try_take(self._loop.time()):
+            return
+
+        fut = self._loop.create_future()
+        self._waiters.append(fut)
+        self._schedule()
+        try:
+            await fut
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # 枠を取得した直後にキャンセルされた場合は枠を返却する
+                self._refund()
+            fut.cancel()
+            self._wake_up_next()
+            raise
+
+    def _time_locked(self) -> bool:
+        if self._time_limit == 0.0:
+            return False
+        return bool(self._waiters) or self.next_available_at() > self._loop.time() + 1e-9
+
+    def _on_watch(self):
+        self._schedule()
+
+    def _schedule(self):
+        if self._timer is not None or not (self._waiters or self._watchers):
+            return
+        self._timer = self._loop.call_at(self.next_available_at(), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._wake_up_next()
+
+    def _wake_up_next(self):
+        now = self._loop.time()
+        while self._waiters:
+            waiter = self._waiters[0]
+            if waiter.done():
+                self._waiters.popleft()
+                continue
+            if not self._try_take(now):
+                break
+            self._waiters.popleft()
+            waiter.set_result(None)
+        self._notify()
+        self._schedule()
+
+
+class GCRASemaphore(_ScheduledTimeSemaphore):
+    def __init__(
+        self,
+        *,
+        entire_calls_limit: int | None = None,
+        time_limit: float = 0.0,
+        time_calls_limit: float = 1,
+        burst: int | None = None,
+        backend: RateLimitBackend | None = None,
+    ):
+        """GCRA(Generic Cell Rate Algorithm)で時間あたりの実行回数制限をかけるSemaphore
+
+        time_limit / time_calls_limit 秒に1回のペースで実行を許可し、burst回までは連続して実行できる
+        次に実行できる時刻を計算で求めるため、タイマーは待機中のタスクがいる時に高々1つしか登録しない
+        backendを指定すると時間あたりの制限の状態をそこに保持し、同じbackendを使う全てのプロセスで制限を共有する
+        (entire_calls_limitはプロセス毎の制限のまま)
+
+        Args:
+            entire_calls_limit (int, optional): 全体の最大並列実行数. Defaults to None.
+            time_limit (float, optional): 時間制限[sec]. Defaults to 0.0.
+            time_calls_limit (float, optional): 時間制限あたりの実行回数、0.5のような小数も指定できる. Defaults to 1.
+            burst (int, optional): 連続して実行できる回数. Defaults to None. つまり、time_calls_limitの切り捨て(最低1)
+            backend (RateLimitBackend, optional): 状態の保存先. Defaults to None. つまり、このインスタンスのメモリ
+        """
+        if time_calls_limit <= 0:
+            raise ValueError("time_calls_limitは0より大きい値を指定してください")
+        burst = max(1, int(time_calls_limit)) if burst is None else burst
+        if burst < 1:
+            raise ValueError("burstは1以上を指定してください")
+        super().__init__(entire_calls_limit=entire_calls_limit, time_limit=time_limit)
+        self.burst = burst
+        self._interval = time_limit / time_calls_limit  # 1回の実行で進む理論上の到着時刻[sec]
+        self._tolerance = self._interval * (burst - 1)  # 許容する前倒しの時間[sec]
+        self._tat = 0.0  # 理論上の到着時刻(Theoretical Arrival Time)
+        self.backend = backend
+
+    def _get_tat(self) -> float:
+        return self._tat if self.backend is None else self.backend.tat()
+
+    def remaining(self) -> int | float:
+        if self._time_limit == 0.0:
+            return math.inf
+        backlog = max(self._get_tat() - self._loop.time(), 0.0)
+        return max(0, min(self.burst, math.floor((self._tolerance - backlog) / self._interval + 1e-9) + 1))
+
+    def next_available_at(self) -> float:
+        return max(self._get_tat() - self._tolerance, self._loop.time())
+
+    def _try_take(self, now: float) -> bool:
+        if self.backend is not None:
+            return self.backend.take(now, self._interval, self._tolerance)
+        tat = max(self._tat, now)
+        if tat - now > self._tolerance + 1e-9:
+            return False
+        self._tat = tat + self._interval
+        return True
+
+    def _refund(self):
+        if self.backend is not None:
+            self.backend.refund(self._interval)
+            return
+        self._tat -= self._interval
+
+
+class SlidingWindowSemaphore(_ScheduledTimeSemaphore):
+    def __init__(
+        self,
+        *,
+        entire_calls_limit: int | None = None,
+        time_limit: float = 0.0,
+        time_calls_limit: int = 1,
+        mode: Literal["log", "counter"] = "log",
+    ):
+        """スライディングウィンドウで「任意のtime_limit秒間にtime_calls_limit回まで」の制限をかけるSemaphore
+
+        Args:
+            entire_calls_limit (int, optional): 全体の最大並列実行数. Defaults to None.
+            time_limit (float, optional): ウィンドウの長さ[sec]. Defaults to 0.0.
+            time_calls_limit (int, optional): ウィンドウあたりの実行回数. Defaults to 1.
+            mode (Literal['log', 'counter'], optional): ウィンドウの計算方式. Defaults to "log".
+                log: 直近time_calls_limit回の実行開始時刻をリングバッファに記録し、厳密に判定する
+                counter: 直前と現在の固定ウィンドウの実行回数から重み付きで推定する. メモリは回数によらず一定
+        """
+        if time_calls_limit < 1:
+            raise ValueError("time_calls_limitは1以上を指定してください")
+        super().__init__(entire_calls_limit=entire_calls_limit, time_limit=time_limit)
+        self.mode = mode
+        self.time_calls_limit = time_calls_limit
+        # log: 実行開始時刻のリングバッファ、_headが最も古い記録を指す
+        self._log = array("d", [-math.inf]) * (time_calls_limit if mode == "log" else 0)
+        self._head = 0
+        # counter: [直前のウィンドウの回数, 現在のウィンドウの回数]
+        self._counts = array("d", [0.0, 0.0])
+        self._window_start = 0.0
+
+    def remaining(self) -> int | float:
+        now = self._loop.time()
+        if self._time_limit == 0.0:
+            return math.inf
+        if self.mode == "log":
+            return self._find_first_in_window(now)
+        self._rotate(now)
+        return max(0, int(self.time_calls_limit - self._estimate(now) + 1e-9))
+
+    def next_available_at(self) -> float:
+        now = self._loop.time()
+        if self._time_limit == 0.0:
+            return now
+        if self.mode == "log":
+            return max(self._log[self._head] + self._time_limit, now)
+        self._rotate(now)
+        prev, current = self._counts
+        limit = self.time_calls_limit - 1
+        if current <= limit:
+            if prev == 0.0:
+                return now
+            # prev * (1 - elapsed / time_limit) + current <= limit となる時刻
+            elapsed = (1 - (limit - current) / prev) * self._time_limit
+            return max(self._window_start + elapsed, now)
+        # 次のウィンドウで current * (1 - elapsed / time_limit) <= limit となる時刻
+        elapsed = (1 - limit / current) * self._time_limit
+        return self._window_start + self._time_limit + elapsed
+
+    def _try_take(self, now: float) -> bool:
+        if self.mode == "log":
+            if self._log[self._head] > now - self._time_limit:
+                return False
+            self._log[self._head] = now
+            self._head = (self._head + 1) % self.time_calls_limit
+            return True
+        self._rotate(now)
+        if self._estimate(now) + 1 > self.time_calls_limit + 1e-9:
+            return False
+        self._counts[1] += 1
+        return True
+
+    def _refund(self):
+        if self.mode == "counter":
+            self._counts[1] = max(0.0, self._counts[1] - 1)
+
+    def _find_first_in_window(self, now: float) -> int:
+        """リングバッファを古い順に見て、ウィンドウ内の最初の記録の位置(=残り回数)を二分探索で求める"""
+        lo, hi = 0, self.time_calls_limit
+        threshold = now - self._time_limit
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._log[(self._head + mid) % self.time_calls_limit] > threshold:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _rotate(self, now: float):
+        """固定ウィンドウを現在時刻まで進める"""
+        windows = math.floor((now - self._window_start) / self._time_limit)
+        if windows <= 0:
+            return
+        self._counts[0] = self._counts[1] if windows == 1 else 0.0
+        self._counts[1] = 0.0
+        self._window_start += windows * self._time_limit
+
+    def _estimate(self, now: float) -> float:
+        prev, current = self._counts
+        return prev * (1 - (now - self._window_start) / self._time_limit) + current
+
+
+async def acquire_all(semaphores: Iterable[TimeSemaphore]) -> None:
+    """複数のSemaphoreをまとめて取得する
+
+    全てのSemaphoreがすぐに取得できる時にだけ一度に取得し、一つでも取得できない場合は何も保持せずに待機する
+    これにより、あるSemaphoreの枠を保持したまま別のSemaphoreを待つことによる枠の浪費やデッドロックを防ぐ
+    _MAX_PASSED_OVER回取得できなかった場合は、単独でacquireするタスクに枠を奪われ続けないように、
+    各Semaphoreの待ち行列に一つずつ並んで取得する
+    取得は作成順の一貫した順序で行う
+
+    Args:
+        semaphores (Iterable[TimeSemaphore]): 取得するSemaphore
+    """
+    ordered = sorted(semaphores, key=lambda sem: sem._order)
+    if len(ordered) == 1:
+        await ordered[0].acquire()
+        return
+
+    for _ in range(_MAX_PASSED_OVER):
+        if await _try_acquire_all(ordered):
+            return
+    # 作成順に取得するので、枠を保持したまま待ってもデッドロックしない
+    acquired: list[TimeSemaphore] = []
+    try:
+        for sem in ordered:
+            await sem.acquire()
+            acquired.append(sem)
+    except BaseException:
+        release_all(acquired)
+        raise
+
+
+async def _try_acquire_all(ordered: list[TimeSemaphore]) -> bool:
+    """全てを同時に取得できれば取得してTrueを返す. できなければ何も保持せずに空くまで待機してFalseを返す"""
+    blocked = next((sem for sem in ordered if sem.locked()), None)
+    if blocked is None:
+        # どれもlockedでないので、以下のacquireは一度も中断せずに完了する
+        for sem in ordered:
+            await sem.acquire()
+        return True
+    if not blocked._sem.locked():
+        # 時間の制限は枠を保持せずに待つ
+        await blocked.wait()
+        return False
+    # 全体の制限は単独でacquireしているタスクと公平に順番を待ち、他が取得できなければすぐに返却する
+    await blocked._sem.acquire()
+    if blocked._time_locked() or any(sem.locked() for sem in ordered if sem is not blocked):
+        blocked.release()
+        return False
+    for sem in ordered:
+        if sem is not blocked:
+            await sem.acquire()
+        elif sem._time_limit != 0.0:
+            await sem._acquire_time()
+    return True
+
+
+def release_all(semaphores: Iterable[TimeSemaphore]) -> None:
+    for sem in semaphores:
+        sem.release()
+
+
+def create_time_semaphore(
+    engine: Engine = "window",
+    *,
+    entire_calls_limit: int | None = None,
+    time_limit: float = 0.0,
+    time_calls_limit: float = 1,
+    burst: int | None = None,
+    backend: RateLimitBackend | None = None,
+) -> TimeSemaphore:
+    """engineに応じたTimeSemaphoreを作成する
+
+    Args:
+        engine (Literal['window', 'gcra', 'sliding_log', 'sliding_counter'], optional):
+            時間あたりの実行回数制限の方式. Defaults to "window".
+            window: 実行開始からtime_limit秒後に枠を返却する
+            gcra: GCRAで一定のペースに均して実行を許可する
+            sliding_log: 任意のtime_limit秒間の実行回数を実行開始時刻の記録から厳密に制限する
+            sliding_counter: 任意のtime_limit秒間の実行回数を固定ウィンドウの回数から推定して制限する
+        backend (RateLimitBackend, optional): 時間あたりの制限の状態の保存先. engine="gcra"のみ指定できる
+
+    Raises:
+        ValueError: engine="gcra"以外でtime_calls_limitが1以上の整数でない時や、burst, backendを指定した時の例外
+    """
+    if engine != "gcra":
+        if backend is not None:
+            raise ValueError("backendはengine='gcra'の場合のみ指定できます")
+        if burst is not None:
+            raise ValueError("burstはengine='gcra'の場合のみ指定できます")
+        if time_calls_limit != int(time_calls_limit) or time_calls_limit < 1:
+            raise ValueError("engine='gcra'以外ではtime_calls_limitは1以上の整数を指定してください")
+    if engine in ("sliding_log", "sliding_counter"):
+        return SlidingWindowSemaphore(
+            entire_calls_limit=entire_calls_limit,
+            time_limit=time_limit,
+            time_calls_limit=int(time_calls_limit),
+            mode="log" if engine == "sliding_log" else "counter",
+        )
+    if engine == "gcra":
+        return GCRASemaphore(
+            entire_calls_limit=entire_calls_limit,
+            time_limit=time_limit,
+            time_calls_limit=time_calls_limit,
+            burst=burst,
+            backend=backend,
+        )
+    if engine != "window":
+        raise ValueError(f"engineが想定外の値です: {engine}")
+    return TimeSemaphore(
+        entire_calls_limit=entire_calls_limit,
+        time_limit=time_limit,
+        time_calls_limit=int(time_calls_limit),
+    )
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import asyncio
+import math
+from typing import Any, Callable
+
+
+class WheelTimer:
+    """TimerWheelに登録されたタイマー"""
+
+    __slots__ = ("tick", "callback", "args", "cancelled", "_wheel")
+
+    def __init__(self, wheel: TimerWheel, tick: int, callback: Callable[..., Any], args: tuple):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self._wheel = wheel
+
+    def cancel(self) -> None:
+        if not self.cancelled:
+            self.cancelled = True
+            self._wheel._on_cancel()
+
+
+class TimerWheel:
+    def __init__(self, *, resolution: float = 0.01, slots: int = 1024):
+        """大量のタイマーをまとめて管理するハッシュ化タイマーホイール
+
+        時刻をresolution秒毎のtickに区切り、tickをslotsで割った余りのスロットにタイマーを登録する
+        asyncioのタイマーは次に処理するtickの一つだけを使い、期限を迎えたタイマーはtick毎にまとめて実行する
+        タイマーは期限以降の最初のtickで実行されるので、遅れは高々resolution秒になる
+        一周の間に期限を迎えるタイマーがなければ、次の期限まで起床しない
+
+        Args:
+            resolution (float, optional): tickの間隔[sec]. Defaults to 0.01.
+            slots (int, optional): スロット数. Defaults to 1024.
+        """
+        if resolution <= 0 or slots < 1:
+            raise ValueError("resolutionは0より大きく、slotsは1以上を指定してください")
+        self.resolution = resolution
+        self._slots: list[list[WheelTimer]] = [[] for _ in range(slots)]
+        self._next_tick = 0  # 次に処理するtick
+        self._idle_ticks = 0  # 期限を迎えたタイマーがなかった連続したtickの数
+        self._live = 0  # キャンセルされていないタイマーの数
+        self._handle: asyncio.TimerHandle | None = None
+        self._wake_tick = 0  # asyncioのタイマーで起床するtick
+        self._advancing = False
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def __len__(self) -> int:
+        return self._live
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        return self._loop
+
+    def call_at(self, when: float, callback: Callable[..., Any], *args) -> WheelTimer:
+        """loop.time()基準の時刻whenにcallbackを呼び出す
+
+        Returns:
+            WheelTimer: キャンセルに使うタイマー
+        """
+        if self._live == 0 and self._handle is None and not self._advancing:
+            # 停止中に進んだ時間は処理せず、今のtickから再開する
+            self._next_tick = math.floor(self.loop.time() / self.resolution)
+            self._idle_ticks = 0
+        tick = max(math.ceil(when / self.resolution), self._next_tick)
+        timer = WheelTimer(self, tick, callback, args)
+        self._slots[tick % len(self._slots)].append(timer)
+        self._live += 1
+        if not self._advancing and (self._handle is None or tick < self._wake_tick):
+            self._schedule(tick)
+        return timer
+
+    async def sleep_until(self, when: float) -> None:
+        """loop.time()基準の時刻whenまで待機する"""
+        future = self.loop.create_future()
+        timer = self.call_at(when, _set_result, future)
+        try:
+            await future
+        finally:
+            timer.cancel()
+
+    def _on_cancel(self) -> None:
+        self._live -= 1
+        if self._live == 0 and self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+            self._clear()
+
+    def _clear(self) -> None:
+        for slot in self._slots:
+            slot.clear()
+
+    def _schedule(self, tick: int) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+        self._wake_tick = tick
+        self._handle = self.loop.call_at(tick * self.resolution, self._advance)
+
+    def _advance(self) -> None:
+        self._handle = None
+        # 予定したtickは必ず処理する(loopのクロック分解能の分だけ早く呼ばれることがある)
+        now_tick = max(math.floor(self.loop.time() / self.resolution), self._wake_tick)
+        self._advancing = True
+        try:
+            if now_tick - self._next_tick >= len(self._slots):
+                self._process_all(now_tick)
+            else:
+                self._process(now_tick)
+        finally:
+            self._advancing = False
+        if self._live == 0:
+            self._clear()
+        elif self._idle_ticks >= len(self._slots):
+            # 一周の間に期限を迎えるタイマーがなかったので、最も早い期限まで起床しない
+            self._schedule(min(timer.tick for slot in self._slots for timer in slot if not timer.cancelled))
+        else:
+            self._schedule(self._next_tick)
+
+    def _process(self, now_tick: int) -> None:
+        n = len(self._slots)
+        while self._next_tick <= now_tick and self._live > 0:
+            tick = self._next_tick
+            self._next_tick += 1
+            slot = self._slots[tick % n]
+            if not any(timer.tick <= tick for timer in slot):
+                self._idle_ticks += 1
+                continue
+            self._idle_ticks = 0
+            due = [timer for timer in slot if timer.tick <= tick]
+            slot[:] = [timer for timer in slot if timer.tick > tick and not timer.cancelled]
+            self._fire(due)
+
+    def _process_all(self, now_tick: int) -> None:
+        """一周以上遅れた場合に全てのスロットを一度だけ走査して期限を迎えたタイマーを実行する"""
+        due = []
+        for slot in self._slots:
+            due.extend(timer for timer in slot if timer.tick <= now_tick)
+            slot[:] = [timer for timer in slot if timer.tick > now_tick and not timer.cancelled]
+        due.sort(key=lambda timer: timer.tick)
+        self._idle_ticks = 0 if due else self._idle_ticks + now_tick - self._next_tick + 1
+        self._next_tick = now_tick + 1
+        self._fire(due)
+
+    def _fire(self, due: list[WheelTimer]) -> None:
+        for timer in due:
+            if timer.cancelled:
+                continue
+            timer.cancelled = True
+            self._live -= 1
+            timer.callback(*timer.args)
+
+
+def _set_result(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import sys
+import threading
+from collections import Counter
+from contextlib import nullcontext
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Any, ContextManager, Optional
+
+try:
+    from typing import Literal  # type: ignore
+except ImportError:
+    from typing_extensions import Literal
+
+SpanKind = Literal["emit", "execute", "depends", "acquire", "retry"]
+
+
+class Span:
+    """計測区間. 親子関係はcontextvarsで引き継がれ、executeのタスクは呼び出し元のemitのSpanを親に持つ"""
+
+    __slots__ = ("kind", "name", "attributes", "parent", "start", "end", "error", "data")
+
+    def __init__(self, kind: SpanKind, name: str, attributes: dict[str, Any], parent: Span | None):
+        self.kind = kind
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.start = perf_counter()
+        self.end: float | None = None
+        self.error: BaseException | None = None  # 例外で終了した場合の例外
+        self.data: dict[str, Any] = {}  # ミドルウェアが自由に使える領域
+
+    def __repr__(self) -> str:
+        return f"Span({self.kind}:{self.name})"
+
+    @property
+    def duration(self) -> float | None:
+        """区間の長さ[sec]. 終了していなければNone"""
+        return None if self.end is None else self.end - self.start
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("exmachina_current_span", default=None)
+
+
+def get_current_span() -> Span | None:
+    """現在のコンテキストで実行中のSpanを取得する"""
+    return _current_span.get()
+
+
+class Middleware:
+    """Spanの開始と終了に呼ばれるフック. 必要なメソッドだけをオーバーライドする
+
+    beforeは登録順に、afterは登録の逆順に呼ばれる
+    """
+
+    def before(self, span: Span) -> None:
+        """Spanの開始時に呼ばれる"""
+
+    def after(self, span: Span) -> None:
+        """Spanの終了時に呼ばれる. span.endとspan.errorは設定済み"""
+
+    def startup(self) -> None:
+        """botの起動時に呼ばれる"""
+
+    def shutdown(self) -> None:
+        """botの終了時に呼ばれる"""
+
+
+class Tracer:
+    def __init__(self) -> None:
+        """登録されたミドルウェアにSpanの開始と終了を通知する
+
+        ミドルウェアがない場合はSpanを作成しないので、計測のオーバーヘッドは分岐一つ分になる
+        """
+        self.middlewares: list[Middleware] = []
+
+    def add(self, middleware: Middleware) -> None:
+        self.middlewares.append(middleware)
+
+    def start(self, kind: SpanKind, name: str, **attributes: Any) -> Span | None:
+        """現在のSpanを親にSpanを開始する. 現在のSpanは変更しない
+
+        Returns:
+            Span | None: 開始したSpan. ミドルウェアがない場合はNone
+        """
+        if not self.middlewares:
+            return None
+        span = Span(kind, name, attributes, _current_span.get())
+        for middleware in self.middlewares:
+            middleware.before(span)
+        return span
+
+    def finish(self, span: Span | None, error: BaseException | None = None) -> None:
+        """startで開始したSpanを終了する"""
+        if span is None:
+            return
+        span.end = perf_counter()
+        span.error = error
+        for middleware in reversed(self.middlewares):
+            middleware.after(span)
+
+    def span(self, kind: SpanKind, name: str, **attributes: Any) -> ContextManager[Span | None]:
+        """withの間をSpanとして計測し、その間は現在のSpanにする"""
+        if not self.middlewares:
+            return _NULL_CONTEXT
+        return _SpanContext(self, kind, name, attributes)
+
+
+class _SpanContext:
+    __slots__ = ("tracer", "kind", "name", "attributes", "span", "token")
+
+    def __init__(self, tracer: Tracer, kind: SpanKind, name: str, attributes: dict[str, Any]):
+        self.tracer = tracer
+        self.kind: SpanKind = kind
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self) -> Span | None:
+        self.span = self.tracer.start(self.kind, self.name, **self.attributes)
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        _current_span.reset(self.token)
+        self.tracer.finish(self.span, exc)
+
+
+_NULL_CONTEXT: ContextManager[None] = nullcontext()
+
+
+class OpenTelemetryMiddleware(Middleware):
+    def __init__(self, tracer: Any = None):
+        """SpanをOpenTelemetryのSpanとして記録する
+
+        Args:
+            tracer (opentelemetry.trace.Tracer, optional): 記録先. Defaults to None. つまり、グローバルなTracerProviderから取得する
+        """
+        try:
+            from opentelemetry import trace  # type: ignore
+        except ModuleNotFoundError:
+            raise ImportError("pip install exmachina[opentelemetry]")
+
+        self._trace = trace
+        self.tracer = tracer or trace.get_tracer("exmachina")
+
+    def before(self, span: Span) -> None:
+        parent = span.parent.data.get("otel") if span.parent is not None else None
+        context = None if parent is None else self._trace.set_span_in_context(parent)
+        attributes = {"exmachina.kind": span.kind, "exmachina.name": span.name}
+        attributes.update((f"exmachina.{key}", _to_attribute(value)) for key, value in span.attributes.items())
+        # exmachinaのSpanは全てプロセス内の処理なので、OpenTelemetryのSpanKindはINTERNALにして種類は属性に残す
+        span.data["otel"] = self.tracer.start_span(
+            f"{span.kind} {span.name}", context=context, kind=self._trace.SpanKind.INTERNAL, attributes=attributes
+        )
+
+    def after(self, span: Span) -> None:
+        otel_span = span.data.pop("otel", None)
+        if otel_span is None:
+            return
+        if span.error is not None:
+            otel_span.record_exception(span.error)
+            otel_span.set_status(self._trace.Status(self._trace.StatusCode.ERROR, repr(span.error)))
+        otel_span.end()
+
+
+def _to_attribute(value: Any) -> Any:
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [str(v) for v in value]
+    return str(value)
+
+
+class SamplingProfiler(Middleware):
+    def __init__(self, *, interval: float = 0.005, max_depth: int = 64):
+        """イベントループのスレッドのスタックを一定間隔で記録するサンプリングプロファイラ
+
+        バックグラウンドのスレッドからinterval秒毎にスタックを覗くだけなので、イベントループ側の処理は増えない
+        いずれかのSpanの実行中のみ記録するので、待機しているだけの時間は含まれない
+        結果はfolded()でflamegraph.plやspeedscopeが読める形式で取得できる
+
+        Args:
+            interval (float, optional): 記録する間隔[sec]. Defaults to 0.005.
+            max_depth (int, optional): 記録するスタックの最大の深さ. Defaults to 64.
+        """
+        if interval <= 0 or max_depth < 1:
+            raise ValueError("intervalは0より大きく、max_depthは1以上を指定してください")
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples: Counter[tuple[str, ...]] = Counter()  # 根から順のスタック -> 記録回数
+        self._active = 0  # 実行中のSpanの数
+        self._target: int | None = None  # 記録するスレッドのid
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def before(self, span: Span) -> None:
+        self._active += 1
+
+    def after(self, span: Span) -> None:
+        self._active -= 1
+
+    def startup(self) -> None:
+        self.start()
+
+    def shutdown(self) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """呼び出したスレッドの記録を開始する"""
+        if self._thread is not None:
+            return
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="exmachina-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """記録を停止する"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            if self._active > 0:
+                self.sample()
+
+    def sample(self) -> None:
+        """対象のスレッドのスタックを一回記録する"""
+        frame = sys._current_frames().get(self._target)  # type: ignore
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+            frame = frame.f_back
+        if stack:
+            self.samples[tuple(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        """記録したスタックを "関数1;関数2;... 回数" の行にして返す"""
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.samples.most_common())
@@ -0,0 +1,177 @@
+import asyncio
+
+import pytest
+
+from exmachina.core.admission import AdmissionQueue, Job, WorkerPool
+from exmachina.core.exception import MachinaException, QueueFullError
+
+
+def create_queue(**kwargs):
+    started = []
+
+    def start(job: Job):
+        started.append(job)
+        task = asyncio.get_running_loop().create_future()
+        job.kwargs["task"] = task
+        return task
+
+    return AdmissionQueue(start, **kwargs), started
+
+
+def create_job(i: int) -> Job:
+    return Job(args=(i,), kwargs={}, future=asyncio.get_running_loop().create_future())
+
+
+def test_admission_queue_error():
+    with pytest.raises(MachinaException):
+        AdmissionQueue(lambda job: job.future, max_tasks=0)
+
+    with pytest.raises(MachinaException):
+        AdmissionQueue(lambda job: job.future, max_tasks=1, queue_size=-1)
+
+
+@pytest.mark.asyncio
+async def test_admission_queue():
+    queue, started = create_queue(max_tasks=2, queue_size=2, overflow="error")
+    jobs = [create_job(i) for i in range(5)]
+
+    for job in jobs[:4]:
+        queue.put_nowait(job)
+
+    # max_tasksを超えた分はタスク化されない
+    assert started == jobs[:2]
+    assert queue.running == 2
+    assert queue.qsize() == 2
+    assert queue.full()
+
+    with pytest.raises(QueueFullError):
+        queue.put_nowait(jobs[4])
+
+    # 待機中にキャンセルされたJobは実行されない
+    jobs[2].future.cancel()
+    jobs[0].kwargs["task"].set_result(None)
+    await asyncio.sleep(0)
+    assert started == [jobs[0], jobs[1], jobs[3]]
+    assert queue.running == 2
+    assert queue.qsize() == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_queue_drop_oldest():
+    queue, started = create_queue(max_tasks=1, queue_size=1, overflow="drop_oldest")
+    jobs = [create_job(i) for i in range(3)]
+
+    for job in jobs:
+        queue.put_nowait(job)
+
+    assert started == [jobs[0]]
+    with pytest.raises(QueueFullError):
+        await jobs[1].future
+    assert queue.qsize() == 1
+
+    # queue_size=0では破棄できる古いJobがないので追加しない
+    queue, started = create_queue(max_tasks=1, queue_size=0, overflow="drop_oldest")
+    queue.put_nowait(create_job(0))
+    with pytest.raises(QueueFullError):
+        queue.put_nowait(create_job(1))
+    assert queue.qsize() == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_queue_wait():
+    queue, started = create_queue(max_tasks=1, queue_size=1, overflow="wait")
+    jobs = [create_job(i) for i in range(3)]
+
+    await queue.put(jobs[0])
+    await queue.put(jobs[1])
+
+    # 空きができるまで待機する
+    putter = asyncio.create_task(queue.put(jobs[2]))
+    await asyncio.sleep(0)
+    assert not putter.done()
+
+    jobs[0].kwargs["task"].set_result(None)
+    await asyncio.wait_for(putter, 1)
+    assert started == jobs[:2]
+    assert queue.qsize() == 1
+
+    # キャンセルされた待機は次の待機者を起こす
+    putter = asyncio.create_task(queue.put(create_job(3)))
+    await asyncio.sleep(0)
+    putter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await putter
+
+    # put_nowaitは待機できないので、overflow="wait"でもqueue_sizeを超えて追加しない
+    with pytest.raises(QueueFullError):
+        queue.put_nowait(create_job(4))
+    assert queue.qsize() == 1
+
+
+@pytest.mark.asyncio
+async def test_worker_pool():
+    with pytest.raises(MachinaException):
+        WorkerPool(lambda job: job.future, workers=0)
+
+    running = []
+
+    async def run(job: Job):
+        running.append(job.args[0])
+        await asyncio.sleep(0.01)
+        if job.args[0] == 3:
+            raise ZeroDivisionError
+        if job.args[0] == 5:
+            raise asyncio.CancelledError
+        return job.args[0]
+
+    pool = WorkerPool(run, workers=2)
+    jobs = [create_job(i) for i in range(5)]
+    for job in jobs:
+        pool.put_nowait(job)
+
+    await asyncio.sleep(0)
+    assert pool.stats().workers == 2
+    assert pool.stats().running == 2
+    assert pool.stats().queued == 3
+
+    # 待機中のJobのキャンセル
+    jobs[2].future.cancel()
+    # 実行中のJobのキャンセルではワーカーは止まらない
+    jobs[1].future.cancel()
+
+    assert await jobs[0].future == 0
+    with pytest.raises(ZeroDivisionError):
+        await jobs[3].future
+    assert await jobs[4].future == 4
+    assert running == [0, 1, 3, 4]
+
+    stats = pool.stats()
+    assert stats.running == 0
+    assert stats.queued == 0
+    assert stats.completed == 4
+    assert stats.average_run > 0
+
+    # Jobの中で発生したキャンセルは呼び出し元に伝え、ワーカーは止まらない
+    jobs = [create_job(i) for i in range(5, 9)]
+    for job in jobs:
+        pool.put_nowait(job)
+    with pytest.raises(asyncio.CancelledError):
+        await jobs[0].future
+    assert jobs[0].future.cancelled()
+    assert [await job.future for job in jobs[1:]] == [6, 7, 8]
+    assert pool.stats().workers == 2
+
+    # closeで未実行のJobはキャンセルされる
+    jobs = [create_job(i) for i in range(3)]
+    for job in jobs:
+        pool.put_nowait(job)
+    await asyncio.sleep(0)
+    await pool.close()
+    assert all(job.future.cancelled() for job in jobs)
+    assert pool.stats().workers == 0
+
+    # close後も再度利用できる
+    job = create_job(0)
+    pool.put_nowait(job)
+    assert await job.future == 0
+    await pool.close()
@@ -1,6 +1,7 @@
 import logging
 
 import pytest
+from pytest_mock.plugin import MockerFixture
 
 from exmachina.core.helper import set_verbose
 
@@ -14,3 +15,31 @@ def test_set_verbose(verbose: str, level: int):
     exmachina = logging.getLogger("exmachina")
 
     assert exmachina.level == level
+
+
+def test_set_verbose_use_queue(mocker: MockerFixture):
+    logger = logging.getLogger("exmachina.test_queue")
+    listener = set_verbose(logger, "INFO", use_queue=True)
+    assert listener is not None
+    assert [h.__class__.__name__ for h in logger.handlers] == ["RecordQueueHandler"]
+
+    # 二回目は登録しない
+    assert set_verbose(logger, "DEBUG", use_queue=True) is None
+    assert logger.level == 10
+    assert len(logger.handlers) == 1
+
+    # ログはバックグラウンドのスレッドでRichHandlerに渡される
+    records: list[logging.LogRecord] = []
+    mocker.patch.object(listener.handlers[0], "emit", records.append)
+    logger.info("message %s", 1)
+    try:
+        raise ZeroDivisionError
+    except ZeroDivisionError:
+        logger.exception("error")
+    listener.stop()
+    assert [r.getMessage() for r in records] == ["message 1", "error"]
+    # 整形せずに渡すので、RichHandlerがトレースバックを描画できる
+    assert records[0].args == (1,)
+    assert records[1].exc_info is not None and records[1].exc_info[0] is ZeroDivisionError
+
+    assert set_verbose(logger, None) is None
@@ -1,4 +1,9 @@
+import asyncio
+import time
+from contextlib import AsyncExitStack
+
 import pytest
+from pytest_mock.plugin import MockerFixture
 
 from exmachina.core.depends_contoroller import DependsContoroller, get_depends
 from exmachina.core.exception import MachinaException
@@ -6,6 +11,7 @@ from exmachina.core.exception import MachinaException
 # from exmachina import Depends
 from exmachina.core.params import Depends
 from exmachina.core.params_function import Depends as fDepends
+from exmachina.lib.cache import TTLCache
 
 
 def depends_function():
@@ -87,6 +93,9 @@ def test_repr():
         return x
 
     assert str(Depends(a, use_cache=False)) == "Depends(a, use_cache=False)"
+    assert str(Depends(a, scope="emit", ttl=60)) == "Depends(a, scope='emit', ttl=60)"
+    with pytest.raises(MachinaException, match="scope"):
+        Depends(a, scope="request")  # type: ignore
 
 
 @pytest.mark.asyncio
@@ -99,3 +108,298 @@ async def test_get_depends():
             ...
 
     assert 42 == await get_depends(get)
+
+
+@pytest.mark.asyncio
+async def test_get_depends_teardown():
+    events = []
+
+    def a():
+        yield "a"
+        events.append("close a")
+
+    async def b(x: str = fDepends(a, use_cache=False), y: str = fDepends(a)):
+        yield x + y + "b"
+        events.append("close b")
+
+    # キャッシュするかどうかによらず、generatorは戻る前に依存元から順に後処理する
+    assert await get_depends(b) == "aab"
+    assert events == ["close b", "close a", "close a"]
+
+    async def c(x: str = fDepends(b, use_cache=False)):
+        ...
+
+    events.clear()
+    assert await DependsContoroller.execute_plan(DependsContoroller.compile(c)) == dict(x="aab")
+    assert events == ["close b", "close a", "close a"]
+
+    # stackを渡すと、stackを閉じるまで後処理しない
+    events.clear()
+    async with AsyncExitStack() as stack:
+        assert await get_depends(b, stack=stack) == "aab"
+        assert events == []
+    assert events == ["close b", "close a", "close a"]
+
+
+def test_compile():
+    def a(x=1):
+        return x
+
+    async def b(x: int = fDepends(a)):
+        return x
+
+    def c(y: int = fDepends(a, use_cache=False), x: int = fDepends(b)):
+        return x + y
+
+    async def func(event, q=1, x: int = fDepends(b), z: int = fDepends(c)):
+        ...
+
+    plan = DependsContoroller.compile(func)
+
+    assert plan.args == ("event",)
+    assert plan.use_event is True
+    assert plan.defaults == (("q", 1),)
+    assert [key for key, _ in plan.depends] == ["x", "z"]
+    b_plan = plan.depends[0][1]
+    c_plan = plan.depends[1][1]
+    assert b_plan.kind == "async"
+    assert c_plan.kind == "sync"
+    # 同じDependsは同じノードを共有する
+    assert c_plan.depends[1][1] is b_plan
+    # use_cacheが異なるものは別のノードになる
+    assert c_plan.depends[0][1] is not b_plan.depends[0][1]
+    assert c_plan.depends[0][1].use_cache is False
+
+
+@pytest.mark.asyncio
+async def test_depends_scope():
+    calls = []
+
+    def a():
+        calls.append("a")
+        return len(calls)
+
+    def b(x: int = fDepends(a, scope="iteration")):
+        return x
+
+    def c(x: int = fDepends(a, scope="execute", ttl=10)):
+        return x
+
+    async def func(x: int = fDepends(a, scope="iteration"), y: int = fDepends(b, use_cache=False)):
+        ...
+
+    plan = DependsContoroller.compile(func)
+    assert plan.scopes == frozenset(["iteration"])
+    assert DependsContoroller.compile(c).depends[0][1].ttl == 10
+
+    # iterationは一回の解決の間だけ共有する
+    assert await DependsContoroller.execute_plan(plan) == dict(x=1, y=1)
+    assert await DependsContoroller.execute_plan(plan) == dict(x=2, y=2)
+
+    # emit/executeはownerごとに共有する
+    cache = TTLCache()
+    plan = DependsContoroller.compile(c)
+    assert await DependsContoroller.execute_plan(plan, cache=cache, owner=("execute", "x")) == dict(x=3)
+    assert await DependsContoroller.execute_plan(plan, cache=cache, owner=("execute", "x")) == dict(x=3)
+    assert await DependsContoroller.execute_plan(plan, cache=cache, owner=("execute", "y")) == dict(x=4)
+    assert len(cache) == 2
+
+    # ttlが違うDependsは別にキャッシュする
+    def d(x: int = fDepends(a, ttl=10), y: int = fDepends(a, ttl=20), z: int = fDepends(a, ttl=10)):
+        ...
+
+    cache = TTLCache()
+    assert await DependsContoroller.execute_plan(DependsContoroller.compile(d), cache=cache) == dict(x=5, y=6, z=5)
+    assert len(cache) == 2
+
+
+@pytest.mark.asyncio
+async def test_depends_without_machina():
+    calls = []
+
+    def a():
+        calls.append("a")
+        return len(calls)
+
+    async def func(x: int = fDepends(a), y: int = fDepends(a)):
+        ...
+
+    # Machinaの外では呼び出しの間だけキャッシュする
+    plan = DependsContoroller.compile(func)
+    assert await DependsContoroller.execute_plan(plan) == dict(x=1, y=1)
+    assert await DependsContoroller.execute_plan(plan) == dict(x=2, y=2)
+    assert await get_depends(a) == 3
+
+
+@pytest.mark.asyncio
+async def test_depends_concurrent():
+    calls = []
+
+    async def shared():
+        calls.append("shared")
+        await asyncio.sleep(0.05)
+        return 1
+
+    async def a(x: int = fDepends(shared, scope="iteration")):
+        await asyncio.sleep(0.05)
+        return x
+
+    async def b(x: int = fDepends(shared, scope="iteration")):
+        await asyncio.sleep(0.05)
+        return x + 1
+
+    async def c():
+        await asyncio.sleep(0.05)
+        return 3
+
+    async def func(x: int = fDepends(a), y: int = fDepends(b, use_cache=False), z: int = fDepends(c, use_cache=False)):
+        ...
+
+    # 独立したDependsは並行して実行し、共有するDependsは一度だけ実行する
+    start = time.perf_counter()
+    assert await DependsContoroller.get_depends_result(func) == dict(x=1, y=2, z=3)
+    assert time.perf_counter() - start < 0.15
+    assert calls == ["shared"]
+
+
+@pytest.mark.asyncio
+async def test_depends_concurrent_error():
+    # 一つが失敗したら残りは止める
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def error():
+        raise ZeroDivisionError
+
+    async def func2(x=fDepends(slow, use_cache=False), y=fDepends(error, use_cache=False)):
+        ...
+
+    # 止めたDependsの終了を待ってから送出する
+    with pytest.raises(ZeroDivisionError):
+        await DependsContoroller.get_depends_result(func2)
+    assert cancelled == [True]
+
+
+@pytest.mark.asyncio
+async def test_depends_sync_inline(mocker: MockerFixture):
+    def a():
+        return 1
+
+    def b(x: int = fDepends(a, use_cache=False)):
+        return x + 1
+
+    async def c():
+        return 3
+
+    def d(x: int = fDepends(c, use_cache=False)):
+        return x + 1
+
+    async def func(x=fDepends(a, use_cache=False), y=fDepends(b, use_cache=False), z=fDepends(d, use_cache=False)):
+        ...
+
+    plan = DependsContoroller.compile(func)
+    # 依存先にasyncの関数を含むものだけが待機する
+    assert [p.awaits for _, p in plan.depends] == [False, False, True]
+
+    # 待機するDependsが一つだけならタスクを作らない
+    create_task = mocker.spy(asyncio, "create_task")
+    assert await DependsContoroller.execute_plan(plan) == dict(x=1, y=2, z=4)
+    assert create_task.call_count == 0
+
+
+def test_depends_cycle():
+    def a(x=None):
+        return x
+
+    def b(x=fDepends(a)):
+        return x
+
+    # 定義後にデフォルト引数を書き換えて循環させる
+    a.__defaults__ = (fDepends(b),)
+
+    async def func(x=fDepends(b)):
+        ...
+
+    with pytest.raises(MachinaException, match="b -> a -> b"):
+        DependsContoroller.compile(func)
+
+
+@pytest.mark.asyncio
+async def test_depends_generator_teardown():
+    events = []
+
+    def a():
+        yield "a"
+        events.append("close a")
+
+    async def b(x: str = fDepends(a, use_cache=False)):
+        yield x + "b"
+        events.append("close b")
+
+    async def c(x: str = fDepends(b, scope="iteration"), y: str = fDepends(a, scope="execute")):
+        ...
+
+    plan = DependsContoroller.compile(c)
+    assert plan.teardown is True
+    assert DependsContoroller.compile(a).teardown is False
+
+    cache = TTLCache()
+    async with AsyncExitStack() as stack:
+        res = await DependsContoroller.execute_plan(plan, cache=cache, owner=("execute", "c"), stack=stack)
+        assert res == dict(x="ab", y="a")
+        assert events == []
+    # キャッシュしないものはstackを閉じた時に後処理する
+    assert events == ["close b", "close a"]
+    # キャッシュするものは削除した時に後処理する
+    await cache.aclose()
+    assert events == ["close b", "close a", "close a"]
+
+
+@pytest.mark.asyncio
+async def test_depends_cached_generator_owns_teardown():
+    events = []
+
+    def conn():
+        events.append("open conn")
+        try:
+            yield "conn"
+        finally:
+            events.append("close conn")
+
+    async def session(c: str = fDepends(conn, use_cache=False), i: str = fDepends(conn, scope="iteration")):
+        events.append("open session")
+        yield f"session({c}, {i})"
+        events.append("close session")
+
+    async def use(s: str = fDepends(session)):
+        events.append(f"use {s}")
+
+    plan = DependsContoroller.compile(use)
+    cache = TTLCache()
+    for _ in range(3):
+        async with AsyncExitStack() as stack:
+            kwargs = await DependsContoroller.execute_plan(plan, cache=cache, stack=stack)
+        await use(**kwargs)
+    # キャッシュしたgeneratorが使うキャッシュしないgeneratorは、解決の後ではなく依存元の後処理の後に後処理する
+    assert events == ["open conn", "open conn", "open session"] + ["use session(conn, conn)"] * 3
+    await cache.aclose()
+    assert events[-3:] == ["close session", "close conn", "close conn"]
+
+    # 依存元の解決に失敗した場合はその場で後処理する
+    async def broken(c: str = fDepends(conn, use_cache=False)):
+        raise ZeroDivisionError
+        yield
+
+    async def use_broken(b: str = fDepends(broken)):
+        ...
+
+    events.clear()
+    with pytest.raises(ZeroDivisionError):
+        await DependsContoroller.execute_plan(DependsContoroller.compile(use_broken), cache=TTLCache())
+    assert events == ["open conn", "close conn"]
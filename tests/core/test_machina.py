@@ -1,12 +1,48 @@
 import asyncio
+import gc
+import os
+import threading
+import traceback
+from datetime import timedelta
+from typing import Any
 from unittest.mock import MagicMock, patch
 
 import pytest
 from pytest_mock.plugin import MockerFixture
 
-from exmachina.core.exception import MachinaException
-from exmachina.core.machina import Event, Machina
+from exmachina.core.exception import MachinaException, QueueFullError
+from exmachina.core.machina import Emit, Event, Machina, _next_deadline
+from exmachina.core.params_function import Depends
+from exmachina.lib.adaptive import AIMD
+from exmachina.lib.circuit_breaker import CircuitBreaker, CircuitOpenError
+from exmachina.lib.cron import Cron
+from exmachina.lib.metrics import HistogramSnapshot
+from exmachina.lib.rate_backend import MemoryRateBackend
 from exmachina.lib.retry import Retry, RetryFixed
+from exmachina.lib.time_semaphore import GCRASemaphore
+from exmachina.lib.tracing import Middleware, Span
+
+
+def get_pid(x: int):
+    return os.getpid(), x
+
+
+class Recorder(Middleware):
+    def __init__(self):
+        self.spans: list[Span] = []
+        self.events: list[str] = []
+
+    def before(self, span: Span):
+        self.events.append(f"before {span.kind}")
+
+    def after(self, span: Span):
+        self.spans.append(span)
+
+    def startup(self):
+        self.events.append("startup")
+
+    def shutdown(self):
+        self.events.append("shutdown")
 
 
 @pytest.fixture(scope="class")
@@ -32,6 +68,28 @@ class TestMachina:
         with pytest.raises(MachinaException):
             bot.create_concurrent_group(name="test")
 
+        # 小数のtime_calls_limitとburstはengine="gcra"のみ
+        with pytest.raises(MachinaException):
+            bot.create_concurrent_group(name="fraction", time_limit=1, time_calls_limit=0.5)
+        with pytest.raises(MachinaException):
+            bot.create_concurrent_group(name="burst", time_limit=1, time_calls_limit=2, burst=2)
+        bot.create_concurrent_group(name="gcra", time_limit=1, time_calls_limit=0.5, engine="gcra")
+        assert "fraction" not in bot._concurrent_groups
+
+    def test_concurrent_group_backend(self, bot: Machina):
+        backend = MemoryRateBackend()
+        cg = bot.create_concurrent_group(
+            name="shared", time_limit=1, time_calls_limit=2, engine="gcra", backend=backend
+        )
+        assert isinstance(cg.semaphore, GCRASemaphore)
+        assert cg.semaphore.backend is backend
+
+        # backendはengine="gcra"のみ、shmはkeyが必要
+        with pytest.raises(MachinaException):
+            bot.create_concurrent_group(name="window", time_limit=1, backend=backend)
+        with pytest.raises(MachinaException):
+            bot.create_concurrent_group(name="nokey", time_limit=1, engine="gcra", backend="shm")
+
     @pytest.mark.asyncio
     async def test_emit(self, bot: Machina):
         # countに負の値は入れられない
@@ -152,7 +210,872 @@ class TestMachina:
 
         await bot_func_only.run()
         assert mock.call_count == 4
-        assert bot_func_only._execute_task_executings["test_execute2"] == 0
+        assert bot_func_only.stats().by_execute["test_execute2"].executings == 0
+
+    @pytest.mark.asyncio
+    async def test_tasks_and_stats(self, bot_func_only: Machina):
+        @bot_func_only.execute()
+        async def test_execute3():
+            await asyncio.sleep(0.01)
+
+        @bot_func_only.emit(count=1)
+        async def test_emit8(event: Event):
+            tasks = [event.execute("test_execute3") for _ in range(3)]
+            assert bot_func_only.tasks("test_execute3") == tasks
+            assert bot_func_only.tasks() == tasks
+
+            stats = bot_func_only.stats()
+            assert stats.emits == 1
+            assert stats.executes == 3
+            assert stats.by_execute["test_execute3"].tasks == 3
+
+            await asyncio.gather(*tasks)
+            assert bot_func_only.tasks("test_execute3") == []
+
+        await bot_func_only.run()
+        assert bot_func_only.stats().emits == 0
+
+    @pytest.mark.asyncio
+    async def test_execute_with_queue(self, bot_func_only: Machina):
+        bot_func_only.create_concurrent_group(name="queue", entire_calls_limit=2)
+
+        # max_tasksが決まらない場合はエラー
+        with pytest.raises(MachinaException):
+
+            @bot_func_only.execute(queue_size=1)
+            async def _():
+                ...
+
+        @bot_func_only.execute(concurrent_groups=["queue"], queue_size=2, overflow="error")
+        async def test_execute4(x: int):
+            await asyncio.sleep(0.01)
+            return x
+
+        @bot_func_only.execute(max_tasks=1, queue_size=1)
+        async def test_execute5(x: int):
+            await asyncio.sleep(0.01)
+            return x
+
+        @bot_func_only.emit(count=1)
+        async def test_emit9(event: Event):
+            queue = bot_func_only._executes["test_execute4"].queue
+            assert queue is not None and queue.max_tasks == 2
+
+            futures = [event.execute("test_execute4", i) for i in range(4)]
+            # max_tasksを超えた分はタスク化されない
+            assert queue.running == 2
+            assert queue.qsize() == 2
+            assert bot_func_only.stats().by_execute["test_execute4"].tasks == 4
+            with pytest.raises(QueueFullError):
+                event.execute("test_execute4", 4)
+            assert await asyncio.gather(*futures) == [0, 1, 2, 3]
+
+            # 空きが出るまで待機する
+            futures = [await event.submit("test_execute5", i) for i in range(3)]
+            assert futures[0].done()
+            assert await asyncio.gather(*futures) == [0, 1, 2]
+            # executeは待機できないのでoverflow="wait"でもqueue_sizeを超えると送出する
+            futures = [event.execute("test_execute5", i) for i in range(2)]
+            with pytest.raises(QueueFullError):
+                event.execute("test_execute5", 2)
+            assert await asyncio.gather(*futures) == [0, 1]
+
+            # キューのないexecuteもsubmitできる
+            assert await (await event.submit("test_execute6")) == 42
+
+            # 例外とキャンセルは呼び出し元のハンドルに伝わる
+            with pytest.raises(ZeroDivisionError):
+                await event.execute("test_execute7")
+            future = event.execute("test_execute5", 0)
+            await asyncio.sleep(0)
+            future.cancel()
+            await asyncio.sleep(0.005)
+            assert bot_func_only._executes["test_execute5"].queue.running == 0  # type: ignore
+
+        @bot_func_only.execute()
+        async def test_execute6():
+            return 42
+
+        @bot_func_only.execute(max_tasks=1)
+        async def test_execute7():
+            raise ZeroDivisionError
+
+        await bot_func_only.run()
+        assert len(bot_func_only._registry) == 0
+
+    @pytest.mark.asyncio
+    async def test_execute_coalesce(self, bot_func_only: Machina):
+        bot = bot_func_only
+        bot.create_concurrent_group(name="coalesce", entire_calls_limit=1)
+        calls = []
+
+        # keyはcoalesce=Trueかcache_ttlを指定した場合のみ
+        with pytest.raises(MachinaException):
+
+            @bot.execute(key=lambda x: x)
+            async def _(x):
+                ...
+
+        @bot.execute(concurrent_groups=["coalesce"], coalesce=True)
+        async def fetch(symbol: str, *, unit: int = 1):
+            calls.append(symbol)
+            await asyncio.sleep(0.01)
+            if symbol == "error":
+                raise ZeroDivisionError
+            return f"{symbol}{unit}"
+
+        @bot.execute(coalesce=True, key=lambda symbol, options: symbol)
+        async def fetch_by_symbol(symbol: str, options: dict):
+            calls.append(symbol)
+            await asyncio.sleep(0.01)
+            return options
+
+        @bot.emit(count=1)
+        async def _(event: Event):
+            # 実行中の同じ呼び出しは一つにまとめ、枠も一つしか使わない
+            futures = [event.execute("fetch", "a") for _ in range(3)] + [fetch("a", unit=2), fetch("b")]
+            assert bot.stats().by_execute["fetch"].tasks == 3
+            assert await asyncio.gather(*futures) == ["a1", "a1", "a1", "a2", "b1"]
+            assert calls == ["a", "a", "b"]
+            # 終わった後の呼び出しは新たに実行する
+            assert await event.execute("fetch", "a") == "a1"
+            assert calls == ["a", "a", "b", "a"]
+
+            # 例外はまとめた全ての呼び出し元に送出する
+            results = await asyncio.gather(*[fetch("error") for _ in range(2)], return_exceptions=True)
+            assert [type(result) for result in results] == [ZeroDivisionError] * 2
+
+            # 一部の呼び出し元がキャンセルしても実行は続き、全てキャンセルすると実行もキャンセルする
+            calls.clear()
+            first, second = event.execute("fetch", "c"), event.execute("fetch", "c")
+            first.cancel()
+            assert await second == "c1"
+            third, fourth = event.execute("fetch", "d"), event.execute("fetch", "d")
+            await asyncio.sleep(0)
+            third.cancel()
+            fourth.cancel()
+            await asyncio.sleep(0.02)
+            assert calls == ["c", "d"]
+            assert len(bot.tasks("fetch")) == 0
+
+            # keyで同じ呼び出しとみなす引数を選べる. 引数がハッシュできなくてもよい
+            calls.clear()
+            results = await asyncio.gather(fetch_by_symbol("a", {"x": 1}), fetch_by_symbol("a", {"x": 2}))
+            assert results == [{"x": 1}, {"x": 1}]
+            assert calls == ["a"]
+            # キーがハッシュできない呼び出しはまとめない
+            calls.clear()
+            await asyncio.gather(fetch(["a"]), fetch(["a"]))  # type: ignore
+            assert calls == [["a"], ["a"]]
+
+        await bot.run()
+        snapshot = bot.metrics.snapshot()["exmachina_execute_coalesced_total"]
+        assert snapshot == {("fetch",): 5, ("fetch_by_symbol",): 1}
+
+    @pytest.mark.asyncio
+    async def test_execute_coalesce_submit(self, bot_func_only: Machina):
+        bot = bot_func_only
+        calls = []
+
+        @bot.execute(max_tasks=1, queue_size=1, coalesce=True)
+        async def fetch(x: int):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            return x
+
+        @bot.emit(count=1)
+        async def _(event: Event):
+            # まとめられる呼び出しはキューの空きを待たずに結果を受け取る
+            futures = [await event.submit("fetch", 1) for _ in range(3)]
+            futures.append(await event.submit("fetch", 2))
+            assert await asyncio.gather(*futures) == [1, 1, 1, 2]
+            assert calls == [1, 2]
+
+        await bot.run()
+
+    @pytest.mark.asyncio
+    async def test_execute_cache(self, bot_func_only: Machina):
+        bot = bot_func_only
+        calls = []
+
+        # cache_errorsとstale_while_revalidateはcache_ttlを指定した場合のみ
+        options: list[dict[str, Any]] = [dict(cache_errors=1), dict(stale_while_revalidate=1), dict(cache_ttl=0)]
+        for kwargs in options:
+            with pytest.raises(MachinaException):
+
+                @bot.execute(**kwargs)
+                async def _():
+                    ...
+
+        @bot.execute(cache_ttl=0.05, cache_size=2)
+        async def fetch(x: int):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            return x
+
+        @bot.execute(cache_ttl=0.05, cache_errors=0.05, key=lambda x: x % 2)
+        async def fail(x: int):
+            calls.append(x)
+            raise ZeroDivisionError
+
+        @bot.execute(cache_ttl=0.05)
+        async def fail_once(x: int):
+            calls.append(x)
+            raise ZeroDivisionError
+
+        @bot.emit(count=1)
+        async def _(event: Event):
+            # キャッシュにない同じ呼び出しは一つにまとめ、その後はキャッシュから返す
+            assert await asyncio.gather(fetch(1), event.execute("fetch", 1)) == [1, 1]
+            assert await fetch(1) == 1
+            assert calls == [1]
+            assert bot.stats().by_execute["fetch"].tasks == 0
+
+            # 件数を超えると最も長く使われていないものから削除する
+            await fetch(2)
+            await fetch(1)
+            await fetch(3)
+            await fetch(1)
+            await fetch(2)
+            assert calls == [1, 2, 3, 2]
+
+            # cache_ttlを過ぎると再実行する
+            await asyncio.sleep(0.06)
+            await fetch(1)
+            assert calls == [1, 2, 3, 2, 1]
+
+            # cache_errorsを指定すると例外もキャッシュする. keyで同じ呼び出しとみなす引数を選べる
+            calls.clear()
+            for x in [1, 3]:
+                with pytest.raises(ZeroDivisionError):
+                    await fail(x)
+            for _ in range(2):
+                with pytest.raises(ZeroDivisionError):
+                    await fail_once(1)
+            assert calls == [1, 1, 1]
+            # キャッシュした例外は呼び出し毎にコピーを送出し、tracebackが伸び続けない
+            errors = []
+            for _ in range(3):
+                with pytest.raises(ZeroDivisionError) as e:
+                    await fail(1)
+                errors.append(e.value)
+            assert errors[1] is not errors[2]
+            assert len(traceback.extract_tb(errors[1].__traceback__)) == len(
+                traceback.extract_tb(errors[2].__traceback__)
+            )
+            assert calls == [1, 1, 1]
+
+        await bot.run()
+        snapshot = bot.metrics.snapshot()["exmachina_execute_cache_total"]
+        assert snapshot[("fetch", "hit")] == 3
+        assert snapshot[("fetch", "miss")] == 6
+        assert bot.metrics.snapshot()["exmachina_execute_coalesced_total"][("fetch",)] == 1
+        # 終了するとキャッシュを消す
+        assert bot._executes["fetch"].result_cache.get(((2,), ())) is None  # type: ignore
+
+    @pytest.mark.asyncio
+    async def test_execute_cache_stale_while_revalidate(self, bot_func_only: Machina):
+        bot = bot_func_only
+        bot.create_concurrent_group(name="rate", entire_calls_limit=1)
+        calls = []
+        version = 0
+
+        @bot.execute(concurrent_groups=["rate"], cache_ttl=0.05, stale_while_revalidate=0.1)
+        async def fetch(x: int):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            if version < 0:
+                raise ZeroDivisionError
+            return (x, version)
+
+        @bot.execute(concurrent_groups=["rate"])
+        async def hold():
+            await asyncio.sleep(0.03)
+
+        @bot.emit(count=1)
+        async def _(event: Event):
+            nonlocal version
+            assert await fetch(1) == (1, 0)
+            version = 1
+            await asyncio.sleep(0.06)
+
+            # 古い結果をすぐに返し、再実行は一度だけconcurrent_groupの制限の中で行う
+            holding = hold()
+            await asyncio.sleep(0)
+            assert await asyncio.gather(*[fetch(1) for _ in range(3)]) == [(1, 0)] * 3
+            assert calls == [1]
+            await holding
+            await asyncio.sleep(0.02)
+            assert calls == [1, 1]
+            assert await fetch(1) == (1, 1)
+
+            # 再実行が失敗しても古い結果を返し続け、失敗した再実行の例外は未取得の警告を出さない
+            unretrieved = []
+            asyncio.get_running_loop().set_exception_handler(lambda loop, context: unretrieved.append(context))
+            version = -1
+            await asyncio.sleep(0.06)
+            assert await fetch(1) == (1, 1)
+            await asyncio.sleep(0.02)
+            assert await fetch(1) == (1, 1)
+            await asyncio.sleep(0.02)
+            assert calls == [1, 1, 1, 1]
+            gc.collect()
+            assert unretrieved == []
+            asyncio.get_running_loop().set_exception_handler(None)
+
+            # stale_while_revalidateも過ぎると新たに実行する
+            version = 2
+            await asyncio.sleep(0.12)
+            assert await fetch(1) == (1, 2)
+
+        await bot.run()
+        snapshot = bot.metrics.snapshot()["exmachina_execute_cache_total"]
+        assert snapshot[("fetch", "stale")] == 3
+
+    @pytest.mark.asyncio
+    async def test_execute_with_workers(self, bot_func_only: Machina):
+        bot_func_only.create_concurrent_group(name="pool1", entire_calls_limit=2, workers=2)
+        bot_func_only.create_concurrent_group(name="pool2", workers=1)
+
+        # workersを持つgroupは一つまで
+        with pytest.raises(MachinaException):
+
+            @bot_func_only.execute(concurrent_groups=["pool1", "pool2"])
+            async def _():
+                ...
+
+        # max_tasksとは併用できない
+        with pytest.raises(MachinaException):
+
+            @bot_func_only.execute(concurrent_groups=["pool1"], max_tasks=1)
+            async def _():
+                ...
+
+        @bot_func_only.execute(concurrent_groups=["pool1"])
+        async def test_execute8(x: int):
+            await asyncio.sleep(0.01)
+            return x
+
+        @bot_func_only.execute(concurrent_groups=["pool1"])
+        async def test_execute9():
+            raise ZeroDivisionError
+
+        @bot_func_only.emit(count=1)
+        async def test_emit10(event: Event):
+            futures = [event.execute("test_execute8", i) for i in range(5)]
+            assert bot_func_only.stats().by_execute["test_execute8"].tasks == 5
+            assert await asyncio.gather(*futures) == [0, 1, 2, 3, 4]
+            assert await test_execute8(42) == 42
+            with pytest.raises(ZeroDivisionError):
+                await event.execute("test_execute9")
+
+            pool = bot_func_only._concurrent_groups["pool1"].pool
+            assert pool is not None and pool.stats().completed == 7
+
+        await bot_func_only.run()
+        # shutdownでワーカーは停止する
+        assert bot_func_only._concurrent_groups["pool1"].pool.stats().workers == 0  # type: ignore
+
+    @pytest.mark.asyncio
+    async def test_execute_with_executor(self, bot_func_only: Machina):
+        # executorには同期関数のみ
+        with pytest.raises(MachinaException):
+
+            @bot_func_only.execute(executor="thread")
+            async def _():
+                ...
+
+        # processはトップレベルの関数のみ
+        with pytest.raises(MachinaException):
+
+            @bot_func_only.execute(executor="process")
+            def _():
+                ...
+
+        @bot_func_only.execute(executor="thread", max_workers=2)
+        def test_execute10(x: int):
+            return threading.get_ident(), x
+
+        bot_func_only.execute(name="test_execute11", executor="process", max_workers=1)(get_pid)
+
+        @bot_func_only.emit(count=1)
+        async def test_emit11(event: Event):
+            assert set(bot_func_only._executors) == {"test_execute10", "test_execute11"}
+
+            ident, x = await event.execute("test_execute10", 42)
+            assert ident != threading.get_ident()
+            assert x == 42
+
+            pid, x = await event.execute("test_execute11", 42)
+            assert pid != os.getpid()
+            assert x == 42
+
+        await bot_func_only.run()
+        # shutdownでプールは破棄される
+        assert bot_func_only._executors == {}
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("requeue", [False, True])
+    async def test_execute_retry_backoff_releases_slots(self, bot_func_only: Machina, requeue: bool):
+        cg = bot_func_only.create_concurrent_group(
+            name="backoff", entire_calls_limit=1, time_limit=10, time_calls_limit=3
+        )
+        pool = bot_func_only.create_concurrent_group(name="backoff_pool", workers=1).pool
+        assert pool is not None
+        retry = Retry([RetryFixed(ZeroDivisionError, wait_time=0.1, retries=1)], requeue=requeue)
+        calls = []
+
+        @bot_func_only.execute(concurrent_groups=["backoff", "backoff_pool"], retry=retry)
+        async def test_execute14(i: int):
+            calls.append(i)
+            if len(calls) == 1:
+                raise ZeroDivisionError
+            return i
+
+        @bot_func_only.emit(count=1)
+        async def test_emit14(event: Event):
+            first = event.execute("test_execute14", 1)
+            await asyncio.sleep(0.02)
+
+            # 待機中は並列実行数の枠もワーカーも持たない
+            assert calls == [1]
+            assert not cg.semaphore._sem.locked()
+            assert pool.stats().running == (0 if requeue else 1)
+            assert bot_func_only.stats().by_execute["test_execute14"].executings == 0
+
+            if requeue:
+                # 待機中の呼び出しに追い越される
+                assert await event.execute("test_execute14", 2) == 2
+                assert await first == 1
+                assert calls == [1, 2, 1]
+            else:
+                assert await first == 1
+                assert calls == [1, 1]
+
+        await bot_func_only.run()
+
+    @pytest.mark.asyncio
+    async def test_execute_requeue_cancel(self, bot_func_only: Machina):
+        retry = Retry([RetryFixed(ZeroDivisionError, wait_time=10)], requeue=True)
+        calls = []
+
+        @bot_func_only.execute(retry=retry)
+        async def test_execute15():
+            calls.append(1)
+            raise ZeroDivisionError
+
+        @bot_func_only.emit(count=1)
+        async def test_emit15(event: Event):
+            task = event.execute("test_execute15")
+            await asyncio.sleep(0.01)
+            assert bot_func_only.stats().executes == 1
+
+            # 待機中にキャンセルすると再投入されない
+            task.cancel()
+            await asyncio.sleep(0)
+            assert bot_func_only.stats().executes == 0
+            assert calls == [1]
+
+        await bot_func_only.run()
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("scheduler", ["asyncio", "wheel"])
+    async def test_emit_entire(self, scheduler):
+        bot = Machina(scheduler=scheduler, timer_resolution=0.005)
+        loop = asyncio.get_running_loop()
+        starts = []
+
+        @bot.emit(count=5, interval="20ms", mode="entire")
+        async def test_emit16():
+            starts.append(loop.time())
+            # 処理時間が変動しても実行予定時刻は前回の予定時刻から数える
+            await asyncio.sleep(0.015 if len(starts) % 2 else 0.001)
+
+        await bot.run()
+        for i, start in enumerate(starts):
+            # 誤差が蓄積する場合は4回目で0.03秒以上遅れる
+            assert starts[0] + 0.02 * i - 0.001 <= start < starts[0] + 0.02 * i + 0.02
+        assert bot._timer_wheel is None
+
+    @pytest.mark.parametrize(
+        "missed, now, expected",
+        [
+            # 遅れていない
+            ("skip", 10.5, 11.0),
+            # 10.0の次は11.0だが13.5まで遅れた場合
+            ("skip", 13.5, 14.0),
+            ("catch_up", 13.5, 11.0),
+            ("coalesce", 13.5, 13.0),
+        ],
+    )
+    def test_next_deadline(self, missed, now: float, expected: float):
+        async def func():
+            ...
+
+        bot = Machina()
+        emit = Emit(name="emit", func=func, interval="1s", mode="entire", alive=True, missed=missed)
+        assert _next_deadline(emit, bot, 10.0, 1.0, now) == expected
+        # intervalが0の場合は常に今
+        assert _next_deadline(emit, bot, 10.0, 0, now) == now
+
+    def test_emit_missed_invalid(self, bot_func_only: Machina):
+        with pytest.raises(MachinaException, match="missed"):
+            bot_func_only.emit(mode="entire", missed="skipp")  # type: ignore
+
+    def test_next_deadline_warns_once(self, mocker: MockerFixture):
+        async def func():
+            ...
+
+        bot = Machina()
+        warning = mocker.patch.object(bot.logger, "warning")
+        emit = Emit(name="emit", func=func, interval="1s", mode="entire", alive=True, missed="catch_up")
+        # 遅れを取り戻している間は警告を繰り返さない
+        deadline = 10.0
+        for _ in range(3):
+            deadline = _next_deadline(emit, bot, deadline, 1.0, 13.5)
+        assert deadline == 13.0
+        assert warning.call_count == 1
+        # 遅れを取り戻した後に再び遅れると警告する
+        assert _next_deadline(emit, bot, deadline, 1.0, 13.5) == 14.0
+        _next_deadline(emit, bot, 14.0, 1.0, 20.5)
+        assert warning.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_emit_max_in_flight(self, bot_func_only: Machina):
+        with pytest.raises(MachinaException):
+            bot_func_only.emit(max_in_flight=0)
+        with pytest.raises(MachinaException):
+            bot_func_only.emit(max_in_flight=2)
+
+        loop = asyncio.get_running_loop()
+        starts = []
+        running = 0
+        max_running = 0
+
+        @bot_func_only.emit(count=6, interval="10ms", mode="entire", max_in_flight=2)
+        async def test_emit18():
+            nonlocal running, max_running
+            starts.append(loop.time())
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.015)
+            running -= 1
+
+        await bot_func_only.run()
+        # 前回の終了を待たずに実行予定時刻通りに実行する
+        assert max_running == 2
+        assert running == 0
+        assert starts[1] - starts[0] < 0.013
+
+        # 並行して実行中のタスクの例外でemitは停止する
+        calls = []
+
+        @bot_func_only.emit(interval="10ms", mode="entire", max_in_flight=3)
+        async def test_emit19():
+            calls.append(1)
+            if len(calls) == 2:
+                raise ZeroDivisionError
+            await asyncio.sleep(1)
+
+        with pytest.raises(ZeroDivisionError):
+            await bot_func_only.run()
+        assert len(calls) == 2
+
+    @pytest.mark.asyncio
+    async def test_emit_cron(self, bot_func_only: Machina, mocker: MockerFixture):
+        with pytest.raises(MachinaException):
+            bot_func_only.emit(cron="* * * * *", interval="1s")
+        with pytest.raises(MachinaException):
+            bot_func_only.emit(cron="* * * *")
+        # 一致する時刻がないスケジュールは登録時に検出する
+        with pytest.raises(MachinaException):
+            bot_func_only.emit(cron="0 0 31 2 *")
+
+        next_ = mocker.patch.object(Cron, "next", side_effect=lambda now: now + timedelta(seconds=0.02))
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        starts = []
+
+        @bot_func_only.emit(count=2, cron="*/5 * * * *")
+        async def test_emit17():
+            starts.append(loop.time() - start)
+
+        await bot_func_only.run()
+        # 最初の実行もスケジュールに従う
+        assert starts[0] >= 0.019
+        assert starts[1] - starts[0] >= 0.019
+        # 登録時の確認と2回の実行
+        assert next_.call_count == 3
+
+    @pytest.mark.asyncio
+    async def test_metrics(self, mocker: MockerFixture):
+        async def sleep(delay, result=None):
+            return result
+
+        mocker.patch("exmachina.lib.retry.asyncio.sleep", sleep)
+        bot = Machina(metrics_port=0)
+        bot.create_concurrent_group(name="metrics", entire_calls_limit=1)
+        retry = Retry([RetryFixed(ZeroDivisionError, wait_time=0.5, retries=1)])
+        fails = [True]
+
+        @bot.execute(concurrent_groups=["metrics"], retry=retry, max_tasks=1)
+        async def test_execute20():
+            if fails.pop() if fails else False:
+                raise ZeroDivisionError
+            await asyncio.sleep(0.01)
+
+        @bot.emit(count=2)
+        async def test_emit20(event: Event):
+            await asyncio.gather(event.execute("test_execute20"), event.execute("test_execute20"))
+            snapshot = bot.metrics.snapshot()
+            assert snapshot["exmachina_group_in_flight"] == {("metrics",): 0}
+            assert snapshot["exmachina_execute_queued"] == {("test_execute20",): 0}
+            assert bot._metrics_server is not None
+
+        await bot.run()
+        assert bot._metrics_server is None
+
+        snapshot = bot.metrics.snapshot()
+
+        def histogram(name: str, *labels: str) -> HistogramSnapshot:
+            value = snapshot[name][labels]
+            assert isinstance(value, HistogramSnapshot)
+            return value
+
+        assert histogram("exmachina_emit_duration_seconds", "test_emit20").count == 2
+        assert snapshot["exmachina_execute_total"] == {("test_execute20", "ok"): 4, ("test_execute20", "error"): 1}
+        assert histogram("exmachina_execute_duration_seconds", "test_execute20").count == 5
+        assert histogram("exmachina_execute_queue_wait_seconds", "test_execute20").count == 4
+        assert histogram("exmachina_group_wait_seconds", "metrics").count == 5
+        rule = ("RetryFixed(ZeroDivisionError)",)
+        assert snapshot["exmachina_retry_attempts_total"] == {rule: 1}
+        assert histogram("exmachina_retry_sleep_seconds", *rule).sum == 0.5
+
+        # 複数のbotで共有したRetryはそれぞれのbotに記録し、元のRetryは変更しない
+        other = Machina()
+
+        @other.execute(retry=retry)
+        async def test_execute20_other():
+            ...
+
+        assert retry.metrics is None and retry.tracer is None
+        assert bot._executes["test_execute20"].retry.metrics is bot.metrics  # type: ignore
+        assert other._executes["test_execute20_other"].retry.metrics is other.metrics  # type: ignore
+        assert other._executes["test_execute20_other"].retry.tracer is other.tracer  # type: ignore
+
+        # メトリクスを記録しない
+        bot = Machina(metrics=False)
+
+        @bot.execute()
+        async def test_execute21():
+            ...
+
+        assert bot._executes["test_execute21"].instruments is None
+        assert bot.metrics.snapshot() == {}
+
+    @pytest.mark.asyncio
+    async def test_middleware(self, mocker: MockerFixture):
+        async def sleep(delay, result=None):
+            return result
+
+        mocker.patch("exmachina.lib.retry.asyncio.sleep", sleep)
+
+        bot = Machina()
+        recorder = bot.add_middleware(Recorder())
+        bot.create_concurrent_group(name="trace", entire_calls_limit=1)
+        fails = [True]
+
+        def get_value():
+            return 1
+
+        @bot.execute(concurrent_groups=["trace"], retry=Retry([RetryFixed(ZeroDivisionError, wait_time=0.5)]))
+        async def test_execute22(value=Depends(get_value, use_cache=False)):
+            if fails.pop() if fails else False:
+                raise ZeroDivisionError
+            return value
+
+        @bot.emit(count=1)
+        async def test_emit22(event: Event):
+            assert await event.execute("test_execute22") == 1
+
+        await bot.run()
+
+        assert recorder.events[0] == "startup"
+        assert recorder.events[-1] == "shutdown"
+        spans = {(span.kind, span.name): span for span in recorder.spans}
+        assert [span.kind for span in recorder.spans] == [
+            "acquire",
+            "depends",
+            "retry",
+            "acquire",
+            "depends",
+            "execute",
+            "emit",
+        ]
+        emit = spans[("emit", "test_emit22")]
+        execute = spans[("execute", "test_execute22")]
+        retry = spans[("retry", "RetryFixed(ZeroDivisionError)")]
+        assert emit.parent is None
+        assert execute.parent is emit
+        assert retry.parent is execute
+        assert retry.attributes == {"sleep": 0.5}
+        assert spans[("acquire", "test_execute22")].parent is execute
+        assert spans[("depends", "TestMachina.test_middleware.<locals>.get_value")].parent is execute
+
+    @pytest.mark.asyncio
+    async def test_depends_cache(self):
+        calls: list[str] = []
+
+        async def get_token():
+            calls.append("token")
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        def get_epoch():
+            calls.append("epoch")
+            return len(calls)
+
+        bot = Machina()
+
+        @bot.execute()
+        async def test_execute23(token=Depends(get_token, scope="execute")):
+            return token
+
+        @bot.emit(count=2)
+        async def test_emit23(
+            event: Event, token=Depends(get_token, scope="emit"), epoch=Depends(get_epoch, scope="iteration")
+        ):
+            # 同時に呼び出しても一度だけ実行する
+            results = await asyncio.gather(*[event.execute("test_execute23") for _ in range(3)])
+            assert len(set(results)) == 1
+
+        await bot.run()
+        # emit: 1回, iteration: 2回, execute: 1回
+        assert sorted(calls) == ["epoch", "epoch", "token", "token"]
+        # 終了時に破棄する
+        assert len(bot.depends_cache) == 0
+
+        # 別のbotとはキャッシュを共有しない
+        other = Machina(depends_cache_size=1)
+
+        @other.emit(count=1)
+        async def test_emit24(token=Depends(get_token, ttl=0)):
+            ...
+
+        await other.run()
+        assert len(calls) == 5
+
+        with pytest.raises(MachinaException):
+
+            @bot.emit()
+            async def test_emit25(token=Depends(get_token, scope="execute")):
+                ...
+
+        with pytest.raises(MachinaException):
+
+            @bot.execute()
+            async def test_execute25(token=Depends(get_token, scope="emit")):
+                ...
+
+    @pytest.mark.asyncio
+    async def test_depends_teardown(self):
+        events: list[str] = []
+
+        async def get_session():
+            events.append("open session")
+            yield "session"
+            events.append("close session")
+
+        def get_connection():
+            events.append("open connection")
+            try:
+                yield "connection"
+            except ZeroDivisionError:
+                events.append("rollback")
+                raise
+            events.append("close connection")
+
+        bot = Machina()
+        bot.create_concurrent_group(name="teardown", entire_calls_limit=1)
+
+        @bot.execute(concurrent_groups=["teardown"])
+        async def test_execute26(fail: bool, connection=Depends(get_connection, scope="iteration")):
+            events.append(f"execute {connection}")
+            if fail:
+                raise ZeroDivisionError
+
+        @bot.emit(count=2)
+        async def test_emit26(event: Event, session=Depends(get_session)):
+            await event.execute("test_execute26", False)
+            # 後処理は呼び出しの完了までに終わっている
+            assert events[-1] == "close connection"
+            with pytest.raises(ZeroDivisionError):
+                await event.execute("test_execute26", True)
+
+        await bot.run()
+        # executeのgeneratorは呼び出し毎、appのscopeのgeneratorは終了時に後処理する
+        assert events == [
+            "open session",
+            *["open connection", "execute connection", "close connection"],
+            *["open connection", "execute connection", "rollback"],
+            *["open connection", "execute connection", "close connection"],
+            *["open connection", "execute connection", "rollback"],
+            "close session",
+        ]
+
+    @pytest.mark.asyncio
+    async def test_execute_with_breaker(self, bot_func_only: Machina):
+        breaker = CircuitBreaker(failure_threshold=2, recovery_time=60)
+        cg = bot_func_only.create_concurrent_group(name="breaker", entire_calls_limit=1, breaker=breaker)
+        calls = []
+
+        @bot_func_only.execute(concurrent_groups=["breaker"])
+        async def test_execute13():
+            calls.append(1)
+            raise ZeroDivisionError
+
+        @bot_func_only.emit(count=1)
+        async def test_emit13(event: Event):
+            for _ in range(2):
+                with pytest.raises(ZeroDivisionError):
+                    await event.execute("test_execute13")
+            assert breaker.state == "open"
+
+            # 開いている間は枠を取らずに失敗する
+            await cg.semaphore.acquire()
+            with pytest.raises(CircuitOpenError):
+                await event.execute("test_execute13")
+            cg.semaphore.release()
+            assert len(calls) == 2
+
+        await bot_func_only.run()
+
+    @pytest.mark.asyncio
+    async def test_execute_with_adaptive(self, bot_func_only: Machina):
+        aimd = AIMD(initial_limit=4, min_limit=1, max_limit=8)
+
+        with pytest.raises(MachinaException):
+            bot_func_only.create_concurrent_group(name="adaptive", entire_calls_limit=4, adaptive=aimd)
+
+        cg = bot_func_only.create_concurrent_group(name="adaptive", adaptive=aimd)
+        assert cg.semaphore.entire_calls_limit == 4
+
+        @bot_func_only.execute(concurrent_groups=["adaptive"])
+        async def test_execute12(fail: bool):
+            if fail:
+                raise ZeroDivisionError
+
+        @bot_func_only.emit(count=1)
+        async def test_emit12(event: Event):
+            for _ in range(10):
+                with pytest.raises(ZeroDivisionError):
+                    await event.execute("test_execute12", True)
+            assert cg.semaphore.entire_calls_limit == 1
+
+            await asyncio.gather(*[event.execute("test_execute12", False) for _ in range(20)])
+            assert cg.semaphore.entire_calls_limit > 1
+
+        await bot_func_only.run()
 
     @pytest.mark.asyncio
     async def test_start_shutdown(self):
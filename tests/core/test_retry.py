@@ -1,9 +1,22 @@
 import pytest
 from pytest_mock.plugin import MockerFixture
 
+from exmachina.lib.circuit_breaker import CircuitBreaker, CircuitOpenError, RetryBudget
 from exmachina.lib.retry import Retry, RetryExponentialAndJitter, RetryFibonacci, RetryFixed, RetryRange, RetryRule
 
 
+def patch_sleep(mocker: MockerFixture) -> list:
+    """リトライの待機をせずに待機時間を記録する. mocker.AsyncMockはPython 3.8以降のみなので使わない"""
+    waits = []
+
+    async def sleep(delay, result=None):
+        waits.append(delay)
+        return result
+
+    mocker.patch("exmachina.lib.retry.asyncio.sleep", sleep)
+    return waits
+
+
 @pytest.mark.asyncio
 async def test_retry_simple(mocker: MockerFixture):
     retry = Retry([RetryFixed(Exception, wait_time=0, retries=2, filter=lambda e: False)])
@@ -129,3 +142,97 @@ def test_abstract_generate_wait_time():
 
     with pytest.raises(NotImplementedError):
         tr.generate_wait_time()
+
+
+@pytest.mark.asyncio
+async def test_retry_unlimited(mocker: MockerFixture):
+    # 再帰しないのでリトライ回数が多くてもRecursionErrorにならない
+    n = 5000
+    func = mocker.MagicMock(side_effect=[ValueError] * n + [1])
+    patch_sleep(mocker)
+
+    @Retry([RetryFixed(ValueError, wait_time=0)])
+    async def wrap():
+        return func()
+
+    assert await wrap() == 1
+    assert func.call_count == n + 1
+
+
+@pytest.mark.asyncio
+async def test_retry_exception_tuple(mocker: MockerFixture):
+    # isinstanceと同様に例外クラスのタプルを指定できる
+    func = mocker.MagicMock(side_effect=[ValueError, KeyError, ZeroDivisionError])
+    retry = Retry([RetryFixed((ValueError, LookupError), wait_time=0)])
+
+    @retry
+    async def wrap():
+        return func()
+
+    with pytest.raises(ZeroDivisionError):
+        await wrap()
+    assert func.call_count == 3
+    assert retry.label(0) == "RetryFixed(ValueError, LookupError)"
+
+
+@pytest.mark.asyncio
+async def test_retry_rule_as_decorator(mocker: MockerFixture):
+    func = mocker.MagicMock(side_effect=[ValueError, KeyError, 1])
+
+    # Python 3.8以前は式をデコレータに書けないので、一度変数に入れる
+    retry_lookup = RetryFixed(LookupError, wait_time=0, retries=1)(None)
+    retry_value = RetryFixed(ValueError, wait_time=0, retries=1)()
+
+    @retry_lookup
+    @retry_value
+    async def wrap():
+        return func()
+
+    assert await wrap() == 1
+    assert func.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_retry_with_budget(mocker: MockerFixture):
+    patch_sleep(mocker)
+    budget = RetryBudget(ratio=0, min_retries=3)
+    func = mocker.MagicMock(side_effect=ValueError)
+
+    # 予算は複数のRetryで共有される
+    @Retry([RetryFixed(ValueError, wait_time=0)], budget=budget)
+    async def wrap1():
+        func()
+
+    @Retry([RetryFixed(ValueError, wait_time=0)], budget=budget)
+    async def wrap2():
+        func()
+
+    with pytest.raises(ValueError):
+        await wrap1()
+    assert func.call_count == 4
+    with pytest.raises(ValueError):
+        await wrap2()
+    assert func.call_count == 5
+
+
+@pytest.mark.asyncio
+async def test_retry_with_breaker(mocker: MockerFixture):
+    waits = patch_sleep(mocker)
+    breaker = CircuitBreaker(failure_threshold=3, recovery_time=60)
+    func = mocker.MagicMock(side_effect=ValueError)
+
+    @Retry([RetryFixed(Exception, wait_time=1)], breaker=breaker)
+    async def wrap():
+        func()
+
+    # 開いた時点で待機せずに失敗する
+    with pytest.raises(ValueError):
+        await wrap()
+    assert func.call_count == 3
+    assert len(waits) == 2
+
+    # 開いている間は実行せずに失敗し、CircuitOpenErrorはリトライしない
+    with pytest.raises(CircuitOpenError):
+        await wrap()
+    assert func.call_count == 3
+    assert len(waits) == 2
@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import signal
+import time
+from pathlib import Path
+
+import pytest
+
+from exmachina.core.exception import MachinaException
+from exmachina.core.machina import Event, Machina
+from exmachina.core.sharding import _share
+from exmachina.lib.hash_ring import HashRing
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="forkが使えない環境")
+
+
+def _names_by_owner(workers: int, count: int) -> list[list[str]]:
+    """shard毎に担当するemitの名前をcount個ずつ集める"""
+    ring = HashRing(range(workers))
+    names: list[list[str]] = [[] for _ in range(workers)]
+    i = 0
+    while any(len(n) < count for n in names):
+        name = f"emit{i}"
+        owner = ring.get(name)
+        if len(names[owner]) < count:
+            names[owner].append(name)
+        i += 1
+    return names
+
+
+def _record(path: Path, name: str):
+    with open(path, "a") as f:
+        f.write(f"{name} {os.getpid()}\n")
+
+
+def _read(path: Path) -> dict[str, int]:
+    return dict((name, int(pid)) for name, pid in (line.split() for line in path.read_text().splitlines()))
+
+
+def test_hash_ring():
+    with pytest.raises(ValueError):
+        HashRing(range(2), replicas=0)
+    with pytest.raises(LookupError):
+        HashRing([]).get("a")
+
+    keys = [f"key{i}" for i in range(1000)]
+    ring = HashRing(range(4))
+    assert len(ring) == 4
+    before = {key: ring.get(key) for key in keys}
+    # 同じノードなら常に同じ割り当てになり、どのノードにも割り当てられる
+    assert before == {key: HashRing(range(4)).get(key) for key in keys}
+    assert set(before.values()) == {0, 1, 2, 3}
+
+    # ノードを追加しても、割り当てが変わるのは追加したノードに移るキーのみ
+    ring.add(4)
+    moved = [key for key in keys if ring.get(key) != before[key]]
+    assert all(ring.get(key) == 4 for key in moved)
+    assert len(moved) < len(keys) / 3
+    ring.remove(4)
+    assert {key: ring.get(key) for key in keys} == before
+
+
+def test_share():
+    assert [_share(10, i, 4) for i in range(4)] == [3, 3, 2, 2]
+    assert sum(_share(7, i, 3) for i in range(3)) == 7
+
+
+@pytest.mark.asyncio
+async def test_run_workers(tmp_path: Path):
+    bot = Machina()
+    path = tmp_path / "emit.log"
+    names = _names_by_owner(2, 2)
+
+    for name in names[0] + names[1]:
+
+        @bot.emit(name=name, count=1)
+        async def _(name=name):
+            _record(path, name)
+
+    await bot.run(workers=2)
+
+    # 全てのemitが一回ずつ、担当のshardで実行される
+    result = _read(path)
+    assert sorted(result) == sorted(names[0] + names[1])
+    assert result[names[0][0]] == result[names[0][1]]
+    assert result[names[1][0]] == result[names[1][1]]
+    assert len({result[names[0][0]], result[names[1][0]], os.getpid()}) == 3
+
+
+@pytest.mark.asyncio
+async def test_run_workers_routing(tmp_path: Path):
+    bot = Machina()
+    path = tmp_path / "emit.log"
+    names = _names_by_owner(2, 1)
+    first, second = names[0][0], names[1][0]
+
+    @bot.emit(name=first, count=1)
+    async def _(event: Event):
+        _record(path, first)
+        # 別のshardが担当するemitは担当のshardで起動する
+        assert event.start(second) is None
+        assert event.get(second) is None
+        with pytest.raises(MachinaException):
+            event.start("unknown")
+
+    @bot.emit(name=second, count=1, alive=False)
+    async def _(event: Event):
+        _record(path, second)
+
+    await bot.run(workers=2)
+
+    result = _read(path)
+    assert sorted(result) == sorted([first, second])
+    assert result[first] != result[second]
+
+
+@pytest.mark.asyncio
+async def test_run_workers_concurrent_group(tmp_path: Path):
+    bot = Machina()
+    path = tmp_path / "execute.log"
+    names = _names_by_owner(2, 1)
+    bot.create_concurrent_group(name="rate", time_limit=0.1, time_calls_limit=2, burst=1, engine="gcra")
+
+    @bot.execute(concurrent_groups=["rate"])
+    async def call():
+        with open(path, "a") as f:
+            f.write(f"{time.monotonic()}\n")
+
+    for name in names[0] + names[1]:
+
+        @bot.emit(name=name, count=1)
+        async def _(event: Event):
+            for _ in range(3):
+                event.execute("call")
+
+    await bot.run(workers=2)
+
+    # 2つのshardの実行を合わせても0.05秒に1回になる
+    starts = sorted(float(line) for line in path.read_text().splitlines())
+    assert len(starts) == 6
+    for previous, current in zip(starts, starts[1:]):
+        assert current - previous >= 0.05 - 0.005
+
+
+@pytest.mark.asyncio
+async def test_run_workers_logging_and_errors(tmp_path: Path):
+    records: list[logging.LogRecord] = []
+
+    class Handler(logging.Handler):
+        def emit(self, record):
+            records.append(record)
+
+    logger = logging.getLogger("test_sharding")
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(Handler())
+    bot = Machina(logger=logger)
+    names = _names_by_owner(2, 1)
+
+    @bot.emit(name=names[0][0], count=1)
+    async def _():
+        pass
+
+    @bot.emit(name=names[1][0], count=1)
+    async def _():
+        raise ZeroDivisionError
+
+    # 失敗したshardの例外は親プロセスで送出し、ログは親プロセスのloggerに集める
+    with pytest.raises(MachinaException, match="ZeroDivisionError"):
+        await bot.run(workers=2)
+    assert {getattr(record, "shard", None) for record in records} == {0, 1}
+    assert any("Uncatched error" in record.getMessage() and getattr(record, "shard", None) == 1 for record in records)
+
+    # 起動時の例外
+    def fail():
+        raise ValueError
+
+    bot = Machina(on_startup=[fail])
+    with pytest.raises(MachinaException, match="ValueError"):
+        await bot.run(workers=2)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("killed", [0, 1])
+async def test_run_workers_killed(killed: int):
+    bot = Machina()
+    names = _names_by_owner(2, 1)
+
+    for index in range(2):
+
+        @bot.emit(name=names[index][0], count=1)
+        async def _(index=index):
+            if index == killed:
+                os.kill(os.getpid(), signal.SIGKILL)
+            await asyncio.sleep(10)
+
+    # doneを送らずに終了したshardがあれば、何番目のshardでも全て止めて例外を送出する
+    with pytest.raises(MachinaException, match=f"shard {killed}: shardのプロセスが異常終了しました"):
+        await asyncio.wait_for(bot.run(workers=2), 5)
+
+
+def test_run_workers_validation():
+    # time_limitはengine='gcra'のみ、entire_calls_limitはworkers以上
+    bot = Machina()
+    bot.create_concurrent_group(name="window", time_limit=1)
+    with pytest.raises(MachinaException):
+        _run(bot, 2)
+
+    bot = Machina()
+    bot.create_concurrent_group(name="small", entire_calls_limit=1)
+    with pytest.raises(MachinaException):
+        _run(bot, 2)
+    with pytest.raises(MachinaException):
+        _run(Machina(), 0)
+
+
+def _run(bot: Machina, workers: int):
+    asyncio.run(bot.run(workers=workers))
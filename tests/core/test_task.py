@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from exmachina.core.task import TaskRegistry, TaskStats
+
+
+@pytest.mark.asyncio
+async def test_task_registry():
+    registry = TaskRegistry()
+    loop = asyncio.get_running_loop()
+
+    emit = loop.create_future()
+    a1, a2, b1 = loop.create_future(), loop.create_future(), loop.create_future()
+
+    registry.add("emit", "emit", emit)
+    task_id = registry.add("execute", "a", a1)
+    registry.add("execute", "a", a2)
+    registry.add("execute", "b", b1)
+
+    assert len(registry) == 4
+    assert registry.get(task_id) is a1
+    assert registry.count("emit") == 1
+    assert registry.count("execute") == 3
+    assert registry.count("execute", "a") == 2
+    assert registry.tasks("execute", "a") == [a1, a2]
+    assert registry.tasks("execute") == [a1, a2, b1]
+    assert registry.tasks("execute", "not_exists") == []
+
+    registry.start_execution("a")
+    registry.start_execution("b")
+    assert registry.executings() == 2
+    assert registry.executings("a") == 1
+    registry.finish_execution("a")
+    assert registry.executings("a") == 0
+
+    registry.remove(a1)
+    # 未登録のタスクの削除は何もしない
+    registry.remove(a1)
+    assert registry.get(task_id) is None
+    assert registry.count("execute", "a") == 1
+
+    stats = registry.stats(["a", "b", "c"])
+    assert stats.emits == 1
+    assert stats.executes == 2
+    assert stats.executings == 1
+    assert stats.by_execute == {
+        "a": TaskStats(tasks=1, executings=0),
+        "b": TaskStats(tasks=1, executings=1),
+        "c": TaskStats(tasks=0, executings=0),
+    }
+
+    for future in [emit, a2, b1]:
+        registry.remove(future)
+    assert len(registry) == 0
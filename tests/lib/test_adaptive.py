@@ -0,0 +1,60 @@
+import pytest
+
+from exmachina.lib.adaptive import AIMD, Gradient
+
+
+def test_adaptive_limit_error():
+    with pytest.raises(ValueError):
+        AIMD(initial_limit=0)
+    with pytest.raises(ValueError):
+        AIMD(initial_limit=10, max_limit=5)
+    with pytest.raises(ValueError):
+        AIMD(initial_limit=1, backoff=1)
+
+
+def test_aimd():
+    aimd = AIMD(initial_limit=4, min_limit=2, max_limit=6, latency_threshold=1.0)
+
+    # 並列実行数分の成功でおおよそ+1
+    for _ in range(4):
+        aimd.update(0.1, False)
+    assert aimd.limit == 4
+    aimd.update(0.1, False)
+    assert aimd.limit == 5
+
+    # 上限を超えない
+    for _ in range(100):
+        aimd.update(0.1, False)
+    assert aimd.limit == 6
+
+    # エラーと遅延で減らす
+    assert aimd.update(0.1, True) == 5
+    assert aimd.update(2.0, False) == 4
+
+    # 下限を下回らない
+    for _ in range(100):
+        aimd.update(0.1, True)
+    assert aimd.limit == 2
+
+
+def test_gradient():
+    gradient = Gradient(initial_limit=10, max_limit=100)
+
+    # 処理時間が安定していれば増える
+    for _ in range(50):
+        gradient.update(0.1, False)
+    increased = gradient.limit
+    assert increased > 10
+
+    # 処理時間が長期平均より大きく悪化すると減る
+    for _ in range(20):
+        gradient.update(1.0, False)
+    assert gradient.limit < increased
+
+    # エラーで減る
+    limit = gradient.limit
+    assert gradient.update(0.1, True) < limit
+
+    # 処理時間0は無視する
+    limit = gradient.limit
+    assert gradient.update(0.0, False) == limit
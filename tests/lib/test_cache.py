@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+
+from exmachina.lib.cache import MISSING, TTLCache
+
+
+def test_ttl_cache(mocker: MockerFixture):
+    monotonic = mocker.patch("exmachina.lib.cache.monotonic", return_value=100.0)
+    with pytest.raises(ValueError):
+        TTLCache(maxsize=0)
+
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1, ttl=1)
+    cache.set("b", 2)
+    assert "b" in cache
+    assert cache.get("a") == 1
+    # 上限を超えると最も長く使われていないbが削除される
+    cache.set("c", 3)
+    assert cache.get("b") is MISSING
+    assert len(cache) == 2
+
+    # 有効期限が切れると取得できない
+    monotonic.return_value = 101.0
+    assert cache.get("a") is MISSING
+    assert cache.get("c") == 3
+
+    cache.discard("c")
+    assert len(cache) == 0
+    cache.set("d", 4)
+    cache.clear()
+    assert "d" not in cache
+
+
+@pytest.mark.asyncio
+async def test_ttl_cache_single_flight():
+    cache = TTLCache()
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    # 同時に取得しても計算は一度だけ
+    assert await asyncio.gather(*[cache.get_or_create("a", factory) for _ in range(5)]) == [1] * 5
+    assert await cache.get_or_create("a", factory) == 1
+    assert len(calls) == 1
+
+    # 例外は待っていた全ての呼び出しに送出し、キャッシュしない
+    async def error():
+        await asyncio.sleep(0.01)
+        raise ZeroDivisionError
+
+    results = await asyncio.gather(*[cache.get_or_create("b", error) for _ in range(3)], return_exceptions=True)
+    assert all(isinstance(res, ZeroDivisionError) for res in results)
+    assert "b" not in cache
+
+    # 計算していた呼び出しがキャンセルされた場合は待っていた呼び出しが計算し直す
+    leader = asyncio.create_task(cache.get_or_create("c", factory))
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(cache.get_or_create("c", factory))
+    await asyncio.sleep(0)
+    leader.cancel()
+    assert await waiter == 3
+    assert leader.cancelled()
+    assert cache.get("c") == 3
+
+
+@pytest.mark.asyncio
+async def test_ttl_cache_finalizer():
+    cache = TTLCache(maxsize=1)
+    closed = []
+
+    def finalizer(key: str):
+        async def finalize():
+            closed.append(key)
+            if key == "c":
+                raise ZeroDivisionError
+
+        return finalize
+
+    errors = []
+    asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context["exception"]))
+
+    # 上限を超えて削除された値の後処理はタスクとして実行する
+    cache.set_finalizer("a", finalizer("a"))
+    cache.set("a", 1)
+    cache.set_finalizer("b", finalizer("b"))
+    cache.set("b", 2)
+    await asyncio.sleep(0)
+    assert closed == ["a"]
+
+    cache.discard("b")
+    await asyncio.sleep(0)
+    assert closed == ["a", "b"]
+
+    # 終了時は残りの後処理を待ち、例外は報告して続行する
+    cache.set_finalizer("c", finalizer("c"))
+    cache.set("c", 3)
+    cache.set_finalizer("d", finalizer("d"))
+    await cache.aclose()
+    assert closed == ["a", "b", "d", "c"]
+    assert len(cache) == 0
+    assert [type(e) for e in errors] == [ZeroDivisionError]
@@ -0,0 +1,118 @@
+import pytest
+from pytest_mock.plugin import MockerFixture
+
+from exmachina.lib.circuit_breaker import CircuitBreaker, CircuitOpenError, RetryBudget
+
+
+@pytest.fixture
+def clock(mocker: MockerFixture):
+    now = [0.0]
+    mocker.patch("exmachina.lib.circuit_breaker.monotonic", side_effect=lambda: now[0])
+    return now
+
+
+def test_retry_budget(clock):
+    with pytest.raises(ValueError):
+        RetryBudget(ratio=-1)
+    with pytest.raises(ValueError):
+        RetryBudget(window=0)
+
+    budget = RetryBudget(ratio=0.5, min_retries=1, window=10, buckets=10)
+    assert budget.remaining() == 1
+    assert budget.try_retry()
+    assert not budget.try_retry()
+
+    # 呼び出し回数に応じてリトライが許可される
+    for _ in range(4):
+        budget.record_call()
+    assert budget.remaining() == 2
+    assert budget.try_retry()
+    assert budget.try_retry()
+    assert not budget.try_retry()
+
+    # windowを過ぎると集計から外れる
+    clock[0] = 5
+    assert budget.remaining() == 0
+    clock[0] = 10
+    assert budget.remaining() == 1
+
+
+def test_circuit_breaker(clock):
+    with pytest.raises(ValueError):
+        CircuitBreaker(failure_threshold=0)
+
+    breaker = CircuitBreaker(name="api", failure_threshold=2, recovery_time=10, half_open_calls=2)
+
+    # 連続しない失敗ではopenにならない
+    breaker.acquire()
+    breaker.record(True)
+    breaker.acquire()
+    breaker.record(False)
+    breaker.acquire()
+    breaker.record(True)
+    assert breaker.state == "closed"
+
+    breaker.acquire()
+    breaker.record(True)
+    assert breaker.state == "open"
+
+    clock[0] = 4
+    with pytest.raises(CircuitOpenError) as e:
+        breaker.acquire()
+    assert e.value.name == "api"
+    assert e.value.retry_after == 6
+
+    # half_openではhalf_open_calls回まで試す
+    clock[0] = 10
+    assert breaker.state == "half_open"
+    trial = breaker.acquire()
+    assert trial is not None
+    assert breaker.acquire() == trial
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+
+    # 結果を得ずに終わった試行は枠を返す
+    breaker.cancel(trial)
+    breaker.acquire()
+
+    # 失敗するとopenに戻る
+    breaker.record(False, trial)
+    breaker.record(True, trial)
+    assert breaker.state == "open"
+
+    # 全て成功するとclosedに戻る
+    clock[0] = 20
+    trial = breaker.acquire()
+    breaker.record(False, trial)
+    assert breaker.state == "half_open"
+    trial = breaker.acquire()
+    breaker.record(False, trial)
+    assert breaker.state == "closed"
+
+
+def test_circuit_breaker_stale_calls(clock):
+    breaker = CircuitBreaker(failure_threshold=1, recovery_time=10, half_open_calls=1)
+
+    # closedの間に許可された呼び出しはtrialを持たない
+    stale = [breaker.acquire() for _ in range(3)]
+    assert stale == [None, None, None]
+    breaker.record(True, stale.pop())
+    assert breaker.state == "open"
+
+    clock[0] = 10
+    trial = breaker.acquire()
+    # closedの間に許可された呼び出しの終了はhalf_openの試行枠を返却せず、結果も数えない
+    breaker.cancel(stale.pop())
+    breaker.record(False, stale.pop())
+    assert breaker.state == "half_open"
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+
+    # 失敗してopenに戻った後、前回のhalf_openの試行の結果は次のhalf_openで数えない
+    breaker.record(True, trial)
+    clock[0] = 20
+    assert breaker.state == "half_open"
+    breaker.record(True, trial)
+    assert breaker.state == "half_open"
+    breaker.record(False, breaker.acquire())
+    assert breaker.state == "closed"
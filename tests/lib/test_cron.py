@@ -0,0 +1,42 @@
+from datetime import datetime
+
+import pytest
+
+from exmachina.lib.cron import Cron
+
+
+def test_cron_parse():
+    cron = Cron("*/15 9-17/4 1,15 * 5-7")
+    assert cron.minutes == {0, 15, 30, 45}
+    assert cron.hours == {9, 13, 17}
+    assert cron.days == {1, 15}
+    assert cron.months == set(range(1, 13))
+    assert cron.weekdays == {0, 5, 6}
+    assert Cron("5/20 * * * *").minutes == {5, 25, 45}
+    assert Cron("@daily").hours == {0}
+    assert repr(Cron("@daily")) == "Cron('@daily')"
+
+    for expression in ["* * * *", "60 * * * *", "* * 0 * *", "*/0 * * * *", "5-1 * * * *", "a * * * *"]:
+        with pytest.raises(ValueError):
+            Cron(expression)
+
+
+@pytest.mark.parametrize(
+    "expression, now, expected",
+    [
+        ("* * * * *", datetime(2026, 1, 1, 10, 0, 30), datetime(2026, 1, 1, 10, 1)),
+        ("*/15 9-17 * * 1-5", datetime(2026, 10, 17, 12, 3), datetime(2026, 10, 19, 9, 0)),
+        ("0 * * * *", datetime(2026, 12, 31, 23, 0), datetime(2027, 1, 1, 0, 0)),
+        ("0 0 29 2 *", datetime(2026, 1, 1), datetime(2028, 2, 29, 0, 0)),
+        # 日と曜日の両方を指定した場合はどちらかに一致すればよい
+        ("0 12 13 * 5", datetime(2026, 1, 1), datetime(2026, 1, 2, 12, 0)),
+        ("30 8 * * 7", datetime(2026, 10, 17), datetime(2026, 10, 18, 8, 30)),
+    ],
+)
+def test_cron_next(expression: str, now: datetime, expected: datetime):
+    assert Cron(expression).next(now) == expected
+
+
+def test_cron_never():
+    with pytest.raises(ValueError):
+        Cron("0 0 31 2 *").next(datetime(2026, 1, 1))
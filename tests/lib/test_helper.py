@@ -1,9 +1,24 @@
 import asyncio
+import functools
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
-from exmachina.lib.helper import interval_to_second, to_thread
+from exmachina.lib.helper import call_by_name, interval_to_second, run_in_executor, to_thread
+
+
+def add(x: int, y: int = 0):
+    return x + y
+
+
+@functools.wraps(add)
+def wrapped_add(*args, **kwargs):
+    raise NotImplementedError
+
+
+class Namespace:
+    add = staticmethod(wrapped_add)
 
 
 @pytest.mark.parametrize(
@@ -46,3 +61,15 @@ async def test_to_thread():
     res = await asyncio.gather(task1, task2)
     assert res == [2, 1]
     assert results == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_run_in_executor():
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="test") as executor:
+        assert await run_in_executor(executor, add, 1, y=2) == 3
+
+
+def test_call_by_name():
+    assert call_by_name(__name__, "add", (1,), {"y": 2}) == 3
+    # デコレートされていても元の関数を呼び出す
+    assert call_by_name(__name__, "Namespace.add", (1,), {"y": 2}) == 3
@@ -0,0 +1,99 @@
+import asyncio
+import math
+
+import pytest
+
+from exmachina.lib.metrics import HistogramSnapshot, MetricsRegistry
+
+
+def test_metrics_registry():
+    registry = MetricsRegistry()
+    counter = registry.counter("requests_total", "リクエスト数", labels=("path",))
+    gauge = registry.gauge("in_flight")
+    histogram = registry.histogram("latency_seconds", labels=("path",), buckets=(0.1, 1.0))
+
+    # 同じ名前は同じものを返し、定義が異なる場合はエラー
+    assert registry.counter("requests_total", labels=("path",)) is counter
+    assert registry.get("in_flight") is gauge
+    with pytest.raises(ValueError):
+        registry.gauge("requests_total", labels=("path",))
+    with pytest.raises(ValueError):
+        counter.labels("a", "b")
+
+    counter.labels("/a").inc()
+    counter.labels("/a").inc(2)
+    gauge.labels().inc()
+    gauge.labels().dec(3)
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        histogram.labels("/a").observe(value)
+
+    snapshot = registry.snapshot()
+    assert snapshot["requests_total"] == {("/a",): 3.0}
+    assert snapshot["in_flight"] == {(): -2.0}
+    h = snapshot["latency_seconds"][("/a",)]
+    assert isinstance(h, HistogramSnapshot)
+    assert h.buckets == ((0.1, 2), (1.0, 3), (math.inf, 4))
+    assert h.count == 4
+    assert h.sum == pytest.approx(2.65)
+    assert h.quantile(0.5) == pytest.approx(0.1)
+    assert h.quantile(0.75) == pytest.approx(1.0)
+    assert h.quantile(1.0) == 1.0
+
+    # 取得時に計算する値
+    gauge.labels().set_function(lambda: 7)
+    assert registry.snapshot()["in_flight"] == {(): 7.0}
+
+
+def test_histogram_empty():
+    registry = MetricsRegistry()
+    h = registry.histogram("h").labels().get()
+    assert math.isnan(h.quantile(0.5))
+
+
+def test_render_prometheus():
+    registry = MetricsRegistry()
+    registry.counter("c_total", "help\ntext", labels=("name",)).labels('a"b').inc()
+    registry.histogram("h_seconds", buckets=(0.5,)).labels().observe(0.1)
+    registry.gauge("g").labels().set(math.inf)
+
+    assert registry.render_prometheus() == "\n".join(
+        [
+            "# HELP c_total help\\ntext",
+            "# TYPE c_total counter",
+            'c_total{name="a\\"b"} 1.0',
+            "# HELP h_seconds ",
+            "# TYPE h_seconds histogram",
+            'h_seconds_bucket{le="0.5"} 1',
+            'h_seconds_bucket{le="+Inf"} 1',
+            "h_seconds_sum 0.1",
+            "h_seconds_count 1",
+            "# HELP g ",
+            "# TYPE g gauge",
+            "g +Inf",
+            "",
+        ]
+    )
+
+
+@pytest.mark.asyncio
+async def test_serve():
+    registry = MetricsRegistry()
+    registry.counter("c_total").labels().inc()
+    server = await registry.serve(port=0)
+    port = server.sockets[0].getsockname()[1]
+
+    async def get(path: str) -> bytes:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        return response
+
+    response = await get("/metrics")
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert response.endswith(b"c_total 1.0\n")
+    assert (await get("/")).startswith(b"HTTP/1.1 404 Not Found\r\n")
+
+    server.close()
+    await server.wait_closed()
@@ -0,0 +1,192 @@
+import asyncio
+import multiprocessing
+import os
+import time
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+
+from exmachina.lib.rate_backend import (
+    _BOOT_ID_PATH,
+    _STATE,
+    MemoryRateBackend,
+    RateLimitBackend,
+    SharedMemoryRateBackend,
+    _boot_id,
+    _clock_epoch,
+    create_rate_backend,
+)
+from exmachina.lib.time_semaphore import GCRASemaphore, create_time_semaphore
+
+
+@pytest.fixture
+def shm_key(tmp_path, request):
+    key = f"test-{request.node.name}".replace("[", "-").replace("]", "")
+    backend = SharedMemoryRateBackend(key, directory=str(tmp_path))
+    yield key, str(tmp_path)
+    backend.unlink()
+
+
+def test_memory_rate_backend():
+    backend = MemoryRateBackend()
+    # 0.1秒に1回、0.1秒分の前倒し(2回の連続実行)を許可する
+    assert backend.take(10.0, 0.1, 0.1)
+    assert backend.take(10.0, 0.1, 0.1)
+    assert not backend.take(10.0, 0.1, 0.1)
+    assert backend.tat() == pytest.approx(10.2)
+    backend.refund(0.1)
+    assert backend.take(10.0, 0.1, 0.1)
+    assert backend.take(10.1, 0.1, 0.1)
+
+
+def test_shared_memory_rate_backend(shm_key):
+    key, directory = shm_key
+    with pytest.raises(ValueError):
+        SharedMemoryRateBackend("../a", directory=directory)
+
+    # 同じkeyのbackendは状態を共有する
+    a = SharedMemoryRateBackend(key, directory=directory)
+    b = SharedMemoryRateBackend(key, directory=directory)
+    assert a.take(10.0, 0.1, 0.0)
+    assert not b.take(10.0, 0.1, 0.0)
+    assert b.tat() == pytest.approx(10.1)
+    a.refund(0.1)
+    assert b.take(10.0, 0.1, 0.0)
+    a.close()
+    a.close()
+    b.close()
+
+
+def test_shared_memory_rate_backend_reboot(shm_key, mocker: MockerFixture):
+    key, directory = shm_key
+    backend = SharedMemoryRateBackend(key, directory=directory)
+    future = time.monotonic() + 3600
+    if os.path.exists(_BOOT_ID_PATH):
+        assert len(_boot_id()) == 16
+
+    # boot_idが同じなら、時刻の調整でmonotonicの基準時刻がずれても状態を破棄しない
+    mocker.patch("exmachina.lib.rate_backend._boot_id", return_value=b"a" * 16)
+    _STATE.pack_into(backend._map, 0, b"a" * 16, _clock_epoch() - 3600, future)
+    assert backend.tat() == future
+    # 再起動前(boot_idが違う)に記録された遠い未来のTATは破棄する
+    _STATE.pack_into(backend._map, 0, b"b" * 16, _clock_epoch(), future)
+    assert backend.tat() == 0.0
+    assert backend.take(time.monotonic(), 0.1, 0.0)
+    assert backend.tat() == pytest.approx(time.monotonic() + 0.1, abs=0.05)
+
+    # boot_idがない環境ではmonotonicの基準時刻で判断する
+    mocker.patch("exmachina.lib.rate_backend._boot_id", return_value=b"")
+    _STATE.pack_into(backend._map, 0, b"", _clock_epoch(), future)
+    assert backend.tat() == future
+    _STATE.pack_into(backend._map, 0, b"", _clock_epoch() - 3600, future)
+    assert backend.tat() == 0.0
+    backend.close()
+
+
+def _try_lock(backend: SharedMemoryRateBackend, queue) -> None:
+    fcntl = backend._fcntl
+    try:
+        fcntl.flock(backend._lock().fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        queue.put(False)
+    else:
+        queue.put(True)
+
+
+def test_shared_memory_rate_backend_fork(shm_key):
+    if "fork" not in multiprocessing.get_all_start_methods():
+        pytest.skip("forkが使えない環境")
+    key, directory = shm_key
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    backend = SharedMemoryRateBackend(key, directory=directory)
+
+    def run() -> bool:
+        process = context.Process(target=_try_lock, args=(backend, queue))
+        process.start()
+        locked = queue.get(timeout=10)
+        process.join()
+        return locked
+
+    # fork前に作ったbackendでも、子プロセスは親プロセスのロック中にロックを取れない
+    with backend._lock():
+        assert not run()
+    assert run()
+    backend.close()
+
+
+def test_create_rate_backend():
+    assert isinstance(create_rate_backend("memory"), MemoryRateBackend)
+    backend = MemoryRateBackend()
+    assert create_rate_backend(backend) is backend
+    with pytest.raises(ValueError):
+        create_rate_backend("shm")
+    with pytest.raises(ValueError):
+        create_rate_backend("redis")  # type: ignore
+    with pytest.raises(ValueError):
+        create_time_semaphore("window", time_limit=1, backend=backend)
+    assert issubclass(SharedMemoryRateBackend, RateLimitBackend)
+
+
+@pytest.mark.asyncio
+async def test_GCRASemaphore_shared(shm_key):
+    key, directory = shm_key
+    loop = asyncio.get_running_loop()
+    # 同じ状態を共有する2つのSemaphoreは合わせて0.05秒に1回になる
+    sems = [
+        GCRASemaphore(time_limit=0.05, time_calls_limit=1, backend=SharedMemoryRateBackend(key, directory=directory))
+        for _ in range(2)
+    ]
+    starts = []
+    start = loop.time()
+
+    async def func(sem: GCRASemaphore):
+        async with sem:
+            starts.append(loop.time() - start)
+
+    await asyncio.gather(*[func(sems[i % 2]) for i in range(4)])
+
+    starts.sort()
+    for i in range(1, 4):
+        assert starts[i] >= 0.05 * i - 0.001
+    assert all(sem._timer is None for sem in sems)
+
+
+def _stress_worker(key: str, directory: str, begin: float, duration: float, queue) -> None:
+    async def run():
+        sem = GCRASemaphore(
+            time_limit=0.1, time_calls_limit=5, burst=2, backend=SharedMemoryRateBackend(key, directory=directory)
+        )
+        await asyncio.sleep(max(begin - time.monotonic(), 0))
+        starts = []
+        while time.monotonic() < begin + duration:
+            async with sem:
+                starts.append(time.monotonic())
+        return starts
+
+    queue.put(asyncio.run(run()))
+
+
+def test_shared_memory_rate_backend_processes(shm_key):
+    if "fork" not in multiprocessing.get_all_start_methods():
+        pytest.skip("forkが使えない環境")
+    key, directory = shm_key
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    # 4プロセスで0.02秒に1回(burst=2)の制限を共有する
+    begin, duration = time.monotonic() + 0.3, 0.6
+    processes = [
+        context.Process(target=_stress_worker, args=(key, directory, begin, duration, queue)) for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    starts = sorted(t for _ in processes for t in queue.get(timeout=10))
+    for process in processes:
+        process.join()
+
+    # 全体でも任意の0.1秒間に5回 + burstの分までしか実行されない
+    for i, t in enumerate(starts):
+        assert sum(1 for s in starts[i:] if s < t + 0.1) <= 5 + 2
+    # 期間中の合計も1プロセス分の制限に収まる(制限を共有しなければ4倍になる)
+    in_duration = [t for t in starts if t < begin + duration]
+    assert duration / 0.02 * 0.8 <= len(in_duration) <= duration / 0.02 + 2 + 1
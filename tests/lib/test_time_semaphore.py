@@ -1,9 +1,17 @@
 import asyncio
+import math
 import time
 
 import pytest
 
-from exmachina.lib.time_semaphore import TimeSemaphore
+from exmachina.lib.time_semaphore import (
+    GCRASemaphore,
+    SlidingWindowSemaphore,
+    TimeSemaphore,
+    acquire_all,
+    create_time_semaphore,
+    release_all,
+)
 
 
 @pytest.mark.asyncio
@@ -91,3 +99,398 @@ async def test_TimeSemaphore_decorator():
 
     assert starts[2] == 0.1  # 三つ目のタスクが実行されるのは0.1秒後
     assert starts[3] == 0.2  # 1つめ乃至二つ目のタスクの終了を待つので0.2秒後
+
+
+@pytest.mark.asyncio
+async def test_TimeSemaphore_release_on_cancel():
+    # 時間制限の待機中にキャンセルされた場合は全体の枠を返却する
+    sem = TimeSemaphore(entire_calls_limit=2, time_calls_limit=1, time_limit=10)
+    await sem.acquire()
+    task = asyncio.create_task(sem.acquire())
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert not sem._sem.locked()
+
+
+@pytest.mark.asyncio
+async def test_GCRASemaphore():
+    with pytest.raises(ValueError):
+        GCRASemaphore(time_limit=1, time_calls_limit=0)
+    with pytest.raises(ValueError):
+        GCRASemaphore(time_limit=1, burst=0)
+
+    loop = asyncio.get_running_loop()
+    # 0.05秒に1回、2回まで連続して実行できる
+    sem = GCRASemaphore(time_limit=0.1, time_calls_limit=2)
+    assert sem.burst == 2
+
+    starts = []
+    start = loop.time()
+
+    @sem
+    async def func():
+        starts.append(loop.time() - start)
+
+    await asyncio.gather(*[func() for _ in range(5)])
+
+    assert starts[1] < 0.04  # burstの分は即時実行
+    for i in range(2, 5):
+        assert starts[i] >= 0.05 * (i - 1) - 0.001  # 以降は0.05秒毎
+    assert sem._timer is None
+
+
+@pytest.mark.asyncio
+async def test_GCRASemaphore_fractional_rate():
+    loop = asyncio.get_running_loop()
+    # 0.5回/0.01秒 = 0.02秒に1回
+    sem = GCRASemaphore(time_limit=0.01, time_calls_limit=0.5)
+    assert sem.burst == 1
+
+    await sem.acquire()
+    sem.release()
+    start = loop.time()
+    await sem.acquire()
+    sem.release()
+    assert loop.time() - start >= 0.019
+
+
+@pytest.mark.asyncio
+async def test_GCRASemaphore_single_timer(mocker):
+    loop = asyncio.get_running_loop()
+    call_at = mocker.spy(loop, "call_at")
+    call_later = mocker.spy(loop, "call_later")
+
+    sem = GCRASemaphore(time_limit=0.05, time_calls_limit=50, burst=1)
+
+    async def func():
+        async with sem:
+            ...
+
+    await asyncio.gather(*[func() for _ in range(20)])
+    # 待機中のタスクがいてもタイマーは一つずつしか登録しない
+    assert call_later.call_count == 0
+    assert call_at.call_count <= 20
+
+
+@pytest.mark.asyncio
+async def test_GCRASemaphore_cancel():
+    sem = GCRASemaphore(entire_calls_limit=3, time_limit=10, time_calls_limit=1)
+    await sem.acquire()
+
+    task1 = asyncio.create_task(sem.acquire())
+    task2 = asyncio.create_task(sem.acquire())
+    await asyncio.sleep(0)
+    assert len(sem._waiters) == 2
+
+    task1.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task1
+    # 枠を取得した直後にキャンセルされた場合は枠を返却する
+    tat = sem._tat
+    sem._tat = 0
+    sem._wake_up_next()
+    task2.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task2
+    assert sem._tat == pytest.approx(asyncio.get_running_loop().time(), abs=0.1)
+    assert tat > sem._tat
+    assert not sem._sem.locked()
+
+
+@pytest.mark.parametrize("engine", ["window", "gcra"])
+@pytest.mark.asyncio
+async def test_locked_and_wait(engine: str):
+    sem = create_time_semaphore(engine, entire_calls_limit=1, time_limit=0.05, time_calls_limit=1)  # type: ignore
+    assert not sem.locked()
+
+    await sem.acquire()
+    assert sem.locked()  # 全体の制限
+    sem.release()
+    assert sem.locked()  # 時間の制限
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    await asyncio.wait_for(sem.wait(), 1)
+    assert loop.time() - start >= 0.04
+    assert not sem.locked()
+
+
+@pytest.mark.asyncio
+async def test_acquire_all():
+    entire = TimeSemaphore(entire_calls_limit=1)
+    rate = GCRASemaphore(time_limit=0.1, time_calls_limit=1)
+
+    await acquire_all([])
+    release_all([])
+
+    # rateの枠を使い切る
+    await rate.acquire()
+    rate.release()
+
+    order = []
+
+    async def both():
+        # 順序が異なっても作成順に取得する
+        await acquire_all([rate, entire])
+        order.append("both")
+        release_all([rate, entire])
+
+    async def only_entire():
+        await acquire_all([entire])
+        order.append("entire")
+        await asyncio.sleep(0.01)
+        release_all([entire])
+
+    task = asyncio.create_task(both())
+    await asyncio.sleep(0)
+    # rateを待っている間もentireの枠は保持しない
+    assert not entire.locked()
+    await only_entire()
+    await task
+
+    assert order == ["entire", "both"]
+    assert not entire.locked()
+
+
+@pytest.mark.asyncio
+async def test_acquire_all_entire_locked():
+    entire = TimeSemaphore(entire_calls_limit=1)
+    rate = GCRASemaphore(time_limit=0.05, time_calls_limit=1)
+
+    await entire.acquire()
+    task = asyncio.create_task(acquire_all([entire, rate]))
+    await asyncio.sleep(0)
+
+    # entireの順番を待っている間にrateが使われた
+    await rate.acquire()
+    rate.release()
+    entire.release()
+    await asyncio.sleep(0.01)
+    # entireを取得してもrateが取得できないのでentireは保持しない
+    assert not task.done()
+    assert not entire.locked()
+
+    await asyncio.wait_for(task, 1)
+    assert entire.locked()
+    release_all([entire, rate])
+    assert not entire.locked()
+
+    # rateが空いていればentireの順番が来た時にまとめて取得する
+    await asyncio.sleep(0.05)
+    await entire.acquire()
+    task = asyncio.create_task(acquire_all([entire, rate]))
+    await asyncio.sleep(0)
+    entire.release()
+    await asyncio.wait_for(task, 1)
+    assert entire.locked()
+    assert rate.locked()
+    release_all([entire, rate])
+
+
+@pytest.mark.asyncio
+async def test_acquire_all_not_starved():
+    entire = TimeSemaphore(entire_calls_limit=10)
+    rate = GCRASemaphore(time_limit=0.02, time_calls_limit=1)
+
+    async def hammer():
+        # 単独でacquireするタスクが常にrateの待ち行列に並んでいる
+        while True:
+            await rate.acquire()
+            rate.release()
+
+    hammers = [asyncio.create_task(hammer()) for _ in range(3)]
+    await asyncio.sleep(0)
+    try:
+        # 先を越され続けても、いずれrateの待ち行列に並んで取得する
+        await asyncio.wait_for(acquire_all([entire, rate]), 1)
+        release_all([entire, rate])
+    finally:
+        for task in hammers:
+            task.cancel()
+        await asyncio.gather(*hammers, return_exceptions=True)
+
+
+class FakeLoop:
+    def __init__(self, now: float):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+
+def use_fake_loop(sem: TimeSemaphore, now: float) -> FakeLoop:
+    loop = FakeLoop(now)
+    sem._TimeSemaphore__loop = loop  # type: ignore
+    return loop
+
+
+def test_SlidingWindowSemaphore_log():
+    with pytest.raises(ValueError):
+        SlidingWindowSemaphore(time_limit=1, time_calls_limit=0)
+
+    sem = SlidingWindowSemaphore(time_limit=1, time_calls_limit=3, mode="log")
+    loop = use_fake_loop(sem, 100.0)
+
+    assert sem.remaining() == 3
+    assert sem._try_take(100.0)
+    loop.now = 100.5
+    assert sem._try_take(100.5)
+    assert sem._try_take(100.5)
+    assert sem.remaining() == 0
+    assert not sem._try_take(100.5)
+    # 最も古い実行開始から1秒後に実行できる
+    assert sem.next_available_at() == 101.0
+
+    loop.now = 101.0
+    assert sem.remaining() == 1
+    assert sem._try_take(101.0)
+    assert not sem._try_take(101.0)
+    assert sem.next_available_at() == 101.5
+
+    loop.now = 102.5
+    assert sem.remaining() == 3
+    assert sem.next_available_at() == 102.5
+
+
+def test_SlidingWindowSemaphore_counter():
+    sem = SlidingWindowSemaphore(time_limit=1, time_calls_limit=4, mode="counter")
+    loop = use_fake_loop(sem, 100.0)
+
+    for _ in range(4):
+        assert sem._try_take(100.0)
+    assert not sem._try_take(100.0)
+    assert sem.remaining() == 0
+    # 次のウィンドウで 4 * (1 - elapsed) <= 3 となる 100.25 から実行できる
+    assert sem.next_available_at() == pytest.approx(101.25)
+
+    loop.now = 101.25
+    assert sem.remaining() == 1
+    assert sem._try_take(101.25)
+    assert not sem._try_take(101.25)
+    # 4 * (1 - elapsed) + 1 <= 3 となる 101.5 から実行できる
+    assert sem.next_available_at() == pytest.approx(101.5)
+
+    sem._refund()
+    assert sem.remaining() == 1
+
+    # 2つ以上ウィンドウが進むと回数はリセットされる
+    loop.now = 103.0
+    assert sem.remaining() == 4
+    assert sem.next_available_at() == 103.0
+
+
+def test_remaining_and_next_available_at():
+    for engine in ["window", "gcra", "sliding_log", "sliding_counter"]:
+        sem = create_time_semaphore(engine)  # type: ignore
+        use_fake_loop(sem, 100.0)
+        # 時間制限がない場合
+        assert sem.remaining() == math.inf
+        assert sem.next_available_at() == 100.0
+
+    sem = GCRASemaphore(time_limit=1, time_calls_limit=2)
+    loop = use_fake_loop(sem, 100.0)
+    assert sem.remaining() == 2
+    assert sem._try_take(100.0)
+    assert sem.remaining() == 1
+    assert sem._try_take(100.0)
+    assert sem.remaining() == 0
+    assert sem.next_available_at() == 100.5
+    loop.now = 101.0
+    assert sem.remaining() == 2
+
+
+@pytest.mark.asyncio
+async def test_TimeSemaphore_remaining():
+    loop = asyncio.get_running_loop()
+    sem = TimeSemaphore(time_limit=0.05, time_calls_limit=2)
+    assert sem.remaining() == 2
+    start = loop.time()
+    await sem.acquire()
+    await sem.acquire()
+    assert sem.remaining() == 0
+    assert sem.next_available_at() >= start + 0.05
+
+    await asyncio.sleep(0.06)
+    assert sem.remaining() == 2
+    assert sem.next_available_at() == pytest.approx(loop.time(), abs=0.01)
+
+
+@pytest.mark.parametrize("engine", ["sliding_log", "sliding_counter"])
+@pytest.mark.asyncio
+async def test_SlidingWindowSemaphore(engine: str):
+    loop = asyncio.get_running_loop()
+    sem = create_time_semaphore(engine, time_limit=0.1, time_calls_limit=2)  # type: ignore
+    assert isinstance(sem, SlidingWindowSemaphore)
+
+    starts = []
+
+    @sem
+    async def func():
+        starts.append(loop.time())
+
+    await asyncio.gather(*[func() for _ in range(6)])
+    if engine == "sliding_log":
+        # 任意の0.1秒間に2回まで
+        for prev, current in zip(starts, starts[2:]):
+            assert current - prev >= 0.1 - 1e-6
+    else:
+        # counterは近似なので全体のペースのみ確認する
+        assert starts[-1] - starts[0] >= 0.1
+
+
+@pytest.mark.asyncio
+async def test_TimeSemaphore_resize():
+    with pytest.raises(ValueError):
+        TimeSemaphore().resize(1)
+
+    sem = TimeSemaphore(entire_calls_limit=1)
+    with pytest.raises(ValueError):
+        sem.resize(0)
+
+    await sem.acquire()
+    tasks = [asyncio.create_task(sem.acquire()) for _ in range(3)]
+    await asyncio.sleep(0)
+    assert not any(task.done() for task in tasks)
+
+    # 増やすと待機中のタスクが実行される
+    sem.resize(3)
+    await asyncio.sleep(0)
+    assert [task.done() for task in tasks] == [True, True, False]
+
+    # 減らすと実行中のタスクが終わるまで新たに実行しない
+    sem.resize(1)
+    sem.release()
+    sem.release()
+    await asyncio.sleep(0)
+    assert not tasks[2].done()
+    sem.release()
+    await asyncio.sleep(0)
+    assert tasks[2].done()
+    assert sem.entire_calls_limit == 1
+
+    # 待機中のキャンセル
+    task = asyncio.create_task(sem.acquire())
+    await asyncio.sleep(0)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    sem.release()
+    assert not sem.locked()
+
+
+def test_create_time_semaphore():
+    assert type(create_time_semaphore("window", time_limit=1, time_calls_limit=2)) is TimeSemaphore
+    assert type(create_time_semaphore("gcra", time_limit=1, time_calls_limit=2)) is GCRASemaphore
+    sem = create_time_semaphore("sliding_counter", time_limit=1, time_calls_limit=2)
+    assert isinstance(sem, SlidingWindowSemaphore) and sem.mode == "counter"
+    with pytest.raises(ValueError):
+        create_time_semaphore("unknown")  # type: ignore
+    # 小数のtime_calls_limitとburstはgcraのみ
+    sem = create_time_semaphore("gcra", time_limit=1, time_calls_limit=0.5, burst=2)
+    assert isinstance(sem, GCRASemaphore) and sem.burst == 2
+    for engine in ["window", "sliding_log", "sliding_counter"]:
+        for kwargs in [dict(time_calls_limit=0.5), dict(time_calls_limit=1.5), dict(burst=2)]:
+            with pytest.raises(ValueError):
+                create_time_semaphore(engine, time_limit=1, **kwargs)  # type: ignore
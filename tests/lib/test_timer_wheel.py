@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+import pytest
+
+from exmachina.lib.timer_wheel import TimerWheel
+
+
+def test_timer_wheel_error():
+    with pytest.raises(ValueError):
+        TimerWheel(resolution=0)
+    with pytest.raises(ValueError):
+        TimerWheel(slots=0)
+
+
+@pytest.mark.asyncio
+async def test_timer_wheel_call_at():
+    wheel = TimerWheel(resolution=0.01, slots=8)
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    fired = []
+
+    for i in [3, 1, 2, 12]:
+        wheel.call_at(now + 0.01 * i, lambda i: fired.append((i, loop.time() - now)), i)
+    canceled = wheel.call_at(now + 0.02, fired.append, "canceled")
+    assert len(wheel) == 5
+    canceled.cancel()
+    canceled.cancel()
+    assert len(wheel) == 4
+
+    await asyncio.sleep(0.2)
+    # 一周(slots)を超えるタイマーも期限順に実行される
+    assert [i for i, _ in fired] == [1, 2, 3, 12]
+    for i, elapsed in fired:
+        assert elapsed >= 0.01 * i - 0.001
+    assert len(wheel) == 0
+    assert wheel._handle is None
+
+
+@pytest.mark.asyncio
+async def test_timer_wheel_sleep_until():
+    wheel = TimerWheel(resolution=0.01)
+    loop = asyncio.get_running_loop()
+
+    deadline = loop.time() + 0.05
+    await wheel.sleep_until(deadline)
+    assert deadline <= loop.time() < deadline + 0.03
+
+    # キャンセルするとタイマーも削除される
+    task = asyncio.create_task(wheel.sleep_until(loop.time() + 10))
+    await asyncio.sleep(0)
+    assert len(wheel) == 1
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert len(wheel) == 0
+    assert wheel._handle is None
+
+
+@pytest.mark.asyncio
+async def test_timer_wheel_idle_and_lag():
+    wheel = TimerWheel(resolution=0.001, slots=4)
+    loop = asyncio.get_running_loop()
+    fired = []
+
+    # 一周の間に期限を迎えるタイマーがなければ、最も早い期限まで起床しない
+    far = wheel.call_at(loop.time() + 10, fired.append, "far")
+    wheel.call_at(loop.time() + 0.001, fired.append, "near")
+    await asyncio.sleep(0.02)
+    assert fired == ["near"]
+    assert wheel._wake_tick == far.tick
+
+    # より早いタイマーを登録すると起床時刻を早める
+    wheel.call_at(loop.time() + 0.002, fired.append, "next")
+    assert wheel._wake_tick < far.tick
+    await asyncio.sleep(0.02)
+    assert fired == ["near", "next"]
+    far.cancel()
+
+    # loopが止まって一周以上遅れても期限順に実行する
+    now = loop.time()
+    for i in [3, 1, 2]:
+        wheel.call_at(now + 0.001 * i, fired.append, i)
+    time.sleep(0.02)
+    await asyncio.sleep(0.005)
+    assert fired[2:] == [1, 2, 3]
+    assert len(wheel) == 0
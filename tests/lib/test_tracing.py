@@ -0,0 +1,131 @@
+import asyncio
+import sys
+import time
+from types import ModuleType, SimpleNamespace
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+
+from exmachina.lib.tracing import Middleware, OpenTelemetryMiddleware, SamplingProfiler, Span, Tracer, get_current_span
+
+
+class Recorder(Middleware):
+    def __init__(self, name: str, calls: list):
+        self.name = name
+        self.calls = calls
+
+    def before(self, span: Span):
+        self.calls.append((self.name, "before", span.name))
+
+    def after(self, span: Span):
+        self.calls.append((self.name, "after", span.name))
+
+
+@pytest.mark.asyncio
+async def test_tracer():
+    tracer = Tracer()
+    # ミドルウェアがない場合はSpanを作成しない
+    with tracer.span("emit", "a") as span:
+        assert span is None
+    assert tracer.start("emit", "a") is None
+
+    calls: list = []
+    tracer.add(Recorder("1", calls))
+    tracer.add(Recorder("2", calls))
+    with tracer.span("emit", "a", epoch=1) as parent:
+        assert get_current_span() is parent
+        # 子のタスクにも現在のSpanが引き継がれる
+        child = await asyncio.create_task(_child(tracer))
+    assert get_current_span() is None
+
+    assert parent is not None and child is not None
+    assert parent.attributes == {"epoch": 1}
+    assert parent.duration is not None and parent.error is None
+    assert child.parent is parent
+    assert child.error is not None
+    # beforeは登録順、afterは逆順
+    assert calls == [
+        ("1", "before", "a"),
+        ("2", "before", "a"),
+        ("1", "before", "b"),
+        ("2", "before", "b"),
+        ("2", "after", "b"),
+        ("1", "after", "b"),
+        ("2", "after", "a"),
+        ("1", "after", "a"),
+    ]
+
+
+async def _child(tracer: Tracer):
+    span = None
+    with pytest.raises(ZeroDivisionError):
+        with tracer.span("execute", "b") as span:
+            raise ZeroDivisionError
+    return span
+
+
+def test_opentelemetry_middleware(mocker: MockerFixture):
+    # opentelemetryがない場合
+    mocker.patch.dict(sys.modules, {"opentelemetry": None})
+    with pytest.raises(ImportError):
+        OpenTelemetryMiddleware()
+
+    trace = SimpleNamespace(
+        set_span_in_context=lambda span: ("context", span),
+        Status=lambda code, description: (code, description),
+        StatusCode=SimpleNamespace(ERROR="ERROR"),
+        SpanKind=SimpleNamespace(INTERNAL="INTERNAL"),
+    )
+    opentelemetry = ModuleType("opentelemetry")
+    opentelemetry.trace = trace  # type: ignore
+    mocker.patch.dict(sys.modules, {"opentelemetry": opentelemetry})
+    otel_tracer = mocker.MagicMock()
+    middleware = OpenTelemetryMiddleware(otel_tracer)
+
+    parent = Span("emit", "a", {}, None)
+    child = Span("acquire", "b", {"groups": ("g1", "g2")}, parent)
+    middleware.before(parent)
+    middleware.before(child)
+    otel_parent = parent.data["otel"]
+    otel_tracer.start_span.assert_called_with(
+        "acquire b",
+        context=("context", otel_parent),
+        kind="INTERNAL",
+        attributes={"exmachina.kind": "acquire", "exmachina.name": "b", "exmachina.groups": ["g1", "g2"]},
+    )
+    child.error = ZeroDivisionError()
+    otel_child = child.data["otel"]
+    middleware.after(child)
+    otel_child.record_exception.assert_called_once_with(child.error)
+    otel_child.set_status.assert_called_once_with(("ERROR", "ZeroDivisionError()"))
+    otel_child.end.assert_called_once_with()
+    assert "otel" not in child.data
+
+
+def busy_function(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_sampling_profiler():
+    with pytest.raises(ValueError):
+        SamplingProfiler(interval=0)
+
+    profiler = SamplingProfiler(interval=0.001)
+    span = Span("execute", "a", {}, None)
+    profiler.start()
+    # Spanの実行中のみ記録する
+    busy_function(0.02)
+    assert not profiler.samples
+    profiler.before(span)
+    busy_function(0.1)
+    profiler.after(span)
+    profiler.stop()
+
+    assert sum(profiler.samples.values()) > 0
+    lines = profiler.folded().splitlines()
+    assert any("busy_function" in line for line in lines)
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert stack.split(";")[-1].startswith("busy_function")
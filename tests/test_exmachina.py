@@ -1,5 +1,75 @@
+from __future__ import annotations
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+import pytest
+
+import exmachina
 from exmachina import __version__
 
+SOURCE = os.path.dirname(os.path.dirname(os.path.abspath(exmachina.__file__)))
+# botを動かすのに必ずimportされる標準ライブラリ
+BASELINE = "import asyncio, contextvars, dataclasses, inspect, logging"
+MARK = "--exmachina-import--"
+# from exmachina import Machina でexmachinaが追加でimportする時間の上限. 同じプロセスでBASELINEをimportした時間との比
+# 実行する環境の速さに左右されないように、絶対的な時間ではなく比で比べる
+IMPORT_BUDGET_RATIO = 0.6
+
 
 def test_version():
     assert __version__ == "0.0.0"
+
+
+def test_lazy_attributes():
+    assert "Machina" in dir(exmachina)
+    assert set(exmachina.__all__) == {"__version__", *exmachina._LAZY_ATTRIBUTES}
+    for name in exmachina.__all__:
+        assert getattr(exmachina, name) is not None
+    with pytest.raises(AttributeError):
+        exmachina.unknown  # type: ignore
+
+
+def _run(code: str) -> subprocess.CompletedProcess:
+    code = f"import sys; sys.path.insert(0, {SOURCE!r}); {code}"
+    return subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True)
+
+
+def _loaded(statement: str, modules: list[str]) -> list[str]:
+    """statementを実行した後にimportされているモジュール"""
+    result = _run(f"import json; {statement}; print(json.dumps([m for m in {modules!r} if m in sys.modules]))")
+    return json.loads(result.stdout)
+
+
+def test_import_is_lazy():
+    # import exmachina だけでは何もimportしない
+    assert _loaded("import exmachina", ["asyncio", "exmachina.core.machina", "exmachina.lib.retry"]) == []
+    # 使わない機能と任意の依存はMachinaをimportしても読み込まない
+    heavy = ["multiprocessing", "concurrent.futures.process", "logging.handlers", "tempfile", "rich", "opentelemetry"]
+    assert _loaded("from exmachina import Machina, Retry, Depends", heavy) == []
+
+
+def _sum_import_time(stderr: str) -> float:
+    """-X importtimeの出力から、トップレベルのimportの累積時間を合計する[sec]"""
+    total = 0
+    for line in stderr.splitlines():
+        if line.startswith("import time:"):
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit() and not name[1:].startswith(" "):
+                total += int(cumulative)
+    return total / 1e6
+
+
+def _import_time_ratio(statement: str) -> float:
+    """statementのimport時間と、同じプロセスでBASELINEをimportした時間の比"""
+    result = _run(f"{BASELINE}; sys.stderr.write({MARK!r} + '\\n'); {statement}")
+    baseline, target = result.stderr.split(MARK + "\n", 1)
+    return _sum_import_time(target) / _sum_import_time(baseline)
+
+
+def test_import_time_budget():
+    ratio = statistics.median(_import_time_ratio("from exmachina import Machina") for _ in range(3))
+    assert ratio < IMPORT_BUDGET_RATIO